@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Benchmark placement quality and decision overhead of pool strategies.
+
+A pool of hundreds of children, each with its own maximum and its own
+(simulated) provisioning latency, serves a stream of requests while earlier
+requests are released at random, keeping the pool about two thirds full.
+Each strategy sees the same pool and the same stream. Children keep their
+state in memory stores, so the decision times are the strategies' own
+overhead; with file based stores, every strategy but in-order also reads
+each child's shard per request.
+
+Usage: benchmarks/placement.py [children] [requests]
+
+For each strategy, reports:
+decide: the mean and 95th percentile time taken to split a request.
+spread: the mean standard deviation of the children's load (in use over
+    maximum) - lower is more even.
+latency: the mean simulated time to provision a request, which is that of
+    the slowest child it used, as children provision in parallel.
+short: how many requests could not be placed in full.
+"""
+
+import math
+import random
+import sys
+import time
+
+from cr_cache.cache import Cache
+from cr_cache.source import model
+from cr_cache.store import memory
+from cr_cache.strategy import find_strategy_type
+
+
+FULL = 0.65
+MAX_REQUEST = 8
+STRATEGIES = ['in-order', 'round-robin', 'least-loaded', 'weighted', 'latency']
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def stdev(values):
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((value - mean) ** 2 for value in values)
+        / len(values))
+
+
+def make_pool(count):
+    rand = random.Random(count)
+    children = []
+    latencies = {}
+    for pos in range(count):
+        name = 'c%d' % pos
+        children.append(Cache(name, memory.Store({}, name),
+            model.Source({}, None), maximum=rand.randint(2, 10)))
+        latencies[name] = rand.uniform(1.0, 30.0)
+    return children, latencies
+
+
+def benchmark(strategy_name, children_count, requests):
+    children, latencies = make_pool(children_count)
+    capacity = sum(child.maximum for child in children)
+    weights = dict((child.name, child.maximum) for child in children)
+    strategy = find_strategy_type(strategy_name)({'weights': weights})
+    rand = random.Random(strategy_name)
+    sizes = random.Random(requests)
+    in_use = dict((child.name, 0) for child in children)
+    held = []
+    decisions = []
+    spreads = []
+    request_latencies = []
+    short = 0
+    for _ in range(requests):
+        while held and sum(in_use.values()) > FULL * capacity:
+            child, instances = held.pop(rand.randrange(len(held)))
+            child.discard(instances, force=True)
+            child.collect()
+            in_use[child.name] -= len(instances)
+        size = sizes.randint(1, MAX_REQUEST)
+        start = time.time()
+        split = strategy.split(children, size)
+        decisions.append(time.time() - start)
+        if sum(count for _, count in split) < size:
+            short += 1
+        slowest = 0.0
+        for child, count in split:
+            instances = child.provision(count)
+            held.append((child, instances))
+            in_use[child.name] += count
+            seconds = latencies[child.name] * rand.uniform(0.8, 1.2)
+            strategy.observe(child, count, seconds)
+            slowest = max(slowest, seconds)
+        request_latencies.append(slowest)
+        spreads.append(stdev([float(in_use[child.name]) / child.maximum
+            for child in children]))
+    return decisions, spreads, request_latencies, short
+
+
+def main(argv):
+    children = int(argv[1]) if len(argv) > 1 else 300
+    requests = int(argv[2]) if len(argv) > 2 else 1000
+    print('%-14s %10s %10s %8s %9s %6s' % (
+        'strategy', 'decide', 'p95', 'spread', 'latency', 'short'))
+    for strategy_name in STRATEGIES:
+        decisions, spreads, latencies, short = benchmark(
+            strategy_name, children, requests)
+        print('%-14s %8.3fms %8.3fms %8.3f %8.2fs %6d' % (strategy_name,
+            1000 * sum(decisions) / len(decisions),
+            1000 * percentile(decisions, 0.95),
+            sum(spreads) / len(spreads),
+            sum(latencies) / len(latencies), short))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
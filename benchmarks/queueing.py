@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Benchmark queueing latency of allocation policies under mixed load.
+
+A cache with a small maximum is shared by a batch load (large, long running,
+low priority requests that keep the cache full) and an interactive load
+(small, short, high priority requests arriving now and then). Every request
+waits for capacity with provision(wait=True), through a sqlite store in a
+scratch directory, exactly as concurrent crcache acquire processes would.
+
+Usage: benchmarks/queueing.py [seconds]
+
+For each policy, reports how long each kind of request waited.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from cr_cache.cache import Cache
+from cr_cache.policy import find_policy_type
+from cr_cache.source import model
+from cr_cache.store import sqlite
+
+
+MAXIMUM = 4
+# name: (threads, priority, count, hold seconds, think seconds)
+LOADS = {
+    'batch': (4, 0, 2, 0.2, 0.0),
+    'interactive': (2, 10, 1, 0.05, 0.2),
+    }
+POLICIES = [
+    ('fifo', {}),
+    ('priority', {}),
+    ('priority', {'reserved': {10: 1}}),
+    ]
+
+
+def run_load(cache_factory, name, priority, count, hold, think, stop,
+    results):
+    cache = cache_factory()
+    rand = random.Random(name)
+    while not stop.is_set():
+        time.sleep(rand.uniform(0, 2 * think))
+        start = time.time()
+        instances = cache.provision(count, wait=True, priority=priority)
+        results.append(time.time() - start)
+        time.sleep(hold)
+        cache.discard(instances, force=True)
+        cache.collect()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def benchmark(policy_name, config, seconds):
+    source = model.Source({}, None)
+    policy = find_policy_type(policy_name)(config)
+    shard = '%s-%d' % (policy_name, len(config))
+    def cache_factory():
+        return Cache('bench', sqlite.Store(shard=shard), source,
+            maximum=MAXIMUM, policy=policy)
+    stop = threading.Event()
+    results = dict((name, []) for name in LOADS)
+    threads = []
+    for name, (count, priority, size, hold, think) in sorted(LOADS.items()):
+        for pos in range(count):
+            thread = threading.Thread(target=run_load, args=(cache_factory,
+                '%s-%d' % (name, pos), priority, size, hold, think, stop,
+                results[name]))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main(argv):
+    seconds = float(argv[1]) if len(argv) > 1 else 10.0
+    home = tempfile.mkdtemp()
+    os.environ['HOME'] = home
+    try:
+        print('%-32s %-12s %6s %8s %8s %8s' % (
+            'policy', 'load', 'served', 'mean', 'p95', 'max'))
+        for policy_name, config in POLICIES:
+            label = policy_name
+            if config:
+                label += ' %r' % config
+            results = benchmark(policy_name, config, seconds)
+            for name, waits in sorted(results.items()):
+                if not waits:
+                    print('%-32s %-12s %6d' % (label, name, 0))
+                    continue
+                print('%-32s %-12s %6d %7.3fs %7.3fs %7.3fs' % (label, name,
+                    len(waits), sum(waits) / len(waits),
+                    percentile(waits, 0.95), max(waits)))
+    finally:
+        shutil.rmtree(home)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
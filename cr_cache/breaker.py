@@ -0,0 +1,133 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Circuit breakers, for skipping sources that keep failing."""
+
+import time
+
+from cr_cache.store import read_locked, write_locked
+
+# How long a half-open probe may take before it is assumed abandoned and
+# another is let through.
+_PROBE_SECONDS = 600
+
+
+class Breaker(object):
+    """A circuit breaker for one cache, kept in the cache's store.
+
+    While closed, requests go through and consecutive failures are counted.
+    After failures of them in a row the breaker opens, and requests are
+    skipped for cooldown seconds. It is then half-open: one request at a time
+    is let through as a probe. If the probe succeeds the breaker closes, and
+    if it fails the breaker opens for another cooldown.
+
+    The state is in breaker/name, as "failures open_until probe_until", so
+    every crcache process sees the same breaker.
+
+    :attr cache: The cr_cache.cache.Cache being protected.
+    :attr failures: How many failures in a row open the breaker. 0 disables
+        the breaker.
+    :attr cooldown: How many seconds the breaker stays open for.
+    """
+
+    def __init__(self, cache, failures=3, cooldown=300):
+        self.cache = cache
+        self.failures = failures
+        self.cooldown = cooldown
+
+    def ready(self, now=None):
+        """Would a request be let through?
+
+        Unlike allow(), this claims nothing.
+
+        :param now: The current time.time(), for testing.
+        """
+        if not self.failures:
+            return True
+        if now is None:
+            now = time.time()
+        with read_locked(self.cache.store):
+            _, open_until, probe_until = self._load()
+        return not open_until or (now >= open_until and now >= probe_until)
+
+    def allow(self, now=None):
+        """Should a request go to the cache?
+
+        When the breaker is half-open this claims the probe, so the caller
+        must report the outcome with succeeded() or failed().
+
+        :param now: The current time.time(), for testing.
+        """
+        if not self.failures:
+            return True
+        if now is None:
+            now = time.time()
+        with read_locked(self.cache.store):
+            _, open_until, probe_until = self._load()
+        if not open_until:
+            return True
+        if now < open_until or now < probe_until:
+            return False
+        with write_locked(self.cache.store):
+            # Another process may have claimed the probe meanwhile.
+            failures, open_until, probe_until = self._load()
+            if now < open_until or now < probe_until:
+                return False
+            self._save(failures, open_until, now + _PROBE_SECONDS)
+        return True
+
+    def succeeded(self):
+        """Record a successful request, closing the breaker."""
+        if not self.failures:
+            return
+        with read_locked(self.cache.store):
+            if self._load() == (0, 0.0, 0.0):
+                return
+        with write_locked(self.cache.store):
+            try:
+                del self.cache.store['breaker/' + self.cache.name]
+            except KeyError:
+                pass
+
+    def failed(self, now=None):
+        """Record a failed request, opening the breaker if it is time to.
+
+        :param now: The current time.time(), for testing.
+        """
+        if not self.failures:
+            return
+        if now is None:
+            now = time.time()
+        with write_locked(self.cache.store):
+            failures, open_until, probe_until = self._load()
+            failures += 1
+            if open_until or failures >= self.failures:
+                # Tripped, or a half-open probe failed.
+                self._save(failures, now + self.cooldown, 0)
+            else:
+                self._save(failures, 0, 0)
+
+    def _load(self):
+        """Assumes the store is already locked."""
+        try:
+            state = self.cache.store['breaker/' + self.cache.name]
+        except KeyError:
+            return 0, 0.0, 0.0
+        failures, open_until, probe_until = state.split()
+        return int(failures), float(open_until), float(probe_until)
+
+    def _save(self, failures, open_until, probe_until):
+        """Assumes the store is already write locked."""
+        self.cache.store['breaker/' + self.cache.name] = '%d %f %f' % (
+            failures, open_until, probe_until)
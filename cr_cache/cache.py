@@ -14,14 +14,109 @@
 
 """Resource Cache for caching resources."""
 
-from cr_cache.store import write_locked, read_locked
+import math
+import os
+import time
+import uuid
+
+from cr_cache import parallel
+from cr_cache.policy import priority
+from cr_cache.source import UnknownInstance
+from cr_cache.store import (
+    read_locked,
+    read_locked_all,
+    state_dir,
+    write_locked,
+    )
+from cr_cache.store import lockfile, notify
+
+# How long a collector may take to discard instances before they are
+# assumed abandoned and retried.
+_CLAIM_SECONDS = 600
+# The first delay before retrying a failed discard, and the longest.
+_RETRY_SECONDS = 5
+_RETRY_MAX_SECONDS = 3600
+# How much weight each day's demand gets in the forecast for its hour.
+_FORECAST_ALPHA = 0.3
+# The width of the buckets in the lease deadline index, in seconds.
+_LEASE_BUCKET_SECONDS = 60
+# The most health checks to run at once.
+_CHECK_CONCURRENCY = 8
+# How long a waiter sleeps between checks when it is not notified, in case
+# the notification was missed or the waiter ahead of it died.
+_WAIT_POLL_SECONDS = 5
 
 class Cache(object):
     """Keep track of compute resources.
     
-    Cache state is stored in a persistent store. The key pool/name is used
-    to track owned instances, allocated/name to track instances handed out
-    to users, and resource/instance, to map instances back to the cache.
+    Cache state is stored in a persistent store. The set pool/name is used
+    to track owned instances, the set allocated/name to track instances handed
+    out to users, the set cached/name to track owned instances that are not
+    handed out, and the key resource/instance, to map instances back to the
+    cache. Keeping cached/name as well as pool/name lets every operation
+    touch only the instances involved, rather than diffing whole sets.
+
+    Provisioning new instances is done in two phases, so that the store is
+    not locked while the source does its (potentially very slow) work. The
+    set provisioning/name holds one placeholder per instance being
+    provisioned, counting against maximum until the source returns and the
+    real instances replace them.
+
+    Discarding is also asynchronous: discard moves instances to the set
+    discarding/name, and collect() later has the source tear them down.
+    They stay in pool/name until then, as they still use capacity. The key
+    retry/instance records how many attempts collect() has made, and when
+    the instance is next due.
+
+    Caches with a ceiling forecast their own demand. The key demand/name
+    holds the current hour, the peak number of instances in use during it,
+    and the number in use now. When the hour ends, its peak is folded into
+    forecast/name/H, an exponentially weighted average of the peak for hour
+    of the day H. warm() sizes the reserve, kept in reserve-target/name, to
+    cover the forecast for this hour and the next.
+
+    provision() calls that wait for capacity queue in the set waiting/name.
+    Members are a ticket from the counter waiter-seq/name, the priority of
+    the request and the waiting process (see lockfile.process_record). The
+    policy orders the queue: only the first waiter may provision, and calls
+    that do not wait may only jump waiters the policy puts behind them.
+    Waiters sleep on a notify.Waiter, which is woken whenever capacity may
+    have been returned.
+
+    Instances provisioned with a lease must be renewed before lease/instance,
+    their deadline, passes, or they are reclaimed as if released. Leases are
+    indexed by deadline: the set leases/name/B holds the instances whose
+    deadline falls in bucket B (time // _LEASE_BUCKET_SECONDS). The set
+    lease-buckets/name lists the buckets holding any, and the key
+    lease-next/name is no later than the earliest of them. Finding expired
+    leases only visits occupied buckets that have come due, however long the
+    cache was idle.
+
+    Instances provisioned for an owner process are recorded in
+    owner/instance, and indexed by owner in the set owned/name/owner. The set
+    owners/name lists the owners with instances, so finding those whose
+    owner has died does not visit every allocation.
+
+    Caches with a health_check probe cached instances before handing them
+    out, unless checked/instance records a pass within the last check_ttl
+    seconds. Probes run outside the lock, in parallel, on cached instances
+    claimed with check-claim/instance. Instances that fail are quarantined:
+    moved to quarantined/name and queued for collect(), so the request is
+    met by other instances instead.
+
+    usage/instance records when an instance was created, when it was last
+    released, and how many times it has been handed out. Instances older than
+    max_age, or handed out max_uses times, are not kept when released; and
+    evict() discards cached ones that are, or have been idle for max_idle.
+    When not every released instance can be kept, eviction picks which go:
+    'lru' discards those idle longest (then the oldest), 'lfu' those handed
+    out least.
+
+    Instances handed out with an affinity key remember it in
+    affinity/instance, until they are next handed out. While they are cached they are indexed in the set
+    idle/name/key, so a request with the same key finds them directly. When
+    there are not enough of those, only as many other cached instances as
+    are needed are looked at, and handed out least recently used first.
 
     The cache is a hierarchical composite structure - each cache can have
     child caches that it draws resources from.
@@ -30,12 +125,26 @@ class Cache(object):
     :attr store: The crcache.store.AbstractStore being used to persist cache
         state.
     :attr reserve: The low water policy point for the cache.
+    :attr floor: The least warm() will size the reserve to.
+    :attr ceiling: The most warm() will size the reserve to. 0 when the
+        cache does not forecast demand.
     :attr maximum: The high water policy point for the cache.
         This is never higher than the sum of the high water policies of any
         child caches (found via source.maximum).
+    :attr policy: The cr_cache.policy.AbstractPolicy deciding which requests
+        are served first when the cache is at its maximum.
+    :attr health_check: A callable taking an instance and returning whether
+        it is healthy, or None.
+    :attr check_ttl: How many seconds a health check result is trusted for.
+    :attr max_idle: Seconds a cached instance may sit unused, or 0.
+    :attr max_age: Seconds an instance may be kept for after creation, or 0.
+    :attr max_uses: How many times an instance may be handed out, or 0.
+    :attr eviction: 'lru' or 'lfu'.
     """
 
-    def __init__(self, name, store, source, reserve=0, maximum=0):
+    def __init__(self, name, store, source, reserve=0, maximum=0, floor=0,
+        ceiling=0, policy=None, health_check=None, check_ttl=300, max_idle=0,
+        max_age=0, max_uses=0, eviction='lru'):
         """Create a Cache.
 
         :param name: The name of the cache, used in storing the cache state.
@@ -50,17 +159,75 @@ class Cache(object):
         :param maximum: If non-zero, reject requests for resources if the total
             provisioned-but-not-discarded would exceed maximum. This is capped
             by the maximum of the provided source.
+        :param floor: The least warm() should size the reserve to.
+        :param ceiling: If non-zero, record demand, and let warm() size the
+            reserve between floor and ceiling to meet it. The reserve is then
+            ignored.
+        :param policy: The allocation policy. Defaults to serving requests by
+            priority with no capacity held back.
+        :param health_check: If not None, a callable taking the source's id
+            for a cached instance, returning True if it is fit to hand out.
+        :param check_ttl: How many seconds a passed health check is trusted
+            for.
+        :param max_idle: If non-zero, evict() discards cached instances unused
+            for this many seconds.
+        :param max_age: If non-zero, discard instances this many seconds after
+            they were created rather than keeping them.
+        :param max_uses: If non-zero, discard instances that have been handed
+            out this many times rather than keeping them.
+        :param eviction: Which released instances to discard first, when not
+            all can be kept: 'lru' or 'lfu'.
         """
         self.name = name
         self.store = store
         self.source = source
         self.reserve = reserve
+        self.floor = floor
+        self.ceiling = ceiling
         if self.source.maximum > 0:
             if maximum > 0:
                 maximum = min(self.source.maximum, maximum)
             else:
                 maximum = self.source.maximum
         self.maximum = maximum
+        if policy is None:
+            policy = priority.Policy({})
+        self.policy = policy
+        self.health_check = health_check
+        self.check_ttl = check_ttl
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.max_uses = max_uses
+        if eviction not in ('lru', 'lfu'):
+            raise ValueError('Unknown eviction policy %r.' % eviction)
+        self.eviction = eviction
+
+    def adopt(self, instances, allocated):
+        """Take over instances provisioned outside this store.
+
+        Used to carry over the state of older crcache versions. Instances
+        already in the pool are left alone.
+
+        :param instances: The ids of every instance to adopt.
+        :param allocated: The ids of those instances that are checked out;
+            the rest go into the reserve.
+        """
+        allocated = set(allocated)
+        with write_locked(self.store):
+            new_instances = [instance for instance in instances
+                if not self.store.sismember('pool/' + self.name, instance)]
+            now = time.time()
+            for instance in new_instances:
+                uses = 1 if instance in allocated else 0
+                self.store['resource/' + instance] = self.name
+                self.store['usage/' + instance] = '%f %f %d' % (now, now, uses)
+            self.store.sadd('pool/' + self.name, new_instances)
+            self.store.sadd('allocated/' + self.name,
+                [instance for instance in new_instances
+                 if instance in allocated])
+            self._cache([instance for instance in new_instances
+                if instance not in allocated])
+        self._notify()
 
     def available(self):
         """Report on the number of resources that could be returned.
@@ -71,25 +238,108 @@ class Cache(object):
         if not self.maximum:
             return 0
         with read_locked(self.store):
-            return self.maximum - len(
-                set(self._get_set('allocated/' + self.name)))
+            return self._available()
+
+    def _available(self):
+        """Assumes the store is already locked."""
+        if not self.maximum:
+            return 0
+        return (self.maximum - self.store.scard('allocated/' + self.name)
+            - self.store.scard('provisioning/' + self.name)
+            - self.store.scard('discarding/' + self.name))
 
     def cached(self):
         """How many instances are sitting in the reserve ready for use."""
         with read_locked(self.store):
-            return len(
-                set(self._get_set('pool/' + self.name))) - len(
-                set(self._get_set('allocated/' + self.name)))
+            return self.store.scard('cached/' + self.name)
+
+    def collect(self, now=None):
+        """Have the source tear down discarded instances that are due.
+
+        Failed discards are retried later, backing off exponentially.
+
+        :param now: The current time.time(), for testing.
+        :return: When the next discarded instance is due (which may be in the
+            past, if more became due while collecting), or None if there are
+            none left.
+        """
+        if now is None:
+            now = time.time()
+        due = []
+        with write_locked(self.store):
+            for instance in sorted(
+                self.store.smembers('discarding/' + self.name)):
+                attempts, next_time = self._retry(instance)
+                if next_time <= now:
+                    due.append(instance)
+                    # Claim it, so other collectors leave it alone.
+                    self.store['retry/' + instance] = '%d %f' % (
+                        attempts, now + _CLAIM_SECONDS)
+        if due:
+            try:
+                self.source.discard(due)
+            except Exception:
+                with write_locked(self.store):
+                    for instance in due:
+                        attempts = self._retry(instance)[0] + 1
+                        delay = min(_RETRY_SECONDS * 2 ** (attempts - 1),
+                            _RETRY_MAX_SECONDS)
+                        self.store['retry/' + instance] = '%d %f' % (
+                            attempts, now + delay)
+            else:
+                with write_locked(self.store):
+                    for instance in due:
+                        del self.store['resource/' + instance]
+                        del self.store['retry/' + instance]
+                        for key in ('checked/', 'usage/', 'affinity/'):
+                            try:
+                                del self.store[key + instance]
+                            except KeyError:
+                                pass
+                    self.store.srem('pool/' + self.name, due)
+                    self.store.srem('discarding/' + self.name, due)
+                    self.store.srem('quarantined/' + self.name, due)
+                self._notify()
+        with read_locked(self.store):
+            pending = [self._retry(instance)[1] for instance
+                in self.store.smembers('discarding/' + self.name)]
+        return min(pending) if pending else None
+
+    def quarantined(self):
+        """How many instances failed a health check and await tear down."""
+        with read_locked(self.store):
+            return self.store.scard('quarantined/' + self.name)
+
+    def discarding(self):
+        """How many discarded instances are waiting to be torn down."""
+        with read_locked(self.store):
+            return self.store.scard('discarding/' + self.name)
+
+    def waiter(self, name):
+        """Return a notify.Waiter woken when instances are discarded.
+
+        It is also woken whenever capacity is returned to the cache. The
+        caller must close it.
+
+        :param name: A name for the waiter's pipe, distinct from every other
+            waiter on this cache.
+        """
+        return notify.Waiter(os.path.join(self._waiter_dir(), name))
 
     def discard(self, instances, force=False):
         """Discard instances.
 
+        The instances are queued for collect() to tear down later, so this
+        never waits for the source.
+
         :param instances: A list of string ids previously returned from a
             provision() call.
         :param Force: When False (the default), as long as the cache is above
-            the reserved count, discards will be passed to the discard routine
-            immediately. Otherwise they will be held indefinitely. When True,
-            instances are never held in reserve.
+            the reserved count, discards will be queued immediately.
+            Otherwise they will be held indefinitely. When True, instances are
+            never held in reserve.
+        :raises UnknownInstance: If any of the instances are not in the
+            cache. Nothing is discarded.
         """
         instances = list(instances)
         prefix = self.name + '-'
@@ -97,133 +347,860 @@ class Cache(object):
             assert instance.startswith(prefix), \
                 "instance %r not owned by cache %r" % (instance, self.name)
         instances = [instance[len(prefix):] for instance in instances]
+        now = time.time()
         # Lock first, to avoid races.
-        to_discard = []
         with write_locked(self.store):
-            allocated = len(self._get_set('allocated/' + self.name))
-            keep_count = self.reserve - allocated + len(instances)
-            for pos, instance in enumerate(instances):
-                if force or pos >= keep_count:
-                    to_discard.append(instance)
-            self._set_remove('allocated/' + self.name, instances)
-        # XXX: Future - avoid long locks by having a gc queue and moving
-        # instances in there, and then doing the api call and finally cleanup.
-            for instance in to_discard:
-                del self.store['resource/' + instance]
-            self._set_remove('pool/' + self.name, to_discard)
-        if not to_discard:
-            return
-        self.source.discard(to_discard)
+            unknown = [instance for instance in instances
+                if not self.store.sismember('pool/' + self.name, instance)]
+            if unknown:
+                raise UnknownInstance(
+                    'No such resource %r.' % (prefix + unknown[0],))
+            # Instances already released, such as those reclaimed when their
+            # lease expired, are ignored.
+            instances = [instance for instance in instances
+                if self.store.sismember('allocated/' + self.name, instance)]
+            for instance in instances:
+                self._drop_lease(instance)
+                self._drop_owner(instance)
+            allocated = self.store.scard('allocated/' + self.name)
+            keep_count = self._reserve_level() - allocated + len(instances)
+            to_keep = []
+            if not force and keep_count > 0:
+                to_keep = self._by_eviction([instance for instance in instances
+                    if not self._worn_out(instance, now)])[-keep_count:]
+            to_discard = [instance for instance in instances
+                if instance not in to_keep]
+            for instance in to_keep:
+                created, _, uses = self._usage(instance)
+                self.store['usage/' + instance] = '%f %f %d' % (
+                    created, now, uses)
+            self.store.srem('allocated/' + self.name, instances)
+            self._cache(to_keep)
+            self.store.sadd('discarding/' + self.name, to_discard)
+            self._record_demand()
+        self._notify()
+
+    def snapshot(self):
+        """Report on the cache, consistently, from one read of the store.
+
+        :return: A Snapshot.
+        """
+        return snapshot_all([self])[0]
+
+    def evict(self, now=None):
+        """Discard cached instances past max_idle, max_age or max_uses.
+
+        :param now: The current time.time(), for testing.
+        :return: The number of instances discarded.
+        """
+        if not (self.max_idle or self.max_age or self.max_uses):
+            return 0
+        if now is None:
+            now = time.time()
+        with write_locked(self.store):
+            evicted = []
+            for instance in self.store.smembers('cached/' + self.name):
+                idle = now - self._usage(instance)[1]
+                if (self._worn_out(instance, now)
+                    or (self.max_idle and idle > self.max_idle)):
+                    evicted.append(instance)
+            self._uncache(evicted)
+            self.store.sadd('discarding/' + self.name, evicted)
+            return len(evicted)
 
     def fill_reserve(self):
-        """If the cache is below the low watermark, fill it up."""
+        """If the cache is below the low watermark, fill it up.
+
+        Concurrent calls do not over-provision: each only provisions what is
+        missing once the others' in-flight instances are counted.
+        """
+        with write_locked(self.store):
+            missing = self._shortfall()
+            if missing <= 0:
+                return
+            reservation = self._reserve(missing)
+        self._get_resources(reservation, 'cached/' + self.name)
+
+    def reclaim(self, now=None):
+        """Release instances whose lease has expired.
+
+        They are released as discard() would, so they may be kept in the
+        reserve, or queued for collect() to tear down.
+
+        :param now: The current time.time(), for testing.
+        :return: The number of instances reclaimed.
+        """
+        if now is None:
+            now = time.time()
         with write_locked(self.store):
-            existing = set(self._get_set('pool/' + self.name))
-            missing = self.reserve - len(existing)
-            if missing:
-                self._get_resources(missing)
+            return len(self._reclaim_expired(now))
+
+    def reap(self):
+        """Release the instances of owners that have died.
+
+        Only owners on this host can be checked.
+
+        :return: The number of instances released.
+        """
+        with write_locked(self.store):
+            return len(self._reap_dead())
+
+    def release_owner(self, owner):
+        """Release every instance held by owner, as discard() would.
+
+        :param owner: An owner passed to provision().
+        :return: The number of instances released.
+        """
+        with write_locked(self.store):
+            instances = self.store.smembers(
+                'owned/%s/%s' % (self.name, owner))
+            if instances:
+                self.discard(self._external_name(instances))
+            return len(instances)
+
+    def renew(self, instances, lease, now=None):
+        """Extend the lease on instances.
+
+        :param instances: A list of string ids previously returned from a
+            provision() call with a lease.
+        :param lease: The new lease, in seconds from now.
+        :param now: The current time.time(), for testing.
+        :raises ValueError: If an instance has no lease, or its lease has
+            expired and it has been reclaimed.
+        """
+        if now is None:
+            now = time.time()
+        prefix = self.name + '-'
+        with write_locked(self.store):
+            for instance in instances:
+                internal = instance[len(prefix):]
+                if not instance.startswith(prefix) or not (
+                    self.store.sismember('allocated/' + self.name, internal)
+                    and self._drop_lease(internal)):
+                    raise ValueError('No lease held on %s.' % instance)
+                self._add_lease(internal, now + lease)
+
+    def reserve_shortfall(self):
+        """How many instances short of the low watermark is the cache?
+
+        Instances being provisioned count towards the reserve, so this is 0
+        while a fill_reserve call is making up the difference.
+        """
+        if not self.reserve and not self.ceiling:
+            return 0
+        with read_locked(self.store):
+            return max(0, self._shortfall())
+
+    def warm(self, now=None):
+        """Size the reserve to the forecast demand, and fill it.
+
+        Does nothing for caches without a ceiling. The reserve becomes the
+        larger of the forecasts for this hour and the next (so instances are
+        ready before a daily spike), bounded by floor and ceiling. Idle
+        instances beyond it are discarded, for collect() to tear down.
+
+        :param now: The current time.time(), for testing.
+        :return: The new reserve.
+        """
+        if not self.ceiling:
+            return self.reserve
+        if now is None:
+            now = time.time()
+        with write_locked(self.store):
+            self._record_demand(now)
+            hour = int(now // 3600)
+            forecasts = [self._forecast(h) for h in (hour, hour + 1)]
+            forecasts = [f for f in forecasts if f is not None]
+            target = int(math.ceil(max(forecasts or [0])))
+            target = max(self.floor, min(self.ceiling, target))
+            if self.maximum:
+                target = min(self.maximum, target)
+            self.store['reserve-target/' + self.name] = str(target)
+            excess = min(-self._shortfall(),
+                self.store.scard('cached/' + self.name))
+            if excess > 0:
+                self.store.sadd(
+                    'discarding/' + self.name, self._take_cached(excess))
+        self.fill_reserve()
+        return target
 
     def in_use(self):
         """How many instances are checked out of this cache?"""
         with read_locked(self.store):
-            return len(set(self._get_set('allocated/' + self.name)))
+            return self.store.scard('allocated/' + self.name)
 
     def instances(self):
         """Enumerate the instances that have been checked out."""
         with read_locked(self.store):
             return self._external_name(
-                set(self._get_set('allocated/' + self.name)))
+                self.store.smembers('allocated/' + self.name))
 
-    def provision(self, count):
+    def provision(self, count, wait=False, timeout=None, priority=0,
+        lease=None, owner=None, affinity=None):
         """Request count instances from the cache.
 
         Instance ids that are returned are prefixed with the cache name, to
         ensure no collisions between layered sources.
 
+        :param wait: If True, wait for capacity when the request would exceed
+            the maximum, rather than failing. Waiters are served strictly in
+            the order they arrived.
+        :param timeout: How many seconds to wait for, or None to wait as long
+            as it takes.
+        :param priority: How important the request is; larger is more
+            important. The policy decides what difference it makes.
+        :param lease: If not None, the instances are reclaimed unless they are
+            released or renewed within this many seconds.
+        :param owner: If not None, a lockfile.process_record() for the
+            process the instances belong to. They are released when it dies.
+        :param affinity: If not None, prefer cached instances last handed out
+            with the same affinity, such as a project name, as they may hold
+            state (like caches) from that use.
+        :raises ValueError: If the request would exceed the maximum (and
+            either wait is False, the timeout expires, or the request is
+            larger than the policy lets its priority have).
         :return: A list of instance ids.
         """
-        with write_locked(self.store):
-            # XXX: Future, have a provisionally allocated set and move cached
-            # entries there, then do the blocking API calls, then return
-            # everything.
-            existing = set(self._get_set('pool/' + self.name))
-            if self.maximum and (len(existing) + count) > self.maximum:
+        self.check_cached(count, affinity)
+        # Hand out cached instances and reserve capacity for the rest, then
+        # let go of the store while the source provisions.
+        if not wait:
+            with write_locked(self.store):
+                claimed = self._claim(count, priority, affinity)
+            if claimed is None:
                 raise ValueError('Instance limit exceeded.')
-            allocated = set(self._get_set('allocated/' + self.name))
-            cached = list(existing - allocated)[:count]
-            count = count - len(cached)
-            new_instances = self._get_resources(count)
-            instances = new_instances + cached
-            self._update_set('allocated/' + self.name, instances)
-            return set([self.name + '-' + instance for instance in instances])
-
-    def provision_from_cache(self, count):
+        else:
+            claimed = self._wait_for(count, timeout, priority, affinity)
+        cached, reservation = claimed
+        try:
+            new_instances = self._get_resources(
+                reservation, 'allocated/' + self.name)
+        except:
+            # Return the cached instances for others to use.
+            with write_locked(self.store):
+                self.store.srem('allocated/' + self.name, cached)
+                self._cache(cached)
+            self._notify()
+            raise
+        # Cached instances may remember an affinity from an earlier handout,
+        # which this one replaces even when it has none.
+        if (lease is not None or owner is not None or affinity is not None
+            or cached):
+            with write_locked(self.store):
+                for instance in new_instances + cached:
+                    if affinity is not None:
+                        self.store['affinity/' + instance] = affinity
+                    else:
+                        try:
+                            del self.store['affinity/' + instance]
+                        except KeyError:
+                            pass
+                    if lease is not None:
+                        self._add_lease(instance, time.time() + lease)
+                    if owner is not None:
+                        self._add_owner(instance, owner)
+        return self._external_name(new_instances + cached)
+
+    def provision_from_cache(self, count, check=True):
         """Request up to count instances but only cached ones.
         
         This difference from provision() in that it will return up to the
         requested amount rather than all-or-nothing, and it never triggers
         a backend-provisioning call.
+
+        :param check: Health check the instances first (see check_cached).
+            Callers that already hold the store lock should call check_cached
+            before taking it and pass False, as health checks are slow.
         """
+        if check:
+            self.check_cached(count)
         with write_locked(self.store):
-            existing = set(self._get_set('pool/' + self.name))
-            allocated = set(self._get_set('allocated/' + self.name))
-            cached = list(existing - allocated)[:count]
-            self._update_set('allocated/' + self.name, cached)
+            cached = self._cached_candidates(count)
+            self._uncache(cached)
+            self.store.sadd('allocated/' + self.name, cached)
+            self._note_use(cached)
+            self._record_demand()
             return self._external_name(cached)
 
+    def _add_lease(self, instance, deadline):
+        """Lease instance until deadline.
+
+        Assumes the store is already write locked.
+        """
+        bucket = int(deadline // _LEASE_BUCKET_SECONDS)
+        self.store['lease/' + instance] = '%f' % deadline
+        self.store.sadd('leases/%s/%d' % (self.name, bucket), [instance])
+        self.store.sadd('lease-buckets/' + self.name, [str(bucket)])
+        try:
+            first = int(self.store['lease-next/' + self.name])
+        except KeyError:
+            first = bucket
+        self.store['lease-next/' + self.name] = str(min(first, bucket))
+
+    def _add_owner(self, instance, owner):
+        """Record that instance belongs to owner.
+
+        Assumes the store is already write locked.
+        """
+        self.store['owner/' + instance] = owner
+        self.store.sadd('owners/' + self.name, [owner])
+        self.store.sadd('owned/%s/%s' % (self.name, owner), [instance])
+
+    def _drop_owner(self, instance):
+        """Forget the owner of instance, if it has one.
+
+        Assumes the store is already write locked.
+        """
+        try:
+            owner = self.store['owner/' + instance]
+        except KeyError:
+            return
+        owned = 'owned/%s/%s' % (self.name, owner)
+        self.store.srem(owned, [instance])
+        if not self.store.scard(owned):
+            self.store.srem('owners/' + self.name, [owner])
+        del self.store['owner/' + instance]
+
+    def _reap_dead(self):
+        """Release the instances of owners that have died.
+
+        Assumes the store is already write locked.
+
+        :return: The released instances.
+        """
+        released = []
+        for owner in self.store.smembers('owners/' + self.name):
+            if lockfile.process_gone(owner):
+                released.extend(self.store.smembers(
+                    'owned/%s/%s' % (self.name, owner)))
+        if released:
+            self.discard(self._external_name(released))
+        return released
+
+    def _drop_lease(self, instance):
+        """Remove the lease on instance, if it has one.
+
+        Assumes the store is already write locked.
+
+        :return: True if there was a lease.
+        """
+        try:
+            deadline = float(self.store['lease/' + instance])
+        except KeyError:
+            return False
+        bucket = int(deadline // _LEASE_BUCKET_SECONDS)
+        setname = 'leases/%s/%d' % (self.name, bucket)
+        self.store.srem(setname, [instance])
+        if not self.store.scard(setname):
+            self.store.srem('lease-buckets/' + self.name, [str(bucket)])
+        del self.store['lease/' + instance]
+        return True
+
+    def _reclaim_expired(self, now):
+        """Release the instances whose lease has expired by now.
+
+        Assumes the store is already write locked.
+
+        :return: The reclaimed instances.
+        """
+        try:
+            first = int(self.store['lease-next/' + self.name])
+        except KeyError:
+            return []
+        current = int(now // _LEASE_BUCKET_SECONDS)
+        if first > current:
+            return []
+        buckets = sorted(int(bucket) for bucket
+            in self.store.smembers('lease-buckets/' + self.name))
+        expired = []
+        for bucket in buckets:
+            if bucket > current:
+                break
+            for instance in self.store.smembers(
+                'leases/%s/%d' % (self.name, bucket)):
+                if float(self.store['lease/' + instance]) <= now:
+                    expired.append(instance)
+        # The current bucket keeps any leases in it that are not yet due.
+        later = [bucket for bucket in buckets if bucket > current]
+        if later or current in buckets:
+            self.store['lease-next/' + self.name] = str(
+                current if current in buckets else later[0])
+        else:
+            del self.store['lease-next/' + self.name]
+        if expired:
+            self.discard(self._external_name(expired))
+        return expired
+
+    def _by_eviction(self, instances):
+        """Sort instances, those to discard first by the eviction policy first.
+
+        Assumes the store is already locked.
+        """
+        def key(instance):
+            created, released, uses = self._usage(instance)
+            if self.eviction == 'lfu':
+                return (uses, released, created)
+            return (released, created)
+        return sorted(instances, key=key)
+
+    def _note_use(self, instances):
+        """Count a use of each of instances.
+
+        Assumes the store is already write locked.
+        """
+        for instance in instances:
+            created, released, uses = self._usage(instance)
+            self.store['usage/' + instance] = '%f %f %d' % (
+                created, released, uses + 1)
+
+    def _usage(self, instance):
+        """Return when instance was created and last released, and its uses.
+
+        Instances with no record (from older versions of crcache) are treated
+        as new and unused.
+
+        Assumes the store is already locked.
+        """
+        try:
+            created, released, uses = self.store['usage/' + instance].split()
+        except KeyError:
+            now = time.time()
+            return now, now, 0
+        return float(created), float(released), int(uses)
+
+    def _worn_out(self, instance, now):
+        """Is instance past max_age or max_uses?
+
+        Assumes the store is already locked.
+        """
+        created, _, uses = self._usage(instance)
+        return bool((self.max_age and now - created > self.max_age)
+            or (self.max_uses and uses >= self.max_uses))
+
+    def _cache(self, instances):
+        """Add instances to the cached set, and the affinity index.
+
+        Assumes the store is already write locked.
+        """
+        self.store.sadd('cached/' + self.name, instances)
+        for instance in instances:
+            try:
+                affinity = self.store['affinity/' + instance]
+            except KeyError:
+                continue
+            self.store.sadd('idle/%s/%s' % (self.name, affinity), [instance])
+
+    def _uncache(self, instances):
+        """Remove instances from the cached set, and the affinity index.
+
+        Assumes the store is already write locked.
+        """
+        self.store.srem('cached/' + self.name, instances)
+        for instance in instances:
+            try:
+                affinity = self.store['affinity/' + instance]
+            except KeyError:
+                continue
+            self.store.srem('idle/%s/%s' % (self.name, affinity), [instance])
+
+    def _cached_candidates(self, count, affinity=None):
+        """Return up to count cached instances that may be handed out.
+
+        With a health check, those are the ones that passed it recently.
+
+        Assumes the store is already locked.
+        """
+        if self.health_check is None and affinity is None:
+            return list(self.store.smembers('cached/' + self.name, limit=count))
+        now = time.time()
+        candidates = []
+        for instance in self._handout_order(affinity, count):
+            if (self.health_check is None
+                or self._checked_since(instance, now - self.check_ttl)):
+                candidates.append(instance)
+                if len(candidates) == count:
+                    break
+        return candidates
+
+    def _handout_order(self, affinity, count):
+        """Return cached instances, those to hand out first first.
+
+        Those last used with affinity come first, found through the index.
+        Only if there are not count of them are others looked at, and then
+        only as many as could be needed, not every cached instance.
+
+        Assumes the store is already locked.
+        """
+        if affinity is None:
+            return sorted(self.store.smembers('cached/' + self.name))
+        preferred = sorted(self.store.smembers(
+            'idle/%s/%s' % (self.name, affinity)))
+        if len(preferred) >= count and self.health_check is None:
+            return preferred
+        # At most len(preferred) of any count cached instances are preferred
+        # ones, so this finds all the others that can be needed.
+        others = self.store.smembers(
+            'cached/' + self.name, limit=count) - set(preferred)
+        # Least recently used first, leaving recently used instances for the
+        # affinity they were used with.
+        return preferred + sorted(others,
+            key=lambda instance:self._usage(instance)[1::-1])
+
+    def check_cached(self, count, affinity=None):
+        """Health check cached instances so that count can be handed out.
+
+        Instances that fail are quarantined. The store must not be locked:
+        it is only locked to claim the instances and to record the results.
+        """
+        if self.health_check is None:
+            return
+        now = time.time()
+        with write_locked(self.store):
+            fresh = 0
+            stale = []
+            for instance in self._handout_order(affinity, count):
+                if self._checked_since(instance, now - self.check_ttl):
+                    fresh += 1
+                    continue
+                try:
+                    claimed = float(self.store['check-claim/' + instance])
+                except KeyError:
+                    claimed = 0
+                if claimed <= now:
+                    stale.append(instance)
+            stale = stale[:max(0, count - fresh)]
+            for instance in stale:
+                # Claim it, so other checkers leave it alone.
+                self.store['check-claim/' + instance] = '%f' % (
+                    now + _CLAIM_SECONDS)
+        if not stale:
+            return
+        results = parallel.run(self.health_check, stale, _CHECK_CONCURRENCY)
+        with write_locked(self.store):
+            failed = []
+            for instance, healthy, error in results:
+                del self.store['check-claim/' + instance]
+                if healthy and error is None:
+                    self.store['checked/' + instance] = '%f' % time.time()
+                elif self.store.sismember('cached/' + self.name, instance):
+                    failed.append(instance)
+            self._uncache(failed)
+            self.store.sadd('quarantined/' + self.name, failed)
+            self.store.sadd('discarding/' + self.name, failed)
+
+    def _checked_since(self, instance, when):
+        """Did instance pass a health check since when?
+
+        Assumes the store is already locked.
+        """
+        try:
+            return float(self.store['checked/' + instance]) >= when
+        except KeyError:
+            return False
+
+    def _claim(self, count, priority, affinity, ticket=None):
+        """Take cached instances and reserve capacity for count instances.
+
+        Assumes the store is already write locked.
+
+        :param ticket: The caller's place in the wait queue, or None if it is
+            not waiting.
+        :return: None if the maximum would be exceeded or other callers are
+            waiting ahead, otherwise the taken instances and the reservation
+            for the rest.
+        """
+        waiting = self._waiters()
+        if ticket is not None:
+            if waiting[:1] != [ticket]:
+                return None
+        elif waiting and (self._ticket_key(waiting[0])
+            <= self.policy.key(priority, float('inf'))):
+            return None
+        # Expired leases and dead owners give back capacity (and maybe
+        # cached instances).
+        self._reclaim_expired(time.time())
+        self._reap_dead()
+        cached = self._cached_candidates(count, affinity)
+        new_count = count - len(cached)
+        existing = (self.store.scard('pool/' + self.name)
+            + self.store.scard('provisioning/' + self.name))
+        if self.maximum:
+            if (existing + new_count) > self.maximum:
+                return None
+            in_use = (self.store.scard('allocated/' + self.name)
+                + self.store.scard('provisioning/' + self.name)
+                + self.store.scard('discarding/' + self.name))
+            if in_use + count > self.policy.limit(priority, self.maximum):
+                return None
+        self._uncache(cached)
+        self.store.sadd('allocated/' + self.name, cached)
+        self._note_use(cached)
+        reservation = self._reserve(new_count)
+        self._record_demand()
+        return cached, reservation
+
+    def _notify(self):
+        """Wake waiters, as capacity may have been returned."""
+        notify.notify(self._waiter_dir())
+
+    def _wait_for(self, count, timeout, priority, affinity):
+        """Queue until count instances can be claimed.
+
+        :return: The result of _claim.
+        """
+        if self.maximum and count > self.policy.limit(priority, self.maximum):
+            raise ValueError('Instance limit exceeded.')
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with write_locked(self.store):
+            try:
+                seq = int(self.store['waiter-seq/' + self.name]) + 1
+            except KeyError:
+                seq = 1
+            self.store['waiter-seq/' + self.name] = str(seq)
+        ticket = '%d %d %s' % (seq, priority, lockfile.process_record())
+        # The pipe exists before the ticket is queued, so no wakeup is missed.
+        waiter = notify.Waiter(os.path.join(self._waiter_dir(), '%d' % seq))
+        try:
+            with write_locked(self.store):
+                self.store.sadd('waiting/' + self.name, [ticket])
+            try:
+                while True:
+                    with write_locked(self.store):
+                        claimed = self._claim(
+                            count, priority, affinity, ticket)
+                    if claimed is not None:
+                        return claimed
+                    delay = _WAIT_POLL_SECONDS
+                    if timeout is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise ValueError(
+                                'Instance limit exceeded: timed out waiting.')
+                        delay = min(delay, remaining)
+                    waiter.wait(delay)
+            finally:
+                with write_locked(self.store):
+                    self.store.srem('waiting/' + self.name, [ticket])
+                # Let the next waiter have its turn.
+                self._notify()
+        finally:
+            waiter.close()
+
+    def _waiter_dir(self):
+        """Return the directory waiters' pipes are kept in."""
+        return os.path.join(state_dir(self.store.shard), 'waiting', self.name)
+
+    def _ticket_key(self, ticket):
+        """Return the policy's sort key for a waiter's ticket."""
+        seq, priority = ticket.split()[:2]
+        return self.policy.key(int(priority), int(seq))
+
+    def _waiters(self):
+        """Return the wait queue, in order, dropping waiters that died.
+
+        Assumes the store is already write locked.
+        """
+        waiting = sorted(self.store.smembers('waiting/' + self.name),
+            key=self._ticket_key)
+        dead = [ticket for ticket in waiting
+            if lockfile.process_gone(ticket.split(' ', 2)[2])]
+        if dead:
+            self.store.srem('waiting/' + self.name, dead)
+            for ticket in dead:
+                path = os.path.join(self._waiter_dir(), ticket.split()[0])
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            waiting = [ticket for ticket in waiting if ticket not in dead]
+        return waiting
+
     def _external_name(self, ids):
         """Map ids from internal ids to external names."""
         return set([self.name + '-' + instance for instance in ids])
 
-    def _get_resources(self, count):
-        """Get some resources.
+    def _take_cached(self, count):
+        """Remove up to count instances from the cached set.
 
-        Assumes the store is already locked.
+        Assumes the store is already write locked.
+
+        :return: A list of the instances removed.
         """
-        # note that this may leak (allocated in a child, not owned by this) if
-        # a source fails.
-        new_instances = self.source.provision(count)
-        for instance in new_instances:
-            self.store['resource/' + instance] = self.name
-        self._update_set('pool/' + self.name, new_instances)
-        return new_instances
+        cached = list(self.store.smembers('cached/' + self.name, limit=count))
+        self._uncache(cached)
+        return cached
+
+    def _forecast(self, hour):
+        """Return the forecast peak demand for hour, or None if unknown.
 
-    def _update_set(self, setname, items):
-        """Add items to the list stored in setname.
+        Assumes the store is already locked.
 
-        :param setname: A name like pool/foo.
-        :param items: A list of strings.
+        :param hour: Hours since the epoch.
         """
         try:
-            existing_instances = [self.store[setname]]
-            if existing_instances == ['']:
-                existing_instances = []
-            self.store[setname] = ','.join(
-                sorted(list(items) + existing_instances))
+            return float(self.store['forecast/%s/%d' % (
+                self.name, _hour_of_day(hour))])
         except KeyError:
-            self.store[setname] = ','.join(sorted(items))
+            return None
 
-    def _get_set(self, setname):
-        """Get a serialised set from the store.
+    def _record_demand(self, now=None):
+        """Record the number of instances in use now.
 
-        :param setname: A name like allocated/foo.
-        :return; A list of strings.
+        Assumes the store is already write locked.
         """
+        if not self.ceiling:
+            return
+        if now is None:
+            now = time.time()
+        level = (self.store.scard('allocated/' + self.name)
+            + self.store.scard('provisioning/' + self.name))
+        hour = int(now // 3600)
         try:
-            existing_instances = self.store[setname]
+            current, peak, last = map(
+                int, self.store['demand/' + self.name].split())
         except KeyError:
-            existing_instances = ''
-        if existing_instances:
-            return existing_instances.split(',')
+            current, peak, last = hour, level, level
+        if hour > current:
+            self._update_forecast(current, peak)
+            # Nothing was recorded in the hours between, so last held
+            # throughout them. A day of them updates every hour.
+            for skipped in range(current + 1, min(hour, current + 25)):
+                self._update_forecast(skipped, last)
+            peak = last
+        peak = max(peak, level)
+        self.store['demand/' + self.name] = '%d %d %d' % (
+            max(hour, current), peak, level)
+
+    def _update_forecast(self, hour, peak):
+        """Fold the peak demand seen in hour into its forecast.
+
+        Assumes the store is already write locked.
+        """
+        forecast = self._forecast(hour)
+        if forecast is None:
+            forecast = peak
         else:
-            return []
+            forecast += _FORECAST_ALPHA * (peak - forecast)
+        self.store['forecast/%s/%d' % (self.name, _hour_of_day(hour))] = (
+            '%f' % forecast)
+
+    def _reserve_level(self):
+        """Return the current reserve.
+
+        Assumes the store is already locked.
+        """
+        if not self.ceiling:
+            return self.reserve
+        try:
+            return int(self.store['reserve-target/' + self.name])
+        except KeyError:
+            return self.floor
+
+    def _shortfall(self):
+        """Assumes the store is already locked."""
+        return (self._reserve_level() - self.store.scard('pool/' + self.name)
+            - self.store.scard('provisioning/' + self.name)
+            + self.store.scard('discarding/' + self.name))
+
+    def _retry(self, instance):
+        """Return the attempts made to discard instance, and when it is due.
+
+        Assumes the store is already locked.
+        """
+        try:
+            attempts, next_time = self.store['retry/' + instance].split()
+        except KeyError:
+            return 0, 0.0
+        return int(attempts), float(next_time)
+
+    def _reserve(self, count):
+        """Reserve capacity for count new instances.
+
+        Assumes the store is already write locked.
+
+        :return: The reservation, for _get_resources.
+        """
+        # The pid lets abandoned reservations be traced to their process.
+        token = '%d.%s' % (os.getpid(), uuid.uuid4().hex)
+        reservation = ['%s.%d' % (token, pos) for pos in range(count)]
+        self.store.sadd('provisioning/' + self.name, reservation)
+        return reservation
+
+    def _get_resources(self, reservation, setname):
+        """Get resources for a reservation made by _reserve.
 
-    def _set_remove(self, setname, items):
-        """Remove items from a stored list.
+        The store should not be locked: it is only locked to record the
+        outcome. Either way, the reservation is released.
 
-        :param setname: A name like pool/foo.
-        :param items: An iterable of strings.
+        :param setname: The set to add the new instances to.
+        :return: A list of the new instances.
         """
-        existing_instances = set(self._get_set(setname))
-        existing_instances.difference_update(items)
-        self.store[setname] = ','.join(sorted(existing_instances))
+        if not reservation:
+            return []
+        try:
+            # note that this may leak (allocated in a child, not owned by
+            # this) if a source fails.
+            new_instances = self.source.provision(len(reservation))
+        except:
+            with write_locked(self.store):
+                self.store.srem('provisioning/' + self.name, reservation)
+            self._notify()
+            raise
+        with write_locked(self.store):
+            self.store.srem('provisioning/' + self.name, reservation)
+            now = time.time()
+            uses = 1 if setname.startswith('allocated/') else 0
+            for instance in new_instances:
+                self.store['resource/' + instance] = self.name
+                self.store['usage/' + instance] = '%f %f %d' % (now, now, uses)
+                if self.health_check is not None:
+                    self.store['checked/' + instance] = '%f' % time.time()
+            self.store.sadd('pool/' + self.name, new_instances)
+            self.store.sadd(setname, new_instances)
+        return new_instances
+
+
+def _hour_of_day(hour):
+    """Return the local hour of the day for hour, in hours since the epoch."""
+    return time.localtime(hour * 3600).tm_hour
+
+
+class Snapshot(object):
+    """The state of a cache at one moment.
+
+    :attr name: The name of the cache.
+    :attr cached: How many instances are sitting in the reserve.
+    :attr in_use: How many instances are checked out.
+    :attr maximum: The maximum of the cache, or 0 for unlimited.
+    :attr available: How many more instances could be checked out, or 0 for
+        unlimited.
+    :attr instances: The sorted names of the instances checked out.
+    """
+
+    def __init__(self, name, cached, in_use, maximum, available, instances):
+        self.name = name
+        self.cached = cached
+        self.in_use = in_use
+        self.maximum = maximum
+        self.available = available
+        self.instances = instances
+
+
+def snapshot_all(caches):
+    """Report on several caches, consistently, from one read of their stores.
+
+    Every store is read locked at once, so the snapshots are all of the same
+    moment, and each store is only locked once however many caches use it.
+
+    :param caches: An iterable of Cache objects.
+    :return: A list of Snapshots, in the order of caches.
+    """
+    caches = list(caches)
+    with read_locked_all(cache.store for cache in caches):
+        return [Snapshot(cache.name, cache.store.scard('cached/' + cache.name),
+            cache.store.scard('allocated/' + cache.name), cache.maximum,
+            cache._available(),
+            sorted(cache._external_name(
+                cache.store.smembers('allocated/' + cache.name))))
+            for cache in caches]
@@ -17,14 +17,16 @@
 Interesting things here:
 run_argv: the CLI entry point.
 Command: the Command base class.
+spawn: run a command in the background.
 """
 
 from inspect import getdoc
 from optparse import OptionParser
 import os
+import subprocess
 import sys
 
-from cr_cache.store import local
+from cr_cache.store import local, state_dir
 
 
 def _find_command(cmd_name):
@@ -178,6 +180,42 @@ def run_argv(argv, stdin, stdout, stderr):
     return result
 
 
+def spawn(*args):
+    """Run crcache with args in a detached background process.
+
+    The process gets its own session and no terminal, so it outlives the
+    command that spawned it and never writes to its terminal. It imports
+    cr_cache from wherever this process did, so it works from a source tree
+    too, and its errors are appended to worker.log in the unsharded state
+    directory.
+    """
+    worker = ('import sys; from cr_cache.commands import run_argv; '
+        'sys.exit(run_argv(%r, sys.stdin, sys.stdout, sys.stderr))'
+        % (['crcache'] + list(args),))
+    env = dict(os.environ)
+    path = [os.path.abspath(entry or os.curdir) for entry in sys.path]
+    if env.get('PYTHONPATH'):
+        path.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(path)
+    directory = state_dir()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    devnull = open(os.devnull, 'r+b')
+    try:
+        log = open(os.path.join(directory, 'worker.log'), 'ab')
+        try:
+            kwargs = {}
+            if hasattr(os, 'setsid'):
+                kwargs['preexec_fn'] = os.setsid
+            subprocess.Popen([sys.executable, '-c', worker], stdin=devnull,
+                stdout=devnull, stderr=log, close_fds=True, env=env,
+                **kwargs)
+        finally:
+            log.close()
+    finally:
+        devnull.close()
+
+
 def get_command_parser(cmd):
     """Return an OptionParser for cmd.
 
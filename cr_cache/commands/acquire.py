@@ -15,16 +15,51 @@
 """Grab instances from a source."""
 
 import optparse
+import os
 
 from cr_cache.arguments import number
+from cr_cache import commands
 from cr_cache.commands import Command
+from cr_cache.commands.fill import caches_below_reserve
 from cr_cache import config
+from cr_cache.store import lockfile
+
+def owner_record(options):
+    """Return the owner the --owner-pid and --session options pick, or None.
+    """
+    if options.session:
+        return lockfile.process_record(os.getsid(0))
+    if options.owner_pid is not None:
+        return lockfile.process_record(options.owner_pid)
+    return None
+
 
 class acquire(Command):
     """Obtain one or more resources from a source for use.
     
     Each resource will be reserved for exclusive use until
     released by crcache release.
+
+    If this leaves the source (or a source it draws from) below its reserve,
+    crcache fill is started in the background to top it up.
+
+    If the source is at its maximum, acquire fails unless --wait is given.
+    Waiting acquires queue for resources in the order they arrived, except
+    that (unless the source's policy is fifo) acquires with a higher
+    --priority go first, and may use capacity the source holds back for them.
+
+    With --lease, the resources are reclaimed as if released unless they are
+    released or renewed with crcache renew within that many seconds, so that
+    a crashed job cannot hold them forever.
+
+    With --owner-pid or --session, the resources belong to that process (or
+    the leader of this session, such as a login shell), and are released when
+    it exits. crcache reap, and any acquire that needs the capacity, checks
+    for owners that have exited.
+
+    With --affinity, resources last acquired with the same key (for instance a
+    project name) are preferred, so that state they hold from that use, such
+    as dependency caches, can be reused.
     """
 
     args = [number.IntegerArgument('resource_count', min=0)]
@@ -32,6 +67,28 @@ class acquire(Command):
         optparse.Option(
             "--source", "-s", help="What source to acquire from.",
             default="local"),
+        optparse.Option(
+            "--wait", default=False, action="store_true",
+            help="Wait for resources if the source is at its maximum."),
+        optparse.Option(
+            "--timeout", type="float", default=None,
+            help="With --wait, give up after this many seconds."),
+        optparse.Option(
+            "--priority", type="int", default=0,
+            help="How important the request is: larger goes first."),
+        optparse.Option(
+            "--lease", type="float", default=None,
+            help="Reclaim the resources unless renewed within this many "
+            "seconds."),
+        optparse.Option(
+            "--owner-pid", type="int", default=None,
+            help="Release the resources when this process exits."),
+        optparse.Option(
+            "--session", default=False, action="store_true",
+            help="Release the resources when this session's leader exits."),
+        optparse.Option(
+            "--affinity", default=None,
+            help="Prefer resources last acquired with this key."),
         ]
 
     def run(self):
@@ -40,6 +97,16 @@ class acquire(Command):
         resource_count = 1
         if len(self.ui.arguments['resource_count']):
             resource_count = self.ui.arguments['resource_count'][0]
-        resources = source.provision(resource_count)
+        owner = owner_record(self.ui.options)
+        resources = source.provision(resource_count,
+            wait=self.ui.options.wait, timeout=self.ui.options.timeout,
+            priority=self.ui.options.priority, lease=self.ui.options.lease,
+            owner=owner, affinity=self.ui.options.affinity)
         self.ui.output_rest(" ".join(sorted(resources)))
+        # Reclaiming expired leases may have queued discards.
+        if source.discarding():
+            commands.spawn('gc')
+        below = caches_below_reserve([source])
+        if below:
+            commands.spawn('fill', *below)
         return 0
@@ -0,0 +1,44 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Serve the crcache state from memory."""
+
+import signal
+
+from cr_cache.commands import Command
+from cr_cache.store import daemon as daemon_store
+
+class daemon(Command):
+    """Run the crcache state daemon.
+
+    The daemon holds the crcache state in memory and serves it to other
+    crcache processes over a Unix socket, writing changes back to the local
+    (dbm) store in the background. Use the ``daemon`` store type to talk to
+    it. The daemon runs until it is interrupted or sent SIGTERM.
+    """
+
+    def run(self):
+        self.server = daemon_store.Server()
+        def terminate(signum, frame):
+            self.server.stop()
+        try:
+            signal.signal(signal.SIGTERM, terminate)
+        except ValueError:
+            # Not the main thread: rely on stop() being called directly.
+            pass
+        try:
+            self.server.serve()
+        except KeyboardInterrupt:
+            pass
+        return 0
@@ -0,0 +1,65 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Top up source reserves."""
+
+from cr_cache.arguments import string
+from cr_cache.commands import Command
+from cr_cache import config
+
+
+def caches_below_reserve(caches):
+    """Return the names of caches below their reserve.
+
+    The sources that pools draw from are checked too, as pools provision
+    from their reserves.
+
+    :param caches: An iterable of cr_cache.cache.Cache objects.
+    """
+    result = set()
+    pending = list(caches)
+    seen = set()
+    while pending:
+        cache = pending.pop()
+        if cache.name in seen:
+            continue
+        seen.add(cache.name)
+        if cache.reserve_shortfall():
+            result.add(cache.name)
+        pending.extend(getattr(cache.source, 'children', ()))
+    return sorted(result)
+
+
+class fill(Command):
+    """Provision resources to bring sources up to their reserve.
+
+    acquire and release start this in the background when they leave a
+    source below its reserve, so that the next acquire finds resources
+    waiting. Concurrent fills of the same source never provision more than
+    the reserve between them.
+
+    With no arguments, every source is filled.
+    """
+
+    args = [string.StringArgument('sources', min=0, max=None)]
+
+    def run(self):
+        conf = config.Config()
+        names = self.ui.arguments['sources']
+        if not names:
+            names = config.sources(config.default_path())
+            names.add('local')
+        for name in sorted(names):
+            conf.get_source(name).fill_reserve()
+        return 0
@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tear down discarded resources."""
+
+from operator import methodcaller
+import optparse
+import os.path
+import time
+
+from cr_cache.commands import Command
+from cr_cache import config, parallel
+from cr_cache.store import LockTimeout, notify, state_dir
+from cr_cache.store.lockfile import LockFile
+
+# The most sources to tear down resources from at once.
+_CONCURRENCY = 8
+
+class gc(Command):
+    """Tear down discarded resources.
+
+    Released resources are queued for discarding, rather than being torn
+    down while the release waits. release starts this command in the
+    background to work through the queue, retrying failed discards with
+    increasing delays until the queue is empty. Each pass also reclaims
+    resources whose lease has expired (see acquire --lease), and releases
+    those whose owner has exited (see crcache reap).
+
+    Each pass tears down the resources of different sources concurrently, so
+    slow sources do not hold each other up. An error from one source does not
+    stop the others being torn down, and every error is reported.
+
+    Only one gc runs at a time: when one is already running, gc exits
+    straight away and leaves the queue to it. A running gc sleeps until a
+    retry is due or more resources are discarded, whichever comes first.
+    """
+
+    options = [
+        optparse.Option(
+            "--once", default=False, action="store_true",
+            help="Make one pass over the queue, without waiting for retries."),
+        ]
+
+    def run(self):
+        path = state_dir()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        lock = LockFile(os.path.join(path, 'gc.lck'),
+            os.path.join(path, 'gc.wlck'), timeout=0)
+        conf = config.Config()
+        names = config.sources(config.default_path())
+        names.add('local')
+        caches = [conf.get_source(name) for name in sorted(names)]
+        while True:
+            try:
+                lock.lock(True)
+            except LockTimeout:
+                # The running gc will see our discards.
+                return 0
+            try:
+                self._collect(caches)
+            finally:
+                lock.unlock()
+            # Discards queued while we were finishing may have had their gc
+            # turned away by our lock.
+            if self.ui.options.once or not any(
+                cache.discarding() for cache in caches):
+                return 0
+
+    def _collect(self, caches):
+        """Tear down discarded resources until none are left.
+
+        :param caches: The caches to collect.
+        """
+        # The pipes exist before the first pass, so no discard is missed.
+        name = 'gc-%d' % os.getpid()
+        waiters = []
+        try:
+            if not self.ui.options.once:
+                for cache in caches:
+                    waiters.append(cache.waiter(name))
+            while True:
+                for cache in caches:
+                    cache.reclaim()
+                    cache.reap()
+                # Collecting a pool only queues discards in its children,
+                # so pools go first, one at a time. The other caches then
+                # tear down concurrently, each in its own thread, so no
+                # store is used by two threads at once.
+                due = [cache.collect() for cache in caches
+                    if cache.source.children]
+                results = parallel.run(methodcaller('collect'),
+                    [cache for cache in caches if not cache.source.children],
+                    _CONCURRENCY)
+                parallel.raise_errors([(cache.name, result, exc_info)
+                    for cache, result, exc_info in results])
+                due.extend(when for _, when, _ in results)
+                due = [when for when in due if when is not None]
+                if self.ui.options.once:
+                    break
+                if not due:
+                    # Collecting a pool queues discards in its children,
+                    # which may already have been passed.
+                    if not any(cache.discarding() for cache in caches):
+                        break
+                    continue
+                notify.wait_any(waiters, max(0, min(due) - time.time()))
+        finally:
+            for waiter in waiters:
+                waiter.close()
@@ -0,0 +1,50 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Report how hard sources contend for their store locks."""
+
+from cr_cache.arguments import string
+from cr_cache.commands import Command
+from cr_cache import config
+from cr_cache.store import LockStats, stats_path
+
+
+class locks(Command):
+    """Show the lock statistics of each source's store.
+
+    Every process adds the time it spent waiting for and holding each
+    source's store lock to the totals kept with that store when it exits.
+    High waits or timeouts on a source mean too many processes are queueing
+    on it.
+
+    With no arguments, every source is shown.
+    """
+
+    args = [string.StringArgument('sources', min=0, max=None)]
+
+    def run(self):
+        names = self.ui.arguments['sources']
+        if not names:
+            names = config.sources(config.default_path())
+            names.add('local')
+        table = [('source', 'acquired', 'contended', 'timeouts', 'wait',
+            'max-wait', 'hold', 'max-hold')]
+        for name in sorted(names):
+            stats = LockStats.load(stats_path(name))
+            table.append((name, str(stats.acquired), str(stats.contended),
+                str(stats.timeouts), '%.3f' % stats.wait_time,
+                '%.3f' % stats.max_wait, '%.3f' % stats.hold_time,
+                '%.3f' % stats.max_hold))
+        self.ui.output_table(table)
+        return 0
@@ -0,0 +1,70 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Release resources whose owner has exited."""
+
+import optparse
+
+from cr_cache.arguments import string
+from cr_cache import commands
+from cr_cache.commands import Command
+from cr_cache.commands.acquire import owner_record
+from cr_cache.commands.fill import caches_below_reserve
+from cr_cache import config
+
+class reap(Command):
+    """Release resources whose owner has exited.
+
+    Resources acquired with --owner-pid or --session belong to that process.
+    This releases the resources of owners on this host that have exited, as
+    crcache release would. It also discards cached resources past the
+    source's max_idle, max_age or max_uses. Run it periodically, for instance
+    from cron.
+
+    With --owner-pid or --session, every resource belonging to that owner is
+    released straight away, whether or not it is still running.
+
+    With no arguments, every source is reaped.
+    """
+
+    args = [string.StringArgument('sources', min=0, max=None)]
+    options = [
+        optparse.Option(
+            "--owner-pid", type="int", default=None,
+            help="Release the resources belonging to this process."),
+        optparse.Option(
+            "--session", default=False, action="store_true",
+            help="Release the resources belonging to this session."),
+        ]
+
+    def run(self):
+        conf = config.Config()
+        names = self.ui.arguments['sources']
+        if not names:
+            names = config.sources(config.default_path())
+            names.add('local')
+        caches = [conf.get_source(name) for name in sorted(names)]
+        owner = owner_record(self.ui.options)
+        for cache in caches:
+            if owner is None:
+                cache.reap()
+                cache.evict()
+            else:
+                cache.release_owner(owner)
+        if any(cache.discarding() for cache in caches):
+            commands.spawn('gc')
+        below = caches_below_reserve(caches)
+        if below:
+            commands.spawn('fill', *below)
+        return 0
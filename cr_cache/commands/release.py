@@ -15,17 +15,30 @@
 """Return instances that are no longer needed."""
 
 from cr_cache.arguments import string
+from cr_cache import commands, parallel
 from cr_cache.commands import Command
+from cr_cache.commands.fill import caches_below_reserve
 from cr_cache import config
 
+# The most sources to discard from at once.
+_CONCURRENCY = 8
+
 class release(Command):
     """Release one or more resources.
     
     If the resource is from a caching source, it may get cached for later use,
     unless -f is supplied, which will force it to be discarded.
 
-    If any of the resources are unknown the command will fail without taking
-    any action.
+    Discarded resources are torn down in the background by crcache gc, so
+    release does not wait for them.
+
+    If any of the resources are from an unknown source the command will fail
+    without taking any action. If a source does not know one of its
+    resources, none of that source's resources are released.
+
+    Resources from different sources are discarded concurrently. If some
+    sources fail, the others still discard theirs, so the command can fail
+    having released some of the resources; every failure is reported.
     """
 
     args = [string.StringArgument('resources', max=None)]
@@ -36,6 +49,21 @@ class release(Command):
             name, _ = resource.split('-', 1)
             discard_map.setdefault(name, []).append(resource)
         conf = config.Config()
-        for source_name, resources in discard_map.items():
-            conf.get_source(source_name).discard(resources)
+        requests = [(conf.get_source(source_name), resources)
+            for source_name, resources in sorted(discard_map.items())]
+        results = parallel.run(_discard, requests, _CONCURRENCY)
+        sources = [source for source, _ in requests]
+        if any(source.discarding() for source in sources):
+            commands.spawn('gc')
+        # Forced discards can leave a source below its reserve.
+        below = caches_below_reserve(sources)
+        if below:
+            commands.spawn('fill', *below)
+        parallel.raise_errors([(source.name, result, exc_info)
+            for (source, _), result, exc_info in results])
         return 0
+
+
+def _discard(request):
+    source, resources = request
+    source.discard(resources)
@@ -0,0 +1,50 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Extend the lease on instances."""
+
+import optparse
+
+from cr_cache.arguments import string
+from cr_cache.commands import Command
+from cr_cache import config
+
+class renew(Command):
+    """Renew the lease on one or more resources.
+
+    Resources acquired with --lease are reclaimed when their lease expires.
+    Jobs holding them should run this periodically, as a heartbeat, to keep
+    them for as long as they are needed.
+
+    If any of the resources have no lease (including those already reclaimed)
+    the command fails.
+    """
+
+    args = [string.StringArgument('resources', max=None)]
+    options = [
+        optparse.Option(
+            "--lease", type="float", default=600.0,
+            help="How many seconds from now the lease should last."),
+        ]
+
+    def run(self):
+        renew_map = {}
+        for resource in self.ui.arguments['resources']:
+            name, _ = resource.split('-', 1)
+            renew_map.setdefault(name, []).append(resource)
+        conf = config.Config()
+        for source_name, resources in sorted(renew_map.items()):
+            conf.get_source(source_name).renew(resources,
+                self.ui.options.lease)
+        return 0
@@ -14,10 +14,11 @@
 
 """Report status about the system."""
 
-from operator import attrgetter, methodcaller
+from operator import attrgetter
 import optparse
 
 from cr_cache.arguments import string
+from cr_cache.cache import snapshot_all
 from cr_cache.commands import Command
 from cr_cache import config
 
@@ -50,28 +51,27 @@ class status(Command):
             check = lambda x:True
         sources = [conf.get_source(source_name) for source_name
             in sorted(sources) if check(source_name)]
-        def available(source):
-            return source.maximum - source.in_use()
+        # One locked pass, so the figures all agree with each other.
+        snapshots = snapshot_all(sources)
         if self.ui.options.query:
             source_map = {
-                'cached': methodcaller('cached'),
-                'in-ues': methodcaller('in_use'),
+                'cached': attrgetter('cached'),
+                'in-use': attrgetter('in_use'),
                 'max': attrgetter('maximum'),
-                'available': available
+                'available': attrgetter('available'),
                 }
             lookup = source_map[self.ui.options.query]
-            result = sum(map(lookup, sources))
+            result = sum(map(lookup, snapshots))
             self.ui.output_rest('%d' % result)
             return 0
-        for source in sources:
-            cached = str(source.cached())
-            in_use = str(source.in_use())
-            table.append((source.name, cached, in_use, str(source.maximum)))
+        for snapshot in snapshots:
+            table.append((snapshot.name, str(snapshot.cached),
+                str(snapshot.in_use), str(snapshot.maximum)))
             if self.ui.options.verbose:
-                instances = sorted(source.instances())
+                instances = snapshot.instances
                 if not instances:
                     continue
-                details_table.append((source.name, instances[0]))
+                details_table.append((snapshot.name, instances[0]))
                 for instance in instances[1:]:
                     details_table.append(('', instance))
         self.ui.output_table(table)
@@ -0,0 +1,49 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Size source reserves to forecast demand."""
+
+from cr_cache.arguments import string
+from cr_cache import commands
+from cr_cache.commands import Command
+from cr_cache import config
+
+
+class warm(Command):
+    """Size the reserve of sources to their forecast demand.
+
+    Sources with a ceiling in their source.conf learn how many resources are
+    in use at each hour of the day. warm sets their reserve to cover the
+    forecast for the current and the next hour, between the configured floor
+    and ceiling, provisions up to it, and discards idle resources beyond it.
+    Run it hourly (for instance from cron) so that resources are ready before
+    the daily peak and released afterwards.
+
+    With no arguments, every source is warmed.
+    """
+
+    args = [string.StringArgument('sources', min=0, max=None)]
+
+    def run(self):
+        conf = config.Config()
+        names = self.ui.arguments['sources']
+        if not names:
+            names = config.sources(config.default_path())
+            names.add('local')
+        caches = [conf.get_source(name) for name in sorted(names)]
+        for cache in caches:
+            cache.warm()
+        if any(cache.discarding() for cache in caches):
+            commands.spawn('gc')
+        return 0
@@ -16,11 +16,20 @@
 
 import os.path
 
+from extras import try_import
+import six
 import yaml
 
-from cr_cache import cache
+from cr_cache import cache, health
+from cr_cache.policy import find_policy_type
 from cr_cache.source import find_source_type
-from cr_cache.store import local as local_store
+from cr_cache.store import (
+    find_store_type,
+    local as local_store,
+    state_dir,
+    write_locked,
+    )
+sqlite_store = try_import('cr_cache.store.sqlite')
 
 
 def default_path():
@@ -53,6 +62,109 @@ def source_dirs(roots):
     return result
 
 
+def store_config(roots):
+    """Return the store configuration from the first store.conf in roots.
+
+    :return: A dict, empty if no store.conf was found.
+    """
+    for root in roots:
+        try:
+            f = open(os.path.join(root, 'store.conf'), 'rt')
+        except IOError:
+            continue
+        with f:
+            return yaml.safe_load(f) or {}
+    return {}
+
+
+def make_store(config, shard=None):
+    """Make the store described by config (see store_config).
+
+    :param shard: The shard for the store to hold - crcache uses the cache
+        name, so that caches never wait on each other's locks.
+    """
+    kwargs = {'shard': shard}
+    if 'lock_timeout' in config:
+        kwargs['lock_timeout'] = float(config['lock_timeout'])
+    if 'type' in config:
+        return find_store_type(config['type'])(**kwargs)
+    if sqlite_store is not None:
+        return sqlite_store.Store(**kwargs)
+    return local_store.Store(**kwargs)
+
+
+def _legacy_store(config):
+    """Return the store older crcache versions kept every cache in.
+
+    :param config: The store configuration (see store_config).
+    :return: A store for the unsharded local dbm, or None if there is none.
+    """
+    path = os.path.join(state_dir(), 'state')
+    # The suffixes the different dbm implementations use.
+    if not any(os.path.exists(path + suffix)
+        for suffix in ('', '.db', '.dir', '.dat')):
+        return None
+    if config.get('type') == 'daemon':
+        # A running daemon holds that dbm, and serves it as the None shard.
+        return make_store(config)
+    kwargs = {}
+    if 'lock_timeout' in config:
+        kwargs['lock_timeout'] = float(config['lock_timeout'])
+    return local_store.Store(**kwargs)
+
+
+def _legacy_set(store, setname):
+    """Read a set in the comma separated form older versions stored."""
+    try:
+        value = store[setname]
+    except KeyError:
+        return set()
+    return set(member for member in value.split(',') if member)
+
+
+def import_legacy(cache, config):
+    """Move cache's instances out of the state older versions kept.
+
+    Before stores were sharded, every cache was kept in one dbm in
+    ~/.cache/crcache/state, with sets as comma separated strings. Instances
+    recorded there are adopted by cache and then removed from it, so that
+    upgrading never loses track of them.
+
+    Each cache is only imported once: a legacy-imported file in its shard's
+    state directory records that it was, so later calls touch nothing else.
+
+    :param config: The store configuration (see store_config).
+    """
+    marker = os.path.join(state_dir(cache.name), 'legacy-imported')
+    if os.path.exists(marker):
+        return
+    legacy = _legacy_store(config)
+    if legacy is None:
+        return
+    pool_key = 'pool/' + cache.name
+    allocated_key = 'allocated/' + cache.name
+    with write_locked(legacy):
+        pool = _legacy_set(legacy, pool_key)
+        allocated = _legacy_set(legacy, allocated_key) & pool
+        if pool:
+            cache.adopt(sorted(pool), allocated)
+            for instance in pool:
+                try:
+                    owner = legacy['resource/' + instance]
+                except KeyError:
+                    continue
+                if owner == cache.name:
+                    del legacy['resource/' + instance]
+            del legacy[pool_key]
+            try:
+                del legacy[allocated_key]
+            except KeyError:
+                pass
+    if not os.path.exists(os.path.dirname(marker)):
+        os.makedirs(os.path.dirname(marker))
+    open(marker, 'w').close()
+
+
 class Config(object):
     """Represents a full configuration of crcache.
 
@@ -63,7 +175,7 @@ class Config(object):
     def __init__(self):
         self._source_dirs = source_dirs(default_path())
         self._sources = {}
-        self._store = local_store.Store()
+        self._store_config = store_config(default_path())
 
     def get_source(self, name):
         """Get a cr_cache.cache.Cache configured for the source called name.
@@ -83,9 +195,30 @@ class Config(object):
             source_type = find_source_type(config['type'])
         source = source_type(config, self.get_source)
         kwargs = {}
-        if 'reserve' in config:
-            reserve = int(config['reserve'])
-            kwargs['reserve'] = reserve
-        result = cache.Cache(name, self._store, source, **kwargs)
+        for key in ('reserve', 'floor', 'ceiling', 'max_uses'):
+            if key in config:
+                kwargs[key] = int(config[key])
+        for key in ('max_idle', 'max_age'):
+            if key in config:
+                kwargs[key] = float(config[key])
+        if 'eviction' in config:
+            kwargs['eviction'] = config['eviction']
+        policy_type = find_policy_type(config.get('policy', 'priority'))
+        kwargs['policy'] = policy_type(config)
+        command = config.get('check')
+        if isinstance(command, six.string_types):
+            command = ['/bin/sh', '-c', command]
+        scripts = []
+        if path is not None:
+            scripts = health.scripts_in(
+                os.path.join(os.path.dirname(path), 'check.d'))
+        if command or scripts:
+            kwargs['health_check'] = health.HealthCheck(
+                name, source, command, scripts)
+        if 'check_ttl' in config:
+            kwargs['check_ttl'] = float(config['check_ttl'])
+        store = make_store(self._store_config, name)
+        result = cache.Cache(name, store, source, **kwargs)
+        import_legacy(result, self._store_config)
         self._sources[name] = result
         return result
@@ -0,0 +1,71 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Checking instances still work before they are handed out."""
+
+import os
+import subprocess
+
+
+class HealthCheck(object):
+    """Probe the instances of a source.
+
+    An instance is healthy when the command, run on it through the source,
+    and each of the scripts, run locally with the instance's name as their
+    argument, succeed.
+
+    :attr name: The name of the cache the instances are in.
+    :attr source: The cr_cache.source.AbstractSource of the instances.
+    :attr command: A command list, or None.
+    :attr scripts: A list of script paths.
+    """
+
+    def __init__(self, name, source, command=None, scripts=()):
+        self.name = name
+        self.source = source
+        self.command = command
+        self.scripts = list(scripts)
+
+    def __call__(self, instance):
+        """Is instance healthy?
+
+        :param instance: The source's id for the instance.
+        """
+        with open(os.devnull, 'wb') as devnull:
+            if self.command:
+                proc = self.source.subprocess_Popen(instance, self.command,
+                    stdin=devnull, stdout=devnull, stderr=devnull)
+                proc.communicate()
+                if proc.returncode:
+                    return False
+            for script in self.scripts:
+                if subprocess.call([script, self.name + '-' + instance],
+                    stdin=devnull, stdout=devnull, stderr=devnull):
+                    return False
+        return True
+
+
+def scripts_in(path):
+    """Return the scripts in the directory path, as run-parts would run them.
+
+    That is the executable files, in name order. A missing directory has none.
+    """
+    if not os.path.isdir(path):
+        return []
+    scripts = []
+    for name in sorted(os.listdir(path)):
+        script = os.path.join(path, name)
+        if os.path.isfile(script) and os.access(script, os.X_OK):
+            scripts.append(script)
+    return scripts
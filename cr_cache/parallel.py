@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Running work concurrently in threads."""
+
+import sys
+import threading
+
+import six
+
+
+def run(function, items, limit):
+    """Call function on each of items, at most limit at a time.
+
+    Errors do not stop the other calls: every call is made, and its error
+    collected.
+
+    :param function: A callable taking one item.
+    :param items: An iterable of items.
+    :param limit: The most calls to run at once.
+    :return: A list of (item, result, exc_info) tuples, in the order of items.
+        exc_info is None if the call returned, and result is None if it
+        raised.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if len(items) <= 1 or limit <= 1:
+        for pos, item in enumerate(items):
+            results[pos] = _call(function, item)
+        return results
+    pending = list(enumerate(items))
+    mutex = threading.Lock()
+    def worker():
+        while True:
+            with mutex:
+                if not pending:
+                    return
+                pos, item = pending.pop(0)
+            results[pos] = _call(function, item)
+    threads = [threading.Thread(target=worker)
+        for _ in range(min(limit, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def raise_errors(results):
+    """Raise the errors collected by run, if there are any.
+
+    A single error is raised as it was; several are raised together as an
+    Errors, so that none of them is hidden.
+
+    :param results: A list of (item, result, exc_info) tuples from run.
+    """
+    errors = [(item, exc_info) for item, _, exc_info in results
+        if exc_info is not None]
+    if len(errors) == 1:
+        six.reraise(*errors[0][1])
+    if errors:
+        raise Errors(errors)
+
+
+class Errors(Exception):
+    """Several concurrent calls failed.
+
+    :attr errors: A list of (item, exc_info) tuples, one per failed call.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(Errors, self).__init__('; '.join(
+            '%s: %s' % (item, exc_info[1]) for item, exc_info in errors))
+
+
+def _call(function, item):
+    try:
+        return item, function(item), None
+    except Exception:
+        return item, None, sys.exc_info()
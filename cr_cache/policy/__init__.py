@@ -0,0 +1,63 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Policies deciding which requests for instances a cache serves first.
+
+When a cache is at its maximum, requests queue. A policy orders the queue,
+and can hold capacity back from less important requests.
+
+Interesting modules:
+fifo: serves requests strictly in arrival order.
+priority: serves more important requests first (the default).
+"""
+
+
+class AbstractPolicy(object):
+    """Defines the contract for an allocation policy.
+
+    Requests have a priority: an int, where larger is more important. The
+    default priority is 0.
+
+    :attr config: A dict containing the configuration of the source.
+    """
+
+    def __init__(self, config):
+        """Create an AbstractPolicy.
+
+        :param config: A dict containing the configuration of the source.
+        """
+        self.config = config
+
+    def key(self, priority, seq):
+        """Return the sort key for a request.
+
+        Requests with lower keys are served first.
+
+        :param priority: The priority of the request.
+        :param seq: The arrival order of the request.
+        """
+        raise NotImplementedError(self.key)
+
+    def limit(self, priority, maximum):
+        """Return how many instances may be in use after serving a request.
+
+        :param priority: The priority of the request.
+        :param maximum: The maximum of the cache, which is not 0.
+        """
+        raise NotImplementedError(self.limit)
+
+
+def find_policy_type(name):
+    modname = "cr_cache.policy.%s" % name
+    return __import__(modname, globals(), locals(), ['Policy']).Policy
@@ -0,0 +1,27 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Serve requests strictly in arrival order."""
+
+from cr_cache import policy
+
+
+class Policy(policy.AbstractPolicy):
+    """Serve requests strictly in arrival order, ignoring their priority."""
+
+    def key(self, priority, seq):
+        return seq
+
+    def limit(self, priority, maximum):
+        return maximum
@@ -0,0 +1,35 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Serve more important requests first."""
+
+from cr_cache import policy
+
+
+class Policy(policy.AbstractPolicy):
+    """Serve requests in priority order, and then arrival order.
+
+    Capacity can be held back for important requests with the reserved key
+    in source.conf: a mapping from priority to the number of instances that
+    only requests of at least that priority may use.
+    """
+
+    def key(self, priority, seq):
+        return (-priority, seq)
+
+    def limit(self, priority, maximum):
+        reserved = self.config.get('reserved') or {}
+        held = sum(int(count) for level, count in reserved.items()
+            if priority < int(level))
+        return max(0, maximum - held)
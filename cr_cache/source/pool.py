@@ -14,18 +14,55 @@
 
 """Pool multiple other sources into one source."""
 
-from cr_cache import source
+import time
+
+import six
+
+from cr_cache import parallel, source
+from cr_cache.breaker import Breaker
+from cr_cache.store import write_locked_all
+from cr_cache.strategy import find_strategy_type
+
+# The most children to provision from at once, unless configured.
+_PARALLEL = 8
 
 class Source(source.AbstractSource):
     """A pool of other sources.
     
     Configured via
     sources: [name,name,..]
-    in the config.
+    in the config, and optionally
+    strategy: in-order|round-robin|least-loaded|weighted|latency - how to
+      split new instances between the children (see cr_cache.strategy).
+      Defaults to in-order.
+    parallel: int - the most children to provision from at once (default 8).
+    partial: rollback|keep - what to do with the instances that were
+      provisioned when another child fails: discard them and fail the request
+      (rollback, the default), or return them (keep), which meets the
+      request short.
+    breaker_failures: int - how many failures in a row open a child's
+      circuit breaker (default 3, 0 for no breakers).
+    breaker_cooldown: float - how many seconds a child's breaker stays open
+      before a request is let through to probe it (default 300).
+
+    When a child fails to provision, what it was asked for is retried on the
+    other children, and the failure counts towards the child's breaker (see
+    cr_cache.breaker). Children whose breaker is open are skipped; if the
+    rest cannot meet the request, it is handled as partial says.
 
     Each source will be obtained from the get_source callback (which should
     return a Cache object, not a raw source), as cached resourcs are preferred
     when provisioning.
+
+    Each child keeps its state in its own store shard. The pool only holds
+    more than one child shard at once while gathering cached resources, and
+    then takes them with write_locked_all, so pools sharing children cannot
+    deadlock.
+
+    Children are provisioned from and discarded to in threads. Store locks
+    are reentrant per store object, not per thread, so children that share a
+    store - directly, or through a descendant such as a source under two
+    child pools - are always handled one after another in the same thread.
     """
 
     def _init(self):
@@ -34,37 +71,100 @@ class Source(source.AbstractSource):
         child_maximums = list(map(lambda x:x.maximum, self.children))
         if 0 not in child_maximums:
             self.maximum = sum(child_maximums)
+        self.strategy = find_strategy_type(
+            self.config.get('strategy', 'in-order'))(self.config)
+        failures = int(self.config.get('breaker_failures', 3))
+        cooldown = float(self.config.get('breaker_cooldown', 300))
+        self.breakers = dict((child.name, Breaker(child, failures, cooldown))
+            for child in self.children)
+        self.parallel = int(self.config.get('parallel', _PARALLEL))
+        self.partial = self.config.get('partial', 'rollback')
+        if self.partial not in ('rollback', 'keep'):
+            raise ValueError(
+                'Unknown partial failure policy %r.' % self.partial)
 
     def provision(self, count):
         cached_instances = []
-        # Gather cached resources first.
+        # Health check cached resources before locking, so a slow check only
+        # holds its own child's store.
+        wanted = count
         for child in self.children:
-            cached_instances.extend(
-                child.provision_from_cache(count-len(cached_instances)))
+            if wanted <= 0:
+                break
+            child.check_cached(wanted)
+            wanted -= child.cached()
+        # Gather cached resources first, as one step across all the children.
+        with write_locked_all(child.store for child in self.children):
+            for child in self.children:
+                cached_instances.extend(child.provision_from_cache(
+                    count-len(cached_instances), check=False))
         count -= len(cached_instances)
         new_instances = []
-        for child in self.children:
-            if not count:
+        error = None
+        # Children that failed this request, or lost a race to probe.
+        skipped = set()
+        while count:
+            candidates = [child for child in self.children
+                if child.name not in skipped
+                and self.breakers[child.name].ready()]
+            split = self.strategy.split(candidates, count)
+            if not split:
                 break
-            if child.maximum:
-                request_count = min(child.available(), count)
-            else:
-                request_count = count
-            child_instances = child.provision(request_count)
-            new_instances.extend(child_instances)
-            count -= len(child_instances)
-        return cached_instances + new_instances
+            requests = []
+            retry = False
+            for child, child_count in split:
+                if self.breakers[child.name].allow():
+                    requests.append((child, child_count))
+                else:
+                    skipped.add(child.name)
+                    retry = True
+            # Provision from the children at once, so a slow child only
+            # delays the request by its own latency.
+            results = _run_by_store(
+                self._provision_child, requests, self.parallel)
+            for (child, _), child_instances, exc_info in results:
+                if exc_info is None:
+                    self.breakers[child.name].succeeded()
+                    new_instances.extend(child_instances)
+                    count -= len(child_instances)
+                else:
+                    self.breakers[child.name].failed()
+                    skipped.add(child.name)
+                    retry = True
+                    if error is None:
+                        error = exc_info
+            if not retry:
+                break
+        instances = cached_instances + new_instances
+        if count and (self.partial == 'rollback' or not instances):
+            self.discard(instances)
+            if error is not None:
+                six.reraise(*error)
+            if not all(breaker.ready() for breaker in self.breakers.values()):
+                raise ValueError('All children unavailable (circuit open).')
+            raise ValueError('Instance limit exceeded.')
+        return instances
+
+    def _provision_child(self, request):
+        child, count = request
+        start = time.time()
+        instances = child.provision(count)
+        self.strategy.observe(child, count, time.time() - start)
+        return instances
 
     def discard(self, instances):
         discard_map = {}
         for instance in instances:
             name, _ = instance.split('-', 1)
             discard_map.setdefault(name, []).append(instance)
-        for child in self.children:
-            if child.name in discard_map:
-                child.discard(discard_map[child.name])
+        requests = [(child, discard_map[child.name])
+            for child in self.children if child.name in discard_map]
         # Note that discards for no longer configured children are
         # currently silently discarded.
+        results = _run_by_store(_discard_child, requests, self.parallel)
+        # Every child has been asked, whichever failed.
+        parallel.raise_errors([(child.name, result, exc_info)
+            for (child, _), result, exc_info in results])
 
     def subprocess_Popen(self, resource, *args, **kwargs):
         try:
@@ -76,3 +176,45 @@ class Source(source.AbstractSource):
                 return child.source.subprocess_Popen(
                     child_resource, *args, **kwargs)
         raise source.UnknownInstance("No such resource %r." % resource)
+
+
+def _discard_child(request):
+    child, instances = request
+    child.discard(instances)
+
+
+def _stores(cache):
+    """Return the stores cache and its descendants use."""
+    stores = [cache.store]
+    for child in cache.source.children:
+        stores.extend(_stores(child))
+    return stores
+
+
+def _run_by_store(function, requests, limit):
+    """parallel.run function on (child, ...) requests, keeping stores apart.
+
+    Requests whose children share a store run one after another in the same
+    thread, in their original order, so no store is used by two threads at
+    once.
+
+    :return: As parallel.run, in the order of requests.
+    """
+    # Each group is the ids of the stores it uses, and the positions of its
+    # requests.
+    groups = []
+    for pos, request in enumerate(requests):
+        ids = set(id(store) for store in _stores(request[0]))
+        positions = [pos]
+        for group in list(groups):
+            if group[0] & ids:
+                groups.remove(group)
+                ids |= group[0]
+                positions.extend(group[1])
+        groups.append((ids, sorted(positions)))
+    results = [None] * len(requests)
+    def run_group(positions):
+        for pos in positions:
+            results[pos] = parallel.run(function, [requests[pos]], 1)[0]
+    parallel.run(run_group, [positions for _, positions in groups], limit)
+    return results
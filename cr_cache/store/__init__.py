@@ -15,11 +15,23 @@
 """The crcache data store abstraction.
 
 Interesting things here:
-local: The default local persistent DB.
+daemon: A client for the crcache daemon, which serves the state from memory.
+journal: An append-only local persistent DB, for heavy write loads.
+local: The dbm based local persistent DB.
+lockfile: Reader/writer locking for file based stores.
 memory: An in-memory store for testing.
+notify: Waking processes that are waiting for a change.
+sqlite: The default local persistent DB, when sqlite3 is available.
 """
 
+import atexit
 from contextlib import contextmanager
+import json
+import os.path
+import threading
+
+from extras import try_import
+fcntl = try_import('fcntl')
 
 
 class AbstractStore(object):
@@ -29,8 +41,27 @@ class AbstractStore(object):
     in other processes.
 
     No operations can be done outside of a lock context.
+
+    As well as string keys, stores hold sets of strings, addressed by set name.
+    The default set implementation is built on keys: a count, one key per
+    member recording its slot, and one key per slot recording its member. This
+    makes every set operation proportional to the members it touches, not the
+    size of the set. Stores with native set support can override the set
+    methods.
+
+    Persistent stores are sharded: each shard has its own files and its own
+    lock, so work on one shard never waits for another. crcache uses one
+    shard per cache.
+
+    :attr shard: The name of the shard the store holds, or None for the
+        unsharded state.
+    :attr lock_stats: A LockStats recording how long this store waits for
+        and holds its lock, or None if the store does not keep them.
     """
 
+    shard = None
+    lock_stats = None
+
     def __getitem__(self, item):
         """Return item from the store.
 
@@ -56,12 +87,114 @@ class AbstractStore(object):
         """
         raise NotImplementedError(self.__getitem__)
 
+    def sadd(self, setname, members):
+        """Add members to a set.
+
+        :param setname: A name like pool/foo.
+        :param members: An iterable of strings. Members already in the set
+            are ignored.
+        """
+        count = self.scard(setname)
+        for member in members:
+            if self.sismember(setname, member):
+                continue
+            self[_slot_key(setname, count)] = member
+            self[_member_key(setname, member)] = str(count)
+            count += 1
+        self[_count_key(setname)] = str(count)
+
+    def srem(self, setname, members):
+        """Remove members from a set.
+
+        :param setname: A name like pool/foo.
+        :param members: An iterable of strings. Members not in the set are
+            ignored.
+        """
+        count = self.scard(setname)
+        for member in members:
+            try:
+                slot = int(self[_member_key(setname, member)])
+            except KeyError:
+                continue
+            count -= 1
+            # Move the last member into the vacated slot to keep slots dense.
+            if slot != count:
+                last = self[_slot_key(setname, count)]
+                self[_slot_key(setname, slot)] = last
+                self[_member_key(setname, last)] = str(slot)
+            del self[_slot_key(setname, count)]
+            del self[_member_key(setname, member)]
+        self[_count_key(setname)] = str(count)
+
+    def scard(self, setname):
+        """Return the number of members in a set.
+
+        :param setname: A name like pool/foo.
+        """
+        try:
+            return int(self[_count_key(setname)])
+        except KeyError:
+            return 0
+
+    def sismember(self, setname, member):
+        """Is member in the set setname?
+
+        :param setname: A name like pool/foo.
+        :param member: A string.
+        """
+        try:
+            self[_member_key(setname, member)]
+        except KeyError:
+            return False
+        return True
+
+    def smembers(self, setname, limit=None):
+        """Return the members of a set.
+
+        Missing sets are empty.
+
+        :param setname: A name like pool/foo.
+        :param limit: If not None, return at most this many (arbitrary)
+            members.
+        :return: A set of strings.
+        """
+        count = self.scard(setname)
+        if limit is not None:
+            count = min(count, limit)
+        return set(self[_slot_key(setname, slot)] for slot in range(count))
+
+    def sdiff_count(self, setname, other):
+        """Return the number of members of setname that are not in other.
+
+        :param setname: A name like pool/foo.
+        :param other: A name like allocated/foo.
+        """
+        # Walk whichever set is smaller.
+        count = self.scard(setname)
+        if self.scard(other) < count:
+            return count - sum(1 for member in self.smembers(other)
+                if self.sismember(setname, member))
+        return sum(1 for member in self.smembers(setname)
+            if not self.sismember(other, member))
+
     def lock_read(self):
-        """Lock the store, making it possible to read from it."""
+        """Lock the store, making it possible to read from it.
+
+        Many readers may hold the lock at once.
+
+        :raises LockTimeout: If the lock could not be obtained in time.
+        """
         raise NotImplementedError(self.lock_read)
 
     def lock_write(self):
-        """Lock the store, making it possible to read or write to it."""
+        """Lock the store, making it possible to read or write to it.
+
+        Write locks are exclusive: they wait for existing readers to finish
+        and hold back new ones. A store that is read locked cannot take a
+        write lock until it is fully unlocked.
+
+        :raises LockTimeout: If the lock could not be obtained in time.
+        """
         raise NotImplementedError(self.lock_write)
 
     def unlock(self):
@@ -71,6 +204,167 @@ class AbstractStore(object):
         """
         raise NotImplementedError(self.unlock)
 
+    def abort(self):
+        """Discard writes made since the innermost write lock was taken.
+
+        The lock is still held afterwards and must be released with unlock as
+        usual. Stores that apply writes immediately have nothing to discard,
+        and do nothing.
+        """
+
+
+def find_store_type(name):
+    modname = "cr_cache.store.%s" % name
+    return __import__(modname, globals(), locals(), ['Store']).Store
+
+
+def state_dir(shard=None):
+    """Return the directory persistent stores keep the state for shard in.
+
+    :param shard: A shard name, or None for the unsharded state.
+    """
+    if shard is None:
+        return os.path.expanduser('~/.cache/crcache')
+    return os.path.join(os.path.expanduser('~/.cache/crcache/shards'), shard)
+
+
+def _count_key(setname):
+    return 'scard\0' + setname
+
+
+def _member_key(setname, member):
+    return 'smember\0%s\0%s' % (setname, member)
+
+
+def _slot_key(setname, slot):
+    return 'sslot\0%s\0%d' % (setname, slot)
+
+
+class LockTimeout(Exception):
+    """The store could not be locked before the lock timeout expired."""
+
+
+class LockStats(object):
+    """Counters showing the pressure on a store lock.
+
+    Only outermost locks are counted: reentrant locking is free.
+
+    Stats with a path are added to the totals kept in that file when the
+    process exits (or save is called), so the pressure on a shard can be
+    seen across all the processes that used it. See load.
+
+    :attr acquired: How many times the lock was taken.
+    :attr contended: How many of those had to wait for another holder.
+    :attr timeouts: How many attempts gave up with LockTimeout.
+    :attr wait_time: Total seconds spent waiting for the lock, including
+        attempts that timed out.
+    :attr hold_time: Total seconds the lock was held.
+    :attr max_wait: The longest single wait, in seconds.
+    :attr max_hold: The longest single hold, in seconds.
+    :attr path: The file the totals are saved to, or None.
+    """
+
+    _TOTALS = ('acquired', 'contended', 'timeouts', 'wait_time', 'hold_time')
+    _MAXIMA = ('max_wait', 'max_hold')
+
+    def __init__(self, path=None):
+        """Create a LockStats.
+
+        :param path: The file to save the totals to, or None to keep them
+            in memory only. Use stats_path to find the file for a shard.
+        """
+        self._mutex = threading.Lock()
+        self.path = path
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.hold_time = 0.0
+        self.max_wait = 0.0
+        self.max_hold = 0.0
+        # The totals as of the last save, and whether save is registered to
+        # run at exit.
+        self._saved = dict.fromkeys(self._TOTALS, 0)
+        self._registered = False
+
+    @classmethod
+    def load(cls, path):
+        """Load the totals saved to path.
+
+        :return: A LockStats, all zero if nothing has been saved.
+        """
+        stats = cls()
+        try:
+            with open(path, 'rt') as f:
+                totals = json.load(f)
+        except (EnvironmentError, ValueError):
+            return stats
+        for key in cls._TOTALS + cls._MAXIMA:
+            setattr(stats, key, totals.get(key, 0))
+        return stats
+
+    def waited(self, seconds, contended, timed_out=False):
+        """Record an attempt to take the lock.
+
+        :param seconds: How long the attempt took.
+        :param contended: True if the lock was not free straight away.
+        :param timed_out: True if the attempt gave up.
+        """
+        with self._mutex:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.acquired += 1
+            if contended:
+                self.contended += 1
+            self.wait_time += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            if self.path is not None and not self._registered:
+                self._registered = True
+                atexit.register(self.save)
+
+    def held(self, seconds):
+        """Record the release of a lock held for seconds."""
+        with self._mutex:
+            self.hold_time += seconds
+            self.max_hold = max(self.max_hold, seconds)
+
+    def save(self):
+        """Add what has been recorded since the last save to self.path.
+
+        The stats are advisory: if the file cannot be written they are
+        dropped rather than failing the caller.
+        """
+        if self.path is None or fcntl is None:
+            return
+        with self._mutex:
+            current = dict((key, getattr(self, key)) for key in self._TOTALS)
+            if current == self._saved:
+                return
+            added = dict((key, current[key] - self._saved[key])
+                for key in self._TOTALS)
+            maxima = dict((key, getattr(self, key)) for key in self._MAXIMA)
+            self._saved = current
+        try:
+            with open(self.path + '.lck', 'ab') as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                totals = LockStats.load(self.path)
+                for key in self._TOTALS:
+                    added[key] += getattr(totals, key)
+                for key in self._MAXIMA:
+                    added[key] = max(maxima[key], getattr(totals, key))
+                temp = '%s.%d' % (self.path, os.getpid())
+                with open(temp, 'wt') as f:
+                    json.dump(added, f)
+                os.rename(temp, self.path)
+        except EnvironmentError:
+            pass
+
+
+def stats_path(shard=None):
+    """Return the file the LockStats for shard are saved to."""
+    return os.path.join(state_dir(shard), 'lock.stats')
+
 
 @contextmanager
 def read_locked(store):
@@ -83,8 +377,73 @@ def read_locked(store):
 
 @contextmanager
 def write_locked(store):
+    """Write lock store for the duration of the block.
+
+    If the block raises, the writes it made are aborted.
+    """
     store.lock_write()
     try:
         yield store
+    except:
+        store.abort()
+        raise
     finally:
         store.unlock()
+
+
+@contextmanager
+def read_locked_all(stores):
+    """Read lock several stores for the duration of the block.
+
+    Stores are locked in the same order as write_locked_all, so the two can
+    be mixed without deadlock. A store given more than once is locked once.
+    """
+    stores = _lock_order(stores)
+    locked = []
+    try:
+        for store in stores:
+            store.lock_read()
+            locked.append(store)
+        yield stores
+    finally:
+        for store in reversed(locked):
+            store.unlock()
+
+
+@contextmanager
+def write_locked_all(stores):
+    """Write lock several stores for the duration of the block.
+
+    Stores are locked in shard name order, which is what makes holding
+    several shards at once deadlock free: two processes can never each hold
+    a shard the other is waiting for. The unsharded store sorts first. If
+    the block raises, the writes it made are aborted in every store.
+
+    The other half of the protocol is that a cache's shard may be locked
+    while holding the shards of caches drawing from it (such as a pool), but
+    never the other way around.
+    """
+    stores = _lock_order(stores)
+    locked = []
+    try:
+        for store in stores:
+            store.lock_write()
+            locked.append(store)
+        yield stores
+    except:
+        for store in locked:
+            store.abort()
+        raise
+    finally:
+        for store in reversed(locked):
+            store.unlock()
+
+
+def _lock_order(stores):
+    """Return stores, without duplicates, in the order to lock them in."""
+    unique = []
+    for store in stores:
+        if not any(store is seen for seen in unique):
+            unique.append(store)
+    return sorted(unique, key=lambda store:(
+        store.shard is not None, store.shard or ''))
@@ -0,0 +1,640 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""The crcache daemon store.
+
+``crcache daemon`` runs a Server, which keeps the crcache state in memory and
+serves it to Client stores over a Unix socket in ~/.cache/crcache. Clients
+send one request per line as a JSON list of the method name and arguments,
+and get a JSON object back with either a result or an error.
+
+Each shard is served from its own local (dbm) store. The server takes a
+shard's write lock when it first serves it and holds it until it exits, so
+that nothing can change the state behind its back. It loads the whole shard
+at that point, in a thread of its own so that other clients are served while
+it waits for the lock, and writes committed changes back to the local store
+from a background thread, so clients never wait on the disk. When no daemon is
+running, Store falls back to the local store, which then sees exactly the
+state the daemon last wrote.
+
+Each shard has its own lock. Locks are granted to clients in the order they
+are requested, so a waiting writer holds back readers that arrive after it.
+"""
+
+import json
+import os
+import select
+import socket
+import threading
+import time
+
+from cr_cache.store import AbstractStore, LockStats, LockTimeout, stats_path
+from cr_cache.store import local
+
+
+def socket_path():
+    """Return the path of the daemon socket."""
+    return os.path.expanduser('~/.cache/crcache/daemon.sock')
+
+
+def Store(lock_timeout=60, shard=None):
+    """Connect to the crcache daemon, or use the local store if none runs.
+
+    :param lock_timeout: How many seconds to wait for a lock before giving up
+        with LockTimeout.
+    :param shard: The shard to use, or None for the unsharded state.
+    """
+    try:
+        return Client(lock_timeout=lock_timeout, shard=shard)
+    except (IOError, OSError):
+        return local.Store(lock_timeout=lock_timeout, shard=shard)
+
+
+_errors = {
+    'AssertionError': AssertionError,
+    'KeyError': KeyError,
+    'LockTimeout': LockTimeout,
+    }
+
+
+class Client(AbstractStore):
+    """A store that forwards every operation to the crcache daemon."""
+
+    def __init__(self, path=None, lock_timeout=60, shard=None):
+        """Create a Client.
+
+        :param path: The socket to connect to. Defaults to socket_path().
+        :param lock_timeout: How many seconds to wait for a lock before giving
+            up with LockTimeout. None waits forever.
+        :param shard: The shard to use, or None for the unsharded state.
+        :raises socket.error: If there is no daemon listening.
+        """
+        if path is None:
+            path = socket_path()
+        self.lock_timeout = lock_timeout
+        self.shard = shard
+        self.lock_stats = LockStats(stats_path(shard))
+        self._locked = 0
+        self._acquired_at = None
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+        except:
+            self._sock.close()
+            raise
+        self._file = self._sock.makefile('rwb')
+        if shard is not None:
+            self._call('shard', shard)
+
+    def _call(self, *request):
+        self._file.write(json.dumps(request).encode('utf8') + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise IOError('crcache daemon connection closed')
+        reply = json.loads(line.decode('utf8'))
+        if 'error' in reply:
+            error = _errors.get(reply['error'])
+            if error is None:
+                raise IOError('crcache daemon error: %s: %s' % (
+                    reply['error'], ' '.join(map(str, reply['args']))))
+            raise error(*reply['args'])
+        return reply.get('result')
+
+    def close(self):
+        """Disconnect from the daemon."""
+        self._file.close()
+        self._sock.close()
+
+    def __getitem__(self, item):
+        return self._call('get', item)
+
+    def __setitem__(self, item, value):
+        self._call('set', item, value)
+
+    def __delitem__(self, item):
+        self._call('del', item)
+
+    def sadd(self, setname, members):
+        self._call('sadd', setname, list(members))
+
+    def srem(self, setname, members):
+        self._call('srem', setname, list(members))
+
+    def scard(self, setname):
+        return self._call('scard', setname)
+
+    def sismember(self, setname, member):
+        return self._call('sismember', setname, member)
+
+    def smembers(self, setname, limit=None):
+        return set(self._call('smembers', setname, limit))
+
+    def sdiff_count(self, setname, other):
+        return self._call('sdiff_count', setname, other)
+
+    def lock_read(self):
+        self._lock('lock_read')
+
+    def lock_write(self):
+        self._lock('lock_write')
+
+    def _lock(self, method):
+        if self._locked:
+            self._call(method, self.lock_timeout)
+            self._locked += 1
+            return
+        start = time.time()
+        try:
+            # The daemon says whether the lock was contended.
+            contended = self._call(method, self.lock_timeout)
+        except LockTimeout:
+            self.lock_stats.waited(time.time() - start, True, timed_out=True)
+            raise
+        self._acquired_at = time.time()
+        self.lock_stats.waited(self._acquired_at - start, contended)
+        self._locked = 1
+
+    def unlock(self):
+        self._call('unlock')
+        self._locked -= 1
+        if not self._locked:
+            self.lock_stats.held(time.time() - self._acquired_at)
+
+    def abort(self):
+        self._call('abort')
+
+
+_MISSING = object()
+# Returned by lock requests that were queued: the queue sends the reply.
+_QUEUED = object()
+
+
+class _State(AbstractStore):
+    """The daemon's in-memory state.
+
+    Sets use the default AbstractStore implementation on top of plain keys,
+    the same representation the local store uses, so the state can be copied
+    to and from it key by key. Every change is logged to the current undo
+    list so that it can be aborted, and to the touched set so that it can be
+    persisted.
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.undo = None
+        self.touched = None
+
+    def __getitem__(self, item):
+        return self.values[item]
+
+    def __setitem__(self, item, value):
+        self._log(item)
+        self.values[item] = value
+
+    def __delitem__(self, item):
+        if item not in self.values:
+            raise KeyError(item)
+        self._log(item)
+        del self.values[item]
+
+    def _log(self, item):
+        self.undo.append((item, self.values.get(item, _MISSING)))
+        self.touched.add(item)
+
+    def rollback(self, undo):
+        """Reverse the changes recorded in undo."""
+        for item, value in reversed(undo):
+            if value is _MISSING:
+                self.values.pop(item, None)
+            else:
+                self.values[item] = value
+        del undo[:]
+
+
+class _Shard(object):
+    """Server side state for one shard.
+
+    Until the shard is loaded, backing and state are None, and loading lists
+    the connections waiting to use it. error is what loading raised, if it
+    failed.
+    """
+
+    def __init__(self):
+        self.backing = None
+        self.state = None
+        self.loading = []
+        self.error = None
+        # Keys changed by committed writes, not yet persisted.
+        self.committed = set()
+        self.readers = set()
+        self.writer = None
+        self.queue = []
+
+
+class _Connection(object):
+    """Server side state for a client connection."""
+
+    def __init__(self, sock, shard):
+        self.sock = sock
+        self.shard = shard
+        self.buffer = b''
+        # One entry per lock level held: an undo list for write levels, None
+        # for read levels.
+        self.levels = []
+        self.exclusive = False
+        # Keys written under the current write lock.
+        self.touched = set()
+        # A queued lock request: (exclusive, deadline), and whether it had to
+        # wait for other holders.
+        self.waiting = None
+        self.contended = False
+        # The _Shard the connection is waiting to switch to, while it loads.
+        self.loading = None
+
+    def undo(self):
+        """Return the undo list for the innermost write lock level."""
+        for level in reversed(self.levels):
+            if level is not None:
+                return level
+
+
+class Server(object):
+    """Serve the crcache state to Clients over a Unix socket."""
+
+    def __init__(self, path=None, backing=None, persist_interval=0.5):
+        """Create a Server.
+
+        :param path: The socket to listen on. Defaults to socket_path().
+        :param backing: A callable taking a shard name (None for the
+            unsharded state) and returning the local.Store to load that
+            shard from and persist it to. Defaults to local.Store.
+        :param persist_interval: How often, in seconds, to write committed
+            changes to the backing stores.
+        """
+        if path is None:
+            path = socket_path()
+        if backing is None:
+            backing = lambda shard:local.Store(shard=shard)
+        self.path = path
+        self.backing = backing
+        self.persist_interval = persist_interval
+        self.ready = threading.Event()
+        self._stopping = threading.Event()
+        # Guards the shards against the persister.
+        self._mutex = threading.Lock()
+        self._shards = {}
+        # Shards whose loader has finished, for the serving loop to announce.
+        self._loaded = []
+        self._loaders = []
+        # A pipe to wake the serving loop with.
+        self._wake_r = None
+        self._wake_w = None
+
+    def stop(self):
+        """Ask a running serve() to finish. Safe to call from any thread."""
+        self._stopping.set()
+        self._wake()
+
+    def _wake(self):
+        """Wake the serving loop."""
+        wake = self._wake_w
+        if wake is not None:
+            try:
+                os.write(wake, b'x')
+            except OSError:
+                pass
+
+    def serve(self):
+        """Serve clients until stop() is called."""
+        try:
+            shard = _Shard()
+            self._shards[None] = shard
+            self._load(None, shard)
+            if shard.error is not None:
+                raise shard.error
+            del self._loaded[:]
+            self._wake_r, self._wake_w = os.pipe()
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                # Holding the backing lock means any existing socket is stale.
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                listener.bind(self.path)
+                listener.listen(64)
+                persister = threading.Thread(target=self._persist_loop)
+                persister.start()
+                try:
+                    self.ready.set()
+                    self._loop(listener)
+                finally:
+                    self._stopping.set()
+                    persister.join()
+            finally:
+                listener.close()
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                wake_r, wake_w = self._wake_r, self._wake_w
+                self._wake_r = self._wake_w = None
+                os.close(wake_r)
+                os.close(wake_w)
+            for loader in self._loaders:
+                loader.join()
+            self._persist()
+        finally:
+            for shard in self._shards.values():
+                if shard.backing is not None:
+                    shard.backing.unlock()
+            self._shards = {}
+
+    def _shard(self, name):
+        """Return the _Shard for name, starting to load it if needed."""
+        shard = self._shards.get(name)
+        if shard is None:
+            shard = _Shard()
+            self._shards[name] = shard
+            loader = threading.Thread(target=self._load, args=(name, shard))
+            self._loaders.append(loader)
+            loader.start()
+        return shard
+
+    def _load(self, name, shard):
+        """Lock the backing store for shard and load its state.
+
+        Taking the lock can wait for another process, so this runs in a
+        thread of its own, and wakes the serving loop when it is done.
+        """
+        try:
+            backing = self.backing(name)
+            backing.lock_write()
+            try:
+                values = dict((key, backing[key]) for key in backing.keys())
+            except:
+                backing.unlock()
+                raise
+        except Exception as e:
+            with self._mutex:
+                shard.error = e
+                # Let a later request try again.
+                if self._shards.get(name) is shard:
+                    del self._shards[name]
+                self._loaded.append(shard)
+        else:
+            with self._mutex:
+                shard.backing = backing
+                shard.state = _State(values)
+                self._loaded.append(shard)
+        self._wake()
+
+    def _announce_loaded(self):
+        """Tell the connections waiting for shards that have loaded."""
+        loaded, self._loaded = self._loaded, []
+        for shard in loaded:
+            waiting, shard.loading = shard.loading, []
+            for conn in waiting:
+                conn.loading = None
+                if shard.error is not None:
+                    self._reply(conn, error=shard.error)
+                else:
+                    conn.shard = shard
+                    self._reply(conn)
+                self._process(conn)
+
+    def _loop(self, listener):
+        connections = {}
+        try:
+            while not self._stopping.is_set():
+                deadlines = [conn.waiting[1]
+                    for shard in self._shards.values()
+                    for conn in shard.queue if conn.waiting[1] is not None]
+                timeout = None
+                if deadlines:
+                    timeout = max(0, min(deadlines) - time.time())
+                readable, _, _ = select.select(
+                    [listener, self._wake_r] + list(connections), [], [],
+                    timeout)
+                for fileobj in readable:
+                    if fileobj is listener:
+                        sock, _ = listener.accept()
+                        connections[sock] = _Connection(
+                            sock, self._shards[None])
+                    elif fileobj == self._wake_r:
+                        os.read(self._wake_r, 1024)
+                    else:
+                        conn = connections[fileobj]
+                        try:
+                            data = conn.sock.recv(65536)
+                        except (IOError, OSError):
+                            data = b''
+                        with self._mutex:
+                            if data:
+                                conn.buffer += data
+                                self._process(conn)
+                            else:
+                                del connections[conn.sock]
+                                self._disconnect(conn)
+                with self._mutex:
+                    self._announce_loaded()
+                    self._expire()
+        finally:
+            with self._mutex:
+                for conn in connections.values():
+                    self._disconnect(conn)
+
+    def _process(self, conn):
+        """Handle the complete requests buffered for conn."""
+        while (conn.waiting is None and conn.loading is None
+            and b'\n' in conn.buffer):
+            line, conn.buffer = conn.buffer.split(b'\n', 1)
+            # A bad request only fails itself, never the daemon.
+            try:
+                request = json.loads(line.decode('utf8'))
+                result = self._dispatch(conn, request[0], *request[1:])
+            except Exception as e:
+                self._reply(conn, error=e)
+                continue
+            if result is not _QUEUED:
+                self._reply(conn, result)
+
+    def _reply(self, conn, result=None, error=None):
+        if error is not None:
+            reply = {'error': error.__class__.__name__,
+                'args': [str(arg) for arg in error.args]}
+        else:
+            reply = {'result': result}
+        try:
+            conn.sock.sendall(json.dumps(reply).encode('utf8') + b'\n')
+        except (IOError, OSError):
+            # The client has gone: the disconnect will be seen by the loop.
+            pass
+
+    def _dispatch(self, conn, method, *args):
+        if method == 'shard':
+            if conn.levels or conn.waiting is not None:
+                raise AssertionError('cannot change shard while locked')
+            shard = self._shard(args[0])
+            if shard.state is None:
+                conn.loading = shard
+                shard.loading.append(conn)
+                return _QUEUED
+            conn.shard = shard
+            return
+        if method in ('lock_read', 'lock_write'):
+            return self._lock(conn, method == 'lock_write', *args)
+        if method == 'unlock':
+            return self._unlock(conn)
+        if not conn.levels:
+            raise AssertionError('not locked')
+        state = conn.shard.state
+        if method == 'abort':
+            state.rollback(conn.undo())
+            return
+        if method in ('get', 'scard', 'sismember', 'smembers', 'sdiff_count'):
+            if method == 'get':
+                return state[args[0]]
+            result = getattr(state, method)(*args)
+            if method == 'smembers':
+                result = sorted(result)
+            return result
+        if method not in ('set', 'del', 'sadd', 'srem'):
+            raise AssertionError('unknown method %r' % method)
+        if not conn.exclusive:
+            raise AssertionError('not write locked')
+        state.undo = conn.undo()
+        state.touched = conn.touched
+        if method == 'set':
+            state[args[0]] = args[1]
+        elif method == 'del':
+            del state[args[0]]
+        else:
+            getattr(state, method)(*args)
+
+    def _lock(self, conn, exclusive, timeout=None):
+        if conn.levels:
+            if exclusive and not conn.exclusive:
+                raise AssertionError('cannot upgrade a read lock')
+            conn.levels.append([] if exclusive else None)
+            return
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        shard = conn.shard
+        conn.contended = bool(shard.queue or shard.writer is not None or
+            (exclusive and shard.readers))
+        conn.waiting = (exclusive, deadline)
+        shard.queue.append(conn)
+        self._grant(conn.shard)
+        return _QUEUED
+
+    def _grant(self, shard):
+        """Grant queued lock requests, in order, while they are compatible."""
+        while shard.queue and shard.writer is None:
+            conn = shard.queue[0]
+            exclusive = conn.waiting[0]
+            if exclusive and shard.readers:
+                break
+            shard.queue.pop(0)
+            conn.waiting = None
+            conn.exclusive = exclusive
+            if exclusive:
+                shard.writer = conn
+                conn.levels.append([])
+            else:
+                shard.readers.add(conn)
+                conn.levels.append(None)
+            self._reply(conn, conn.contended)
+            self._process(conn)
+
+    def _expire(self):
+        """Fail queued lock requests whose deadline has passed."""
+        now = time.time()
+        for shard in self._shards.values():
+            for conn in list(shard.queue):
+                deadline = conn.waiting[1]
+                if deadline is not None and deadline <= now:
+                    shard.queue.remove(conn)
+                    conn.waiting = None
+                    self._reply(conn, error=LockTimeout(self.path))
+                    self._process(conn)
+            self._grant(shard)
+
+    def _unlock(self, conn):
+        if not conn.levels:
+            raise AssertionError('not locked')
+        level = conn.levels.pop()
+        if level is not None and conn.undo() is not None:
+            # Keep inner changes abortable by the enclosing write level.
+            conn.undo().extend(level)
+        if not conn.levels:
+            self._release(conn)
+
+    def _release(self, conn):
+        """Release the lock conn holds, committing its changes."""
+        shard = conn.shard
+        if conn.exclusive:
+            shard.writer = None
+            shard.committed.update(conn.touched)
+            conn.touched = set()
+        else:
+            shard.readers.discard(conn)
+        conn.exclusive = False
+        self._grant(shard)
+
+    def _disconnect(self, conn):
+        conn.sock.close()
+        if conn.loading is not None:
+            conn.loading.loading.remove(conn)
+            conn.loading = None
+        shard = conn.shard
+        if conn in shard.queue:
+            shard.queue.remove(conn)
+        if conn.levels:
+            # Abort everything the client did not unlock.
+            for level in reversed(conn.levels):
+                if level is not None:
+                    shard.state.rollback(level)
+            conn.levels = []
+            conn.touched = set()
+            self._release(conn)
+        self._grant(shard)
+
+    def _persist_loop(self):
+        while not self._stopping.wait(self.persist_interval):
+            self._persist()
+
+    def _persist(self):
+        """Write committed changes to the backing stores."""
+        with self._mutex:
+            shards = list(self._shards.values())
+        for shard in shards:
+            self._persist_shard(shard)
+
+    def _persist_shard(self, shard):
+        with self._mutex:
+            # Values changed by a writer still in progress may yet be
+            # aborted: wait for a quiet moment.
+            if shard.writer is not None or not shard.committed:
+                return
+            changes = [(key, shard.state.values.get(key, _MISSING))
+                for key in shard.committed]
+            shard.committed = set()
+        for key, value in changes:
+            if value is _MISSING:
+                try:
+                    del shard.backing[key]
+                except KeyError:
+                    pass
+            else:
+                shard.backing[key] = value
+        shard.backing.flush()
@@ -0,0 +1,375 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""The crcache journal data store.
+
+This store never rewrites data in place. Each batch of writes is appended to
+a journal segment as JSON lines, and readers keep the replayed state in
+memory, applying only the records added since they last looked. Compaction
+folds the journal into a new snapshot: it rotates writers onto a fresh
+segment, builds the snapshot without holding the store lock, and then
+briefly retakes the lock to delete the files the snapshot replaces.
+
+Files live in ~/.cache/crcache/journal (or a journal directory under the
+shards directory, for a sharded store):
+snapshot.N: The whole state as of the start of segment N, as JSON.
+journal.N: Records appended after snapshot.N (or after journal.N-1).
+lock, wlock: The store lock (see cr_cache.store.lockfile).
+compact.lock: Held while compacting, so only one compaction runs at once.
+
+A record is only applied once its terminating newline has been written, so
+a writer that dies mid-append leaves a partial line that readers ignore and
+the next writer truncates away.
+"""
+
+from itertools import islice
+import json
+import os
+import re
+import threading
+
+from extras import try_import
+fcntl = try_import('fcntl')
+
+from cr_cache.store import AbstractStore, LockStats, state_dir, stats_path
+from cr_cache.store.lockfile import LockFile
+
+
+class Store(AbstractStore):
+    """Append-only persistent store.
+
+    Writes cost O(1) amortised: a buffered record per operation, appended in
+    one write at the outermost unlock.
+    """
+
+    def __init__(self, lock_timeout=60, compact_threshold=1024*1024,
+        shard=None):
+        """Create a Store.
+
+        :param lock_timeout: How many seconds to wait for a lock before giving
+            up with LockTimeout. None waits forever.
+        :param compact_threshold: Start a background compaction after a
+            write leaves the current segment larger than this many bytes.
+            None disables automatic compaction.
+        :param shard: The shard to store, or None for the unsharded state.
+        """
+        self.shard = shard
+        self.path = os.path.join(state_dir(shard), 'journal')
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.lock_timeout = lock_timeout
+        self.compact_threshold = compact_threshold
+        # Shared with the compaction's locks.
+        self.lock_stats = LockStats(stats_path(shard))
+        self._lockfile = self._make_lockfile()
+        self._locked = 0
+        self._exclusive = False
+        # The replayed state, the oldest segment it needs and the segment and
+        # offset replayed up to. _valid_end is where the last complete record
+        # in the current segment ends.
+        self._values = {}
+        self._sets = {}
+        self._base = None
+        self._segment = 0
+        self._offset = 0
+        # Records written under the current write lock, and the record count
+        # at each lock level (None for read levels) for abort.
+        self._pending = []
+        self._savepoints = []
+        self._compactor = None
+
+    def _make_lockfile(self):
+        return LockFile(
+            os.path.join(self.path, 'lock'), os.path.join(self.path, 'wlock'),
+            self.lock_timeout, self.lock_stats)
+
+    def _check_locked(self, exclusive):
+        if not self._locked or (exclusive and not self._exclusive):
+            raise AssertionError('not locked')
+
+    def __getitem__(self, item):
+        self._check_locked(False)
+        return self._values[item]
+
+    def __setitem__(self, item, value):
+        self._record(['set', item, value])
+
+    def __delitem__(self, item):
+        self._check_locked(True)
+        if item not in self._values:
+            raise KeyError(item)
+        self._record(['del', item])
+
+    def sadd(self, setname, members):
+        self._record(['sadd', setname, list(members)])
+
+    def srem(self, setname, members):
+        self._record(['srem', setname, list(members)])
+
+    def scard(self, setname):
+        self._check_locked(False)
+        return len(self._sets.get(setname, ()))
+
+    def sismember(self, setname, member):
+        self._check_locked(False)
+        return member in self._sets.get(setname, ())
+
+    def smembers(self, setname, limit=None):
+        self._check_locked(False)
+        return set(islice(self._sets.get(setname, ()), limit))
+
+    def sdiff_count(self, setname, other):
+        self._check_locked(False)
+        members = self._sets.get(setname, set())
+        other = self._sets.get(other, set())
+        if len(other) < len(members):
+            return len(members) - len(members.intersection(other))
+        return sum(1 for member in members if member not in other)
+
+    def _record(self, record):
+        """Apply record in memory and queue it for the journal."""
+        self._check_locked(True)
+        _apply(self._values, self._sets, record)
+        self._pending.append(record)
+
+    def abort(self):
+        del self._pending[self._savepoints[-1]:]
+        # Rebuild the committed state and reapply what is still pending.
+        pending = self._pending
+        self._base = None
+        self._refresh()
+        for record in pending:
+            _apply(self._values, self._sets, record)
+        self._pending = pending
+
+    def lock_read(self):
+        self._lock(False)
+        self._savepoints.append(None)
+
+    def lock_write(self):
+        self._lock(True)
+        self._savepoints.append(len(self._pending))
+
+    def _lock(self, exclusive):
+        if self._locked:
+            if exclusive and not self._exclusive:
+                raise AssertionError('cannot upgrade a read lock')
+            self._locked += 1
+            return
+        self._lockfile.lock(exclusive)
+        try:
+            self._refresh()
+        except:
+            self._lockfile.unlock()
+            raise
+        self._exclusive = exclusive
+        self._locked = 1
+
+    def unlock(self):
+        if not self._locked:
+            raise AssertionError('not locked')
+        self._savepoints.pop()
+        if self._locked > 1:
+            self._locked -= 1
+            return
+        try:
+            if self._pending:
+                self._append()
+        finally:
+            self._pending = []
+            self._locked = 0
+            self._exclusive = False
+            self._lockfile.unlock()
+        if (self.compact_threshold is not None and
+            self._offset > self.compact_threshold):
+            self._start_compaction()
+
+    def _refresh(self):
+        """Bring the in-memory state up to date with the files on disk."""
+        snapshots, segments = _list(self.path)
+        base = max(snapshots or [0])
+        # If compaction has removed segments we have not replayed, start
+        # again from the newest snapshot.
+        if self._base is None or self._segment < base:
+            self._values, self._sets = _load_snapshot(self.path, base)
+            self._base = base
+            self._segment = base
+            self._offset = 0
+        while True:
+            self._replay(self._segment)
+            if self._segment + 1 not in segments:
+                break
+            self._segment += 1
+            self._offset = 0
+
+    def _replay(self, segment):
+        """Apply the complete records in segment past self._offset."""
+        try:
+            f = open(_segment_path(self.path, segment), 'rb')
+        except IOError:
+            return
+        with f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # A torn write: ignored, and truncated by the next writer.
+                    break
+                _apply(self._values, self._sets,
+                    json.loads(line.decode('utf8')))
+                self._offset += len(line)
+
+    def _append(self):
+        """Append the pending records to the current segment."""
+        data = b''.join(
+            json.dumps(record).encode('utf8') + b'\n'
+            for record in self._pending)
+        fd = os.open(_segment_path(self.path, self._segment),
+            os.O_CREAT | os.O_WRONLY, 0o600)
+        try:
+            # Drop any torn record left by a writer that died.
+            os.ftruncate(fd, self._offset)
+            os.lseek(fd, self._offset, os.SEEK_SET)
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        self._offset += len(data)
+
+    def _start_compaction(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        # Don't keep the process alive for it: an interrupted compaction
+        # leaves only a .tmp snapshot behind, and the next one starts over.
+        self._compactor = threading.Thread(target=self.compact)
+        self._compactor.daemon = True
+        self._compactor.start()
+
+    def compact(self):
+        """Fold the journal into a new snapshot.
+
+        Writers are only held up while the segment is rotated and while the
+        replaced files are deleted, not while the snapshot is built.
+
+        :return: False if another compaction was already running.
+        """
+        guard = os.open(os.path.join(self.path, 'compact.lock'),
+            os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(guard, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    return False
+            # A lock of our own: this may run in a thread alongside the
+            # Store's users.
+            lockfile = self._make_lockfile()
+            lockfile.lock(True)
+            try:
+                snapshots, segments = _list(self.path)
+                base = max(snapshots or [0])
+                last = max(segments or [base])
+                # New writes go to a fresh segment; the old ones are now
+                # immutable.
+                os.close(os.open(_segment_path(self.path, last + 1),
+                    os.O_CREAT | os.O_WRONLY, 0o600))
+            finally:
+                lockfile.unlock()
+            values, sets = _load_snapshot(self.path, base)
+            for segment in range(base, last + 1):
+                _replay_all(self.path, segment, values, sets)
+            snapshot = _snapshot_path(self.path, last + 1)
+            with open(snapshot + '.tmp', 'wt') as f:
+                json.dump({'values': values,
+                    'sets': dict((name, sorted(members))
+                        for name, members in sets.items() if members)}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(snapshot + '.tmp', snapshot)
+            lockfile.lock(True)
+            try:
+                for old in snapshots:
+                    os.unlink(_snapshot_path(self.path, old))
+                for segment in segments:
+                    if segment <= last:
+                        os.unlink(_segment_path(self.path, segment))
+            finally:
+                lockfile.unlock()
+            return True
+        finally:
+            os.close(guard)
+
+
+def _apply(values, sets, record):
+    """Apply a journal record to values and sets."""
+    op = record[0]
+    if op == 'set':
+        values[record[1]] = record[2]
+    elif op == 'del':
+        values.pop(record[1], None)
+    elif op == 'sadd':
+        sets.setdefault(record[1], set()).update(record[2])
+    elif op == 'srem':
+        sets.get(record[1], set()).difference_update(record[2])
+    else:
+        raise ValueError('unknown journal record %r' % (record,))
+
+
+_file_re = re.compile(r'^(snapshot|journal)\.(\d+)$')
+
+
+def _list(path):
+    """Return the snapshot and segment numbers present in path."""
+    snapshots = []
+    segments = set()
+    for name in os.listdir(path):
+        match = _file_re.match(name)
+        if match is None:
+            continue
+        if match.group(1) == 'snapshot':
+            snapshots.append(int(match.group(2)))
+        else:
+            segments.add(int(match.group(2)))
+    return snapshots, segments
+
+
+def _segment_path(path, segment):
+    return os.path.join(path, 'journal.%d' % segment)
+
+
+def _snapshot_path(path, segment):
+    return os.path.join(path, 'snapshot.%d' % segment)
+
+
+def _load_snapshot(path, segment):
+    """Load snapshot.segment, returning (values, sets)."""
+    try:
+        f = open(_snapshot_path(path, segment), 'rt')
+    except IOError:
+        return {}, {}
+    with f:
+        data = json.load(f)
+    return data['values'], dict(
+        (name, set(members)) for name, members in data['sets'].items())
+
+
+def _replay_all(path, segment, values, sets):
+    """Apply every complete record in segment to values and sets."""
+    try:
+        f = open(_segment_path(path, segment), 'rb')
+    except IOError:
+        return
+    with f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            _apply(values, sets, json.loads(line.decode('utf8')))
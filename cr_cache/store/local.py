@@ -16,58 +16,169 @@
 
 This store uses a simple python ndb for storing active/pooled instance
 metadata.
+
+Locking is done with a cr_cache.store.lockfile.LockFile on state.lck, with
+writers queueing on state.wlck.
+
+Writes made under a write lock are buffered in memory (and are visible to
+reads through the same Store) until the outermost unlock, when they are
+written to the dbm in one batch. Aborted writes never reach the dbm at all.
+Only that in-process abort is atomic: the batch is written to the dbm key by
+key, so a crash part way through a flush can leave some of it written.
+
+The dbm handle, and a cache of values read through it, are kept between
+locks. Each batch of writes bumps a generation number in state.gen; when a
+lock is taken and the generation has changed, the handle is reopened and the
+cache dropped. Repeated reads with no intervening writes from other processes
+never touch the dbm.
 """
 
 from extras import try_imports
 dbm = try_imports(['dbm', 'dbm.ndbm'])
 import os.path
 
-from cr_cache.store import AbstractStore
+from cr_cache.store import AbstractStore, LockStats, state_dir, stats_path
+from cr_cache.store.lockfile import LockFile
 
 class Store(AbstractStore):
     """General store for most crcache operations.
 
-    Stores data in ~/.cache/crcache/state.db.
-    Updates may be batched depending on the dbm implementation, with a lock
-    kept in state.lck.
+    Stores data in ~/.cache/crcache/state.db, or in the shards directory
+    for a sharded store.
+    Updates are batched until the outermost unlock, with a lock kept in
+    state.lck.
     """
 
-    def __init__(self):
-        self.dbm_path = os.path.expanduser('~/.cache/crcache/state')
-        self.dbm_lock = os.path.expanduser('~/.cache/crcache/state.lck')
+    def __init__(self, lock_timeout=60, shard=None):
+        """Create a Store.
+
+        :param lock_timeout: How many seconds to wait for a lock before giving
+            up with LockTimeout. None waits forever.
+        :param shard: The shard to store, or None for the unsharded state.
+        """
+        self.shard = shard
+        dir = state_dir(shard)
+        self.dbm_path = os.path.join(dir, 'state')
+        self.dbm_lock = os.path.join(dir, 'state.lck')
+        self.dbm_turnstile = os.path.join(dir, 'state.wlck')
+        self.dbm_generation = os.path.join(dir, 'state.gen')
+        self._lockfile = LockFile(self.dbm_lock, self.dbm_turnstile,
+            lock_timeout, LockStats(stats_path(shard)))
+        self.lock_stats = self._lockfile.stats
         self._locked = 0
-        # Check it is usable, create empty db if needed.
-        dir = os.path.dirname(self.dbm_path)
+        self._exclusive = False
+        # Buffered writes: key -> encoded value, or None for a deletion.
+        self._pending = {}
+        # One entry per lock level: a copy of _pending to restore on abort for
+        # write locks, None for read locks.
+        self._savepoints = []
+        # The dbm opened for reading, and the generation it and the read
+        # cache (key -> encoded value, or None if missing) reflect.
+        self._db = None
+        self._cache = {}
+        self._generation = None
+        # Create an empty db if needed. Only creating it takes the lock, so
+        # stores can be made while other processes hold it.
         if not os.path.exists(dir):
             os.makedirs(dir)
-        self._lock()
-        db = dbm.open(self.dbm_path, 'c')
-        db.close()
-        self._unlock()
+        if not self._exists():
+            self._lock(True)
+            try:
+                db = dbm.open(self.dbm_path, 'c')
+                db.close()
+            finally:
+                self._unlock()
 
     def __getitem__(self, item):
-        return self._db[item].decode('utf8')
+        if item in self._pending:
+            value = self._pending[item]
+        elif item in self._cache:
+            value = self._cache[item]
+        else:
+            if self._db is None:
+                self._db = self._open('r')
+            try:
+                value = self._db[item]
+            except KeyError:
+                value = None
+            self._cache[item] = value
+        if value is None:
+            raise KeyError(item)
+        return value.decode('utf8')
 
     def __setitem__(self, item, value):
-        self._db[item] = value.encode('utf8')
+        if not self._exclusive:
+            raise AssertionError('not write locked')
+        self._pending[item] = value.encode('utf8')
 
     def __delitem__(self, item):
-        del self._db[item]
+        if not self._exclusive:
+            raise AssertionError('not write locked')
+        # Raises KeyError if item is already absent.
+        self[item]
+        self._pending[item] = None
+
+    def abort(self):
+        self._pending = dict(self._savepoints[-1])
 
     def lock_read(self):
-        if self._lock():
-            self._db = dbm.open(self.dbm_path, 'r')
+        if self._lock(False):
+            self._check_generation()
+        self._savepoints.append(None)
 
     def lock_write(self):
-        if self._lock():
-            self._db = dbm.open(self.dbm_path, 'w')
+        if self._lock(True):
+            self._check_generation()
+        self._savepoints.append(dict(self._pending))
+
+    def _check_generation(self):
+        """Drop the dbm handle and cache if another Store has written."""
+        try:
+            with open(self.dbm_generation, 'rt') as f:
+                generation = f.read()
+        except IOError:
+            generation = ''
+        if generation == self._generation:
+            return
+        self._close()
+        self._cache = {}
+        self._generation = generation
+
+    def _exists(self):
+        """Has the dbm been created?"""
+        whichdb = getattr(dbm, 'whichdb', None)
+        if whichdb is not None:
+            return whichdb(self.dbm_path) is not None
+        # The suffixes the different dbm implementations use.
+        return any(os.path.exists(self.dbm_path + suffix)
+            for suffix in ('', '.db', '.dir', '.dat'))
+
+    def _open(self, flag):
+        """Open the dbm."""
+        # gdbm locks the file while it is open: crcache does its own locking.
+        if getattr(dbm, 'whichdb', None) is not None and (
+            dbm.whichdb(self.dbm_path) == 'dbm.gnu'):
+            flag += 'u'
+        return dbm.open(self.dbm_path, flag)
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
 
-    def _lock(self):
+    def _lock(self, exclusive):
+        """Take the store lock.
+
+        :param exclusive: True to lock for writing.
+        :return: True if this is the outermost lock.
+        """
         if self._locked:
+            if exclusive and not self._exclusive:
+                raise AssertionError('cannot upgrade a read lock')
             self._locked += 1
             return False
-        fd = os.open(self.dbm_lock, os.O_CREAT | os.O_EXCL)
-        os.close(fd)
+        self._lockfile.lock(exclusive)
+        self._exclusive = exclusive
         self._locked = 1
         return True
 
@@ -77,9 +188,76 @@ class Store(AbstractStore):
         self._locked -= 1
         if self._locked:
             return
-        os.unlink(self.dbm_lock)
+        self._lockfile.unlock()
+        self._exclusive = False
 
     def unlock(self):
-        if self._locked == 1:
-            self._db.close()
-        self._unlock()
+        if not self._locked:
+            raise AssertionError('not locked')
+        self._savepoints.pop()
+        try:
+            if self._locked == 1 and self._pending:
+                try:
+                    self._flush()
+                finally:
+                    self._pending = {}
+        finally:
+            self._unlock()
+
+    def flush(self):
+        """Write buffered changes to the dbm without releasing the lock.
+
+        Flushed writes can no longer be aborted.
+        """
+        if not self._exclusive:
+            raise AssertionError('not write locked')
+        if self._pending:
+            try:
+                self._flush()
+            finally:
+                self._pending = {}
+        self._savepoints = [
+            None if savepoint is None else {}
+            for savepoint in self._savepoints]
+
+    def keys(self):
+        """Return the set of all keys in the store."""
+        if not self._locked:
+            raise AssertionError('not locked')
+        if self._db is None:
+            self._db = self._open('r')
+        keys = set(key.decode('utf8') for key in self._db.keys())
+        for item, value in self._pending.items():
+            if value is None:
+                keys.discard(item)
+            else:
+                keys.add(item)
+        return keys
+
+    def _flush(self):
+        """Write buffered changes to the dbm and bump the generation."""
+        # Bump the generation first: even if writing fails part way, other
+        # Stores must not trust what they have cached. Until the writes
+        # succeed, neither does this one.
+        generation = str(int(self._generation or '0') + 1)
+        with open(self.dbm_generation, 'wt') as f:
+            f.write(generation)
+        # The read handle may not see writes made through another handle, and
+        # some dbms rewrite their index when a writable handle is closed: so
+        # writable handles never outlive the write lock.
+        self._close()
+        db = self._open('w')
+        try:
+            for item, value in self._pending.items():
+                if value is None:
+                    try:
+                        del db[item]
+                    except KeyError:
+                        pass
+                else:
+                    db[item] = value
+                self._cache[item] = value
+        finally:
+            db.close()
+        self._generation = generation
+
@@ -0,0 +1,342 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Reader/writer locking between processes, for file based stores.
+
+Locking uses flock(2) where available: readers share the lock file, writers
+hold it exclusively. To stop a steady stream of readers starving writers,
+lockers pass through a second, turnstile, lock file first: writers hold it
+exclusively until they own the lock file, which queues any later readers
+behind them. The kernel drops flocks when their holder dies, so they can
+never be left behind.
+
+Where flock is not available, the lock file is created exclusively for both
+reads and writes. That lock file outlives a holder that is killed, so it
+records its owner's host, pid and process start time: a waiter that finds
+the owner has died (or its pid has been reused) removes the file.
+
+Exclusive flock holders record themselves in the lock file too, so that
+LockTimeout can say who is holding the lock.
+"""
+
+import errno
+from extras import try_import
+fcntl = try_import('fcntl')
+import os
+import socket
+import time
+
+from cr_cache.store import LockStats, LockTimeout
+
+
+# How long a lock file (without flock) may go without an owner being written
+# to it before it is treated as stale: the owner died as it was created.
+_UNOWNED_GRACE = 10
+
+
+class LockFile(object):
+    """A reader/writer lock shared between processes.
+
+    LockFiles are not reentrant: stores count their own nested locks.
+
+    :attr path: The path of the lock file.
+    :attr turnstile: The path of the turnstile that writers queue on.
+    :attr timeout: How many seconds to wait for the lock before giving up
+        with LockTimeout. None waits forever.
+    :attr stats: The LockStats this lock records its use in.
+    """
+
+    def __init__(self, path, turnstile, timeout=60, stats=None):
+        self.path = path
+        self.turnstile = turnstile
+        self.timeout = timeout
+        if stats is None:
+            stats = LockStats()
+        self.stats = stats
+        self._fd = None
+        self._held = False
+        self._exclusive = False
+        self._acquired_at = None
+
+    def lock(self, exclusive):
+        """Take the lock.
+
+        :param exclusive: True to lock for writing.
+        :raises LockTimeout: If the lock could not be obtained in time.
+        """
+        if self._held:
+            raise AssertionError('already locked')
+        start = time.time()
+        if self.timeout is None:
+            deadline = None
+        else:
+            deadline = start + self.timeout
+        contended = []
+        try:
+            if fcntl is None:
+                self._lock_exclusive_file(deadline, contended)
+            else:
+                self._fd = self._lock_flock(exclusive, deadline, contended)
+        except LockTimeout:
+            self.stats.waited(time.time() - start, True, timed_out=True)
+            raise
+        self._acquired_at = time.time()
+        self.stats.waited(self._acquired_at - start, bool(contended))
+        self._held = True
+        self._exclusive = exclusive
+
+    def _lock_flock(self, exclusive, deadline, contended):
+        """Take a shared or exclusive flock on the lock file.
+
+        :param contended: A list, appended to if the lock was not free.
+        :return: The fd holding the lock.
+        """
+        if exclusive:
+            mode = fcntl.LOCK_EX
+        else:
+            mode = fcntl.LOCK_SH
+        turnstile = os.open(self.turnstile, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            _flock(turnstile, mode, deadline, self.turnstile, contended)
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                _flock(fd, mode, deadline, self.path, contended,
+                    lambda:_owner_of(fd))
+                if exclusive:
+                    # Replace any record left by a writer that died.
+                    os.ftruncate(fd, 0)
+                    os.write(fd, _owner().encode('utf8'))
+            except:
+                os.close(fd)
+                raise
+        finally:
+            # Closing drops our hold on the turnstile.
+            os.close(turnstile)
+        return fd
+
+    def _lock_exclusive_file(self, deadline, contended):
+        """Lock by creating the lock file, for platforms without flock.
+
+        :param contended: A list, appended to if the lock was not free.
+        """
+        delay = 0.001
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                    0o600)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                contended.append(True)
+                owner = _read_owner(self.path)
+                if owner is not None and _is_stale(self.path, owner):
+                    self._reclaim(owner)
+                    continue
+                delay = _backoff(delay, deadline, self.path,
+                    lambda:_read_owner(self.path))
+                continue
+            try:
+                os.write(fd, _owner().encode('utf8'))
+            finally:
+                os.close(fd)
+            return
+
+    def _reclaim(self, owner):
+        """Remove the lock file, if it is still held by owner.
+
+        Reclaimers take a guard file first, so that two waiters that both
+        saw the same dead owner cannot remove a lock file taken between
+        them.
+        """
+        guard = self.path + '.reclaim'
+        try:
+            fd = os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # Another waiter is reclaiming - unless it died doing so.
+            _remove_if_older(guard, _UNOWNED_GRACE)
+            return
+        try:
+            if _read_owner(self.path) == owner:
+                os.unlink(self.path)
+        finally:
+            os.close(fd)
+            os.unlink(guard)
+
+    def unlock(self):
+        """Release the lock."""
+        if not self._held:
+            raise AssertionError('not locked')
+        self._held = False
+        self.stats.held(time.time() - self._acquired_at)
+        if self._fd is None:
+            os.unlink(self.path)
+        else:
+            if self._exclusive:
+                os.ftruncate(self._fd, 0)
+            os.close(self._fd)
+            self._fd = None
+
+
+def _flock(fd, mode, deadline, path, contended, owner=None):
+    """flock fd, waiting no later than deadline.
+
+    :param deadline: A time.time() value, or None to wait indefinitely.
+    :param path: The path fd refers to, for error reporting.
+    :param contended: A list, appended to if the lock was not free.
+    :param owner: A callable returning who holds the lock, for error
+        reporting.
+    :raises LockTimeout: If the deadline passes before the lock is granted.
+    """
+    delay = 0.001
+    while True:
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            return
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        contended.append(True)
+        if deadline is None:
+            fcntl.flock(fd, mode)
+            return
+        delay = _backoff(delay, deadline, path, owner)
+
+
+def _backoff(delay, deadline, path, owner=None):
+    """Sleep before retrying a lock.
+
+    :param owner: A callable returning who holds the lock, for error
+        reporting.
+    :return: The delay to use next time.
+    :raises LockTimeout: If deadline has passed.
+    """
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            holder = owner and _describe(path, owner())
+            if holder:
+                raise LockTimeout(path, holder)
+            raise LockTimeout(path)
+        delay = min(delay, remaining)
+    time.sleep(delay)
+    return min(delay * 2, 0.05)
+
+
+def _owner():
+    """Return the owner record for this process."""
+    return process_record() + '\n'
+
+
+def process_record(pid=None):
+    """Return a record identifying a process, for process_gone.
+
+    The record is the host, pid and start time, separated by spaces.
+
+    :param pid: A process on this host. Defaults to this process.
+    """
+    if pid is None:
+        pid = os.getpid()
+    return '%s %d %s' % (socket.gethostname(), pid, _start_time(pid))
+
+
+def process_gone(record):
+    """Has the process process_record returned record in certainly died?"""
+    return _is_stale(None, record + '\n')
+
+
+def _owner_of(fd):
+    """Return the owner record in the open lock file fd, or None."""
+    try:
+        data = os.pread(fd, 1024, 0)
+    except (AttributeError, OSError):
+        return None
+    return data.decode('utf8', 'replace') or None
+
+
+def _read_owner(path):
+    """Return the owner record in the lock file at path.
+
+    :return: The record, '' if the owner has not written it yet, or None if
+        there is no lock file.
+    """
+    try:
+        with open(path, 'rt') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _start_time(pid):
+    """Return an opaque start time for process pid, or '-' if unknown.
+
+    Together with the pid this identifies a process even after its pid is
+    reused.
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'rt') as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return '-'
+    # The command name can contain spaces: fields resume after the last ')'.
+    # starttime is field 22; the state (field 3) is the first after it.
+    return stat.rsplit(')', 1)[-1].split()[19]
+
+
+def _is_stale(path, owner):
+    """Is owner, the record in the lock file at path, certainly dead?"""
+    if not owner.endswith('\n'):
+        # Not written yet, or torn: stale only if the creator died.
+        return _is_older(path, _UNOWNED_GRACE)
+    try:
+        host, pid, start = owner.split()
+        pid = int(pid)
+    except ValueError:
+        return False
+    if host != socket.gethostname() or os.name != 'posix':
+        # Other hosts' processes (and non-POSIX ones) cannot be checked.
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    # The pid is live, but it may have been reused by another process.
+    current = _start_time(pid)
+    return '-' not in (start, current) and start != current
+
+
+def _describe(path, owner):
+    """Describe the live holder recorded as owner, or return None."""
+    if not owner or not owner.endswith('\n') or _is_stale(path, owner):
+        return None
+    fields = owner.split()
+    if len(fields) != 3:
+        return None
+    return 'held by pid %s on %s' % (fields[1], fields[0])
+
+
+def _is_older(path, seconds):
+    try:
+        return os.stat(path).st_mtime < time.time() - seconds
+    except OSError:
+        return False
+
+
+def _remove_if_older(path, seconds):
+    if _is_older(path, seconds):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -22,8 +22,9 @@ from cr_cache.store import AbstractStore
 
 class Store(AbstractStore):
     
-    def __init__(self, backend):
+    def __init__(self, backend, shard=None):
         self._backend = backend
+        self.shard = shard
         self._lock = 'u'
         self._lock_count = 0
 
@@ -0,0 +1,134 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Wake processes waiting for a change, without them polling the store.
+
+Each waiting process creates a named pipe in a shared directory and sleeps
+until something is written to it. notify writes a byte to every pipe in the
+directory. Pipes that nobody is reading are skipped, so notify never blocks.
+
+Where named pipes are not available, waiters just sleep for their timeout.
+"""
+
+import errno
+import os
+import select
+import time
+
+
+class Waiter(object):
+    """A named pipe that a process sleeps on until notified.
+
+    :attr path: The path of the pipe.
+    """
+
+    def __init__(self, path):
+        """Create a Waiter.
+
+        :param path: Where to create the pipe. Its directory is created if
+            needed, and the pipe is removed by close().
+        """
+        self.path = path
+        self._read_fd = None
+        self._write_fd = None
+        if not hasattr(os, 'mkfifo'):
+            return
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        os.mkfifo(path)
+        self._read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # Holding the pipe open for writing too stops it reporting end of
+        # file (and so always being readable) after a notifier closes it.
+        self._write_fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+
+    def wait(self, timeout):
+        """Sleep until notified, or for timeout seconds.
+
+        Notifications sent since the last wait return immediately.
+
+        :return: True if notified.
+        """
+        return wait_any([self], timeout)
+
+    def _drain(self):
+        """Consume the notifications written to the pipe."""
+        try:
+            while os.read(self._read_fd, 512):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        """Remove the pipe."""
+        if self._read_fd is None:
+            return
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        os.close(self._write_fd)
+        os.close(self._read_fd)
+        self._read_fd = None
+        self._write_fd = None
+
+
+def wait_any(waiters, timeout):
+    """Sleep until any of waiters is notified, or for timeout seconds.
+
+    Notifications sent since their last wait return immediately, and are
+    consumed from every waiter that has one.
+
+    :param timeout: Seconds to wait, or None to wait until notified.
+    :return: True if notified.
+    """
+    by_fd = dict((waiter._read_fd, waiter) for waiter in waiters
+        if waiter._read_fd is not None)
+    if not by_fd:
+        if timeout is not None:
+            time.sleep(timeout)
+        return False
+    readable = select.select(list(by_fd), [], [], timeout)[0]
+    for fd in readable:
+        by_fd[fd]._drain()
+    return bool(readable)
+
+
+def notify(directory):
+    """Wake every Waiter in directory."""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        try:
+            fd = os.open(os.path.join(directory, name),
+                os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            # Gone, or nobody reading.
+            continue
+        try:
+            os.write(fd, b'.')
+        except OSError as e:
+            # A full pipe already has a wakeup pending.
+            if e.errno != errno.EAGAIN:
+                raise
+        finally:
+            os.close(fd)
@@ -0,0 +1,274 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""The crcache sqlite data store.
+
+This store keeps crcache state in a sqlite database in WAL mode, so readers
+never block the writer. Sets are stored one row per member with a maintained
+member count, making set operations proportional to the members touched
+rather than the size of the set. resource/ keys live in their own table, and
+all other keys in a metadata table.
+"""
+
+import os.path
+import sqlite3
+import time
+
+from cr_cache.store import (
+    AbstractStore,
+    LockStats,
+    LockTimeout,
+    state_dir,
+    stats_path,
+    )
+
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS metadata (
+        key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS resources (
+        instance TEXT PRIMARY KEY, cache TEXT NOT NULL) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS sets (
+        setname TEXT PRIMARY KEY, count INTEGER NOT NULL) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS set_members (
+        setname TEXT NOT NULL, member TEXT NOT NULL,
+        PRIMARY KEY (setname, member)) WITHOUT ROWID""",
+    ]
+
+_TABLES = ('metadata', 'resources', 'sets', 'set_members')
+# sqlite takes its busy timeout in milliseconds as a C int, so this is the
+# nearest it comes to waiting forever.
+_FOREVER = (2**31 - 1) / 1000.0
+
+
+class Store(AbstractStore):
+    """Persistent store backed by sqlite.
+
+    Stores data in ~/.cache/crcache/state.sqlite, or in the shards directory
+    for a sharded store.
+    """
+
+    def __init__(self, lock_timeout=60, shard=None):
+        """Create a Store.
+
+        :param lock_timeout: How many seconds to wait for a write lock before
+            giving up with LockTimeout. None waits forever.
+        :param shard: The shard to store, or None for the unsharded state.
+        """
+        self.shard = shard
+        self.lock_timeout = lock_timeout
+        self.lock_stats = LockStats(stats_path(shard))
+        dir = state_dir(shard)
+        self.db_path = os.path.join(dir, 'state.sqlite')
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        # Transactions are managed explicitly by lock_read/lock_write. Stores
+        # are handed between threads (a pool provisions from its children in
+        # threads), but only ever used by one thread at a time.
+        self._db = sqlite3.connect(self.db_path, timeout=self._timeout(),
+            isolation_level=None, check_same_thread=False)
+        self._locked = 0
+        self._exclusive = False
+        self._savepoints = []
+        self._acquired_at = None
+        self._execute('PRAGMA journal_mode=WAL')
+        self._execute('PRAGMA synchronous=NORMAL')
+        # Only take the write lock to create the schema when it is missing,
+        # so constructing a store does not contend with writers.
+        present = self._execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'table'"
+            " AND name IN (%s)" % ', '.join('?' * len(_TABLES)),
+            _TABLES).fetchone()[0]
+        if present < len(_TABLES):
+            self.lock_write()
+            try:
+                for statement in _SCHEMA:
+                    self._execute(statement)
+            finally:
+                self.unlock()
+
+    def _timeout(self):
+        """Return lock_timeout in seconds, mapping None to _FOREVER."""
+        if self.lock_timeout is None:
+            return _FOREVER
+        return min(self.lock_timeout, _FOREVER)
+
+    def _execute(self, sql, params=()):
+        try:
+            return self._db.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                raise LockTimeout(self.db_path)
+            raise
+
+    def _check_locked(self, exclusive):
+        if not self._locked or (exclusive and not self._exclusive):
+            raise AssertionError('not locked')
+
+    def _table_for(self, item):
+        """Return the table, key column, value column and key for item."""
+        if item.startswith('resource/'):
+            return 'resources', 'instance', 'cache', item[len('resource/'):]
+        return 'metadata', 'key', 'value', item
+
+    def __getitem__(self, item):
+        self._check_locked(False)
+        table, key, value, row_key = self._table_for(item)
+        row = self._execute(
+            'SELECT %s FROM %s WHERE %s = ?' % (value, table, key),
+            (row_key,)).fetchone()
+        if row is None:
+            raise KeyError(item)
+        return row[0]
+
+    def __setitem__(self, item, value):
+        self._check_locked(True)
+        table, key, column, row_key = self._table_for(item)
+        self._execute(
+            'INSERT OR REPLACE INTO %s (%s, %s) VALUES (?, ?)' % (
+                table, key, column), (row_key, value))
+
+    def __delitem__(self, item):
+        self._check_locked(True)
+        table, key, _, row_key = self._table_for(item)
+        cursor = self._execute(
+            'DELETE FROM %s WHERE %s = ?' % (table, key), (row_key,))
+        if not cursor.rowcount:
+            raise KeyError(item)
+
+    def sadd(self, setname, members):
+        self._check_locked(True)
+        added = 0
+        for member in members:
+            added += self._execute(
+                'INSERT OR IGNORE INTO set_members VALUES (?, ?)',
+                (setname, member)).rowcount
+        self._adjust_count(setname, added)
+
+    def srem(self, setname, members):
+        self._check_locked(True)
+        removed = 0
+        for member in members:
+            removed += self._execute(
+                'DELETE FROM set_members WHERE setname = ? AND member = ?',
+                (setname, member)).rowcount
+        self._adjust_count(setname, -removed)
+
+    def _adjust_count(self, setname, delta):
+        if not delta:
+            return
+        self._execute('INSERT OR IGNORE INTO sets VALUES (?, 0)', (setname,))
+        self._execute(
+            'UPDATE sets SET count = count + ? WHERE setname = ?',
+            (delta, setname))
+
+    def scard(self, setname):
+        self._check_locked(False)
+        row = self._execute(
+            'SELECT count FROM sets WHERE setname = ?', (setname,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def sismember(self, setname, member):
+        self._check_locked(False)
+        return self._execute(
+            'SELECT 1 FROM set_members WHERE setname = ? AND member = ?',
+            (setname, member)).fetchone() is not None
+
+    def smembers(self, setname, limit=None):
+        self._check_locked(False)
+        if limit is None:
+            limit = -1
+        return set(row[0] for row in self._execute(
+            'SELECT member FROM set_members WHERE setname = ? LIMIT ?',
+            (setname, limit)))
+
+    def sdiff_count(self, setname, other):
+        self._check_locked(False)
+        return self._execute(
+            'SELECT COUNT(*) FROM set_members AS s WHERE s.setname = ? AND '
+            'NOT EXISTS (SELECT 1 FROM set_members AS o '
+            'WHERE o.setname = ? AND o.member = s.member)',
+            (setname, other)).fetchone()[0]
+
+    def abort(self):
+        self._execute('ROLLBACK TO ' + self._savepoints[-1])
+
+    def lock_read(self):
+        self._lock(False)
+
+    def lock_write(self):
+        self._lock(True)
+
+    def _lock(self, exclusive):
+        if self._locked:
+            if exclusive and not self._exclusive:
+                raise AssertionError('cannot upgrade a read lock')
+        elif exclusive:
+            # Take the write lock up front rather than on first write, so
+            # that read-modify-write sequences cannot deadlock.
+            self._begin_immediate()
+            self._exclusive = True
+        else:
+            self._execute('BEGIN')
+            self._acquired_at = time.time()
+            self.lock_stats.waited(0.0, False)
+        self._locked += 1
+        # Each write lock level gets a savepoint for abort to roll back to.
+        if exclusive:
+            savepoint = 'lock%d' % self._locked
+            self._execute('SAVEPOINT ' + savepoint)
+        else:
+            savepoint = None
+        self._savepoints.append(savepoint)
+
+    def unlock(self):
+        if not self._locked:
+            raise AssertionError('not locked')
+        savepoint = self._savepoints.pop()
+        if savepoint is not None:
+            self._execute('RELEASE ' + savepoint)
+        self._locked -= 1
+        if self._locked:
+            return
+        self._exclusive = False
+        try:
+            self._execute('COMMIT')
+        finally:
+            self.lock_stats.held(time.time() - self._acquired_at)
+
+    def _begin_immediate(self):
+        """Begin a write transaction, recording the wait in lock_stats."""
+        start = time.time()
+        # Try once without sqlite's busy handler, to see whether another
+        # connection holds the lock.
+        self._db.execute('PRAGMA busy_timeout=0')
+        contended = False
+        try:
+            try:
+                self._execute('BEGIN IMMEDIATE')
+            except LockTimeout:
+                contended = True
+                self._db.execute('PRAGMA busy_timeout=%d' % max(0,
+                    (self._timeout() - (time.time() - start)) * 1000))
+                self._execute('BEGIN IMMEDIATE')
+        except LockTimeout:
+            self.lock_stats.waited(time.time() - start, True, timed_out=True)
+            raise
+        finally:
+            self._db.execute(
+                'PRAGMA busy_timeout=%d' % (self._timeout() * 1000))
+        self._acquired_at = time.time()
+        self.lock_stats.waited(self._acquired_at - start, contended)
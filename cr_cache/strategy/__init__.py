@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Strategies deciding which children of a pool provision new instances.
+
+Cached instances are always taken first; a strategy splits what is left of a
+request between the children of the pool. The strategy is chosen with the
+strategy key in the pool's source.conf.
+
+Interesting modules:
+in_order: fills children in configuration order (the default).
+latency: fills the children that have provisioned fastest first.
+least_loaded: spreads instances to the children with the least of their
+    maximum in use.
+round_robin: spreads instances across the children in turn.
+weighted: spreads instances in proportion to configured weights.
+"""
+
+import heapq
+
+
+class AbstractStrategy(object):
+    """Defines the contract for a pool load-balancing strategy.
+
+    :attr config: A dict containing the configuration of the pool.
+    """
+
+    def __init__(self, config):
+        """Create an AbstractStrategy.
+
+        :param config: A dict containing the configuration of the pool.
+        """
+        self.config = config
+
+    def split(self, children, count):
+        """Split a request for count new instances between children.
+
+        :param children: The child Cache objects of the pool, in
+            configuration order.
+        :param count: How many instances to provision.
+        :return: A list of (child, count) requests. No child may be asked for
+            more than it has available, so if the children have less capacity
+            between them than count, the requests add up to less.
+        """
+        raise NotImplementedError(self.split)
+
+    def observe(self, child, count, seconds):
+        """Record that child provisioned count instances in seconds.
+
+        Called from the thread that provisioned them, for successful requests
+        only. The default does nothing.
+        """
+
+
+def find_strategy_type(name):
+    modname = "cr_cache.strategy.%s" % name.replace('-', '_')
+    return __import__(modname, globals(), locals(), ['Strategy']).Strategy
+
+
+def spread(children, snapshots, count, key):
+    """Hand out count instances one at a time, each to the lowest keyed child.
+
+    :param children: The child Cache objects.
+    :param snapshots: A cr_cache.cache.Snapshot of each of children.
+    :param count: How many instances to hand out.
+    :param key: A callable taking the position of a child and how many
+        instances it has been handed so far, returning its sort key. The key
+        should grow with the count, or the child will take everything.
+    :return: A list of (child, count) requests, in the order of children.
+    """
+    counts = [0] * len(children)
+    heap = [(key(pos, 0), pos) for pos, snapshot in enumerate(snapshots)
+        if _capacity(snapshot)]
+    heapq.heapify(heap)
+    while count and heap:
+        _, pos = heapq.heappop(heap)
+        counts[pos] += 1
+        count -= 1
+        if counts[pos] != _capacity(snapshots[pos]):
+            heapq.heappush(heap, (key(pos, counts[pos]), pos))
+    return [(child, n) for child, n in zip(children, counts) if n]
+
+
+def fill(children, snapshots, count):
+    """Hand out count instances filling each child in turn.
+
+    :param children: The child Cache objects, in the order to fill them.
+    :param snapshots: A cr_cache.cache.Snapshot of each of children.
+    :param count: How many instances to hand out.
+    :return: A list of (child, count) requests.
+    """
+    requests = []
+    for child, snapshot in zip(children, snapshots):
+        if not count:
+            break
+        request_count = min(_capacity(snapshot), count)
+        if request_count:
+            requests.append((child, request_count))
+            count -= request_count
+    return requests
+
+
+def _capacity(snapshot):
+    """How many more instances snapshot's cache can provide.
+
+    Unlimited caches can provide any number.
+    """
+    if not snapshot.maximum:
+        return float('inf')
+    return max(0, snapshot.available)
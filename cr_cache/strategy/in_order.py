@@ -0,0 +1,39 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Fill the children of a pool in configuration order."""
+
+from cr_cache import strategy
+
+
+class Strategy(strategy.AbstractStrategy):
+    """Fill each child up to what it has available before using the next.
+
+    This makes the order of the sources key a preference order.
+    """
+
+    def split(self, children, count):
+        requests = []
+        for child in children:
+            if not count:
+                break
+            if child.maximum:
+                request_count = min(child.available(), count)
+            else:
+                request_count = count
+            if request_count <= 0:
+                continue
+            requests.append((child, request_count))
+            count -= request_count
+        return requests
@@ -0,0 +1,58 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Fill the children of a pool that provision fastest first."""
+
+from cr_cache import strategy
+from cr_cache.cache import snapshot_all
+from cr_cache.store import read_locked_all, write_locked
+
+# How much weight each observation gets in a child's latency.
+_ALPHA = 0.3
+
+
+class Strategy(strategy.AbstractStrategy):
+    """Fill the children in order of how quickly they have provisioned.
+
+    Each child keeps a moving average of how many seconds its provisioning
+    requests take in latency/child, in its own store. Children that have
+    never provisioned sort first, so that they are measured.
+    """
+
+    def split(self, children, count):
+        with read_locked_all(child.store for child in children):
+            snapshots = snapshot_all(children)
+            latencies = [_latency(child) for child in children]
+        order = sorted(range(len(children)),
+            key=lambda pos:(latencies[pos] or 0.0, pos))
+        return strategy.fill([children[pos] for pos in order],
+            [snapshots[pos] for pos in order], count)
+
+    def observe(self, child, count, seconds):
+        with write_locked(child.store):
+            latency = _latency(child)
+            if latency is not None:
+                seconds = _ALPHA * seconds + (1 - _ALPHA) * latency
+            child.store['latency/' + child.name] = '%f' % seconds
+
+
+def _latency(child):
+    """The average seconds child takes to provision, or None if unknown.
+
+    Assumes the store is already locked.
+    """
+    try:
+        return float(child.store['latency/' + child.name])
+    except KeyError:
+        return None
@@ -0,0 +1,37 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Spread instances to the least loaded children of a pool."""
+
+from cr_cache import strategy
+from cr_cache.cache import snapshot_all
+
+
+class Strategy(strategy.AbstractStrategy):
+    """Hand each instance to the child with the least of its maximum in use.
+
+    The load of a child is in_use() / maximum. Children without a maximum
+    are never loaded, so they are only compared by how many instances they
+    have in use.
+    """
+
+    def split(self, children, count):
+        snapshots = snapshot_all(children)
+        def key(pos, n):
+            snapshot = snapshots[pos]
+            in_use = snapshot.in_use + n
+            if not snapshot.maximum:
+                return (0.0, in_use, pos)
+            return (float(in_use) / snapshot.maximum, in_use, pos)
+        return strategy.spread(children, snapshots, count, key)
@@ -0,0 +1,54 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Spread instances across the children of a pool in turn."""
+
+import time
+
+from cr_cache import strategy
+from cr_cache.cache import snapshot_all
+from cr_cache.store import read_locked_all, write_locked
+
+
+class Strategy(strategy.AbstractStrategy):
+    """Spread instances across the children in turn.
+
+    Each child records when it was last picked in picked/child, in its own
+    store, so the rotation carries on from one crcache invocation to the
+    next. A request starts with the children picked longest ago, and goes
+    round them one instance at a time.
+    """
+
+    def split(self, children, count):
+        with read_locked_all(child.store for child in children):
+            snapshots = snapshot_all(children)
+            picked = [_picked(child) for child in children]
+        requests = strategy.spread(children, snapshots, count,
+            lambda pos, n:(n, picked[pos], pos))
+        now = '%f' % time.time()
+        for child, _ in requests:
+            with write_locked(child.store):
+                child.store['picked/' + child.name] = now
+        return requests
+
+
+def _picked(child):
+    """When child was last picked, or 0 if never.
+
+    Assumes the store is already locked.
+    """
+    try:
+        return float(child.store['picked/' + child.name])
+    except KeyError:
+        return 0.0
@@ -0,0 +1,44 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Spread instances across the children of a pool by weight."""
+
+from cr_cache import strategy
+from cr_cache.cache import snapshot_all
+
+
+class Strategy(strategy.AbstractStrategy):
+    """Keep the instances in use from each child in proportion to its weight.
+
+    Weights are set with the weights key in source.conf: a mapping from
+    child name to a positive number. Children not listed weigh 1. Each
+    instance goes to the child that would have the fewest instances in use
+    for its weight after taking it.
+    """
+
+    def __init__(self, config):
+        super(Strategy, self).__init__(config)
+        self.weights = {}
+        for name, weight in (config.get('weights') or {}).items():
+            weight = float(weight)
+            if weight <= 0:
+                raise ValueError(
+                    'Weight for %r must be positive, not %r.' % (name, weight))
+            self.weights[name] = weight
+
+    def split(self, children, count):
+        snapshots = snapshot_all(children)
+        weights = [self.weights.get(child.name, 1.0) for child in children]
+        return strategy.spread(children, snapshots, count,
+            lambda pos, n:((snapshots[pos].in_use + n + 1) / weights[pos], pos))
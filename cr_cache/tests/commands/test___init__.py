@@ -28,7 +28,7 @@ from testtools.matchers import (
 
 from cr_cache import commands
 from cr_cache.ui import cli, model
-from cr_cache.store import local
+from cr_cache.store import local, state_dir
 from cr_cache.tests import TestCase
 
 
@@ -155,6 +155,43 @@ class TestRunArgv(TestCase):
             'err'))
 
 
+class TestSpawn(TestCase):
+
+    def test_runs_detached_command(self):
+        calls = []
+        self.useFixture(MonkeyPatch('subprocess.Popen',
+            lambda *args, **kwargs:calls.append((args, kwargs))))
+        commands.spawn('help', 'gc')
+        [(args, kwargs)] = calls
+        self.assertEqual(sys.executable, args[0][0])
+        self.assertTrue(kwargs['close_fds'])
+        if hasattr(os, 'setsid'):
+            self.assertEqual(os.setsid, kwargs['preexec_fn'])
+        # The command line runs crcache help gc.
+        self.useFixture(MonkeyPatch('cr_cache.commands.run_argv',
+            lambda argv, *streams:calls.append(argv)))
+        code = args[0][2]
+        self.assertThat(lambda:exec(code, {}), raises(SystemExit))
+        self.assertEqual(['crcache', 'help', 'gc'], calls[-1])
+
+    def test_worker_finds_cr_cache_and_logs_errors(self):
+        calls = []
+        self.useFixture(MonkeyPatch('subprocess.Popen',
+            lambda *args, **kwargs:calls.append((args, kwargs))))
+        self.useFixture(MonkeyPatch('os.environ',
+            dict(os.environ, PYTHONPATH='extra')))
+        commands.spawn('gc')
+        [(args, kwargs)] = calls
+        # cr_cache is importable in the worker even when not installed.
+        path = kwargs['env']['PYTHONPATH'].split(os.pathsep)
+        package = os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(commands.__file__))))
+        self.assertIn(package, path)
+        self.assertEqual('extra', path[-1])
+        self.assertEqual(
+            os.path.join(state_dir(), 'worker.log'), kwargs['stderr'].name)
+
+
 class TestGetCommandParser(TestCase):
 
     def test_trivial(self):
@@ -14,8 +14,13 @@
 
 """Tests for the acquire command."""
 
+import os
+
+from fixtures import MonkeyPatch
+
 from cr_cache.commands import acquire
 from cr_cache.config import Config
+from cr_cache.store import lockfile
 from cr_cache.ui.model import UI
 from cr_cache.tests import TestCase
 from cr_cache.tests.test_config import SourceConfigFixture
@@ -23,6 +28,12 @@ from cr_cache.tests.test_config import SourceConfigFixture
 
 class TestCommand(TestCase):
 
+    def setUp(self):
+        super(TestCommand, self).setUp()
+        self.spawned = []
+        self.useFixture(MonkeyPatch('cr_cache.commands.spawn',
+            lambda *args:self.spawned.append(args)))
+
     def get_test_ui_and_cmd(self,args=(), options=()):
         ui = UI(args=args, options=options)
         cmd = acquire.acquire(ui)
@@ -46,3 +57,51 @@ class TestCommand(TestCase):
         self.useFixture(SourceConfigFixture('model', 'model'))
         cmd.execute()
         self.assertEqual([('rest', 'model-0')], ui.outputs)
+
+    def test_acquire_wait(self):
+        ui, cmd = self.get_test_ui_and_cmd(
+            options=[('source', 'model'), ('wait', True), ('timeout', 0.0),
+                ('priority', 10)])
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual([('rest', 'model-0')], ui.outputs)
+
+    def test_acquire_lease(self):
+        ui, cmd = self.get_test_ui_and_cmd(
+            options=[('source', 'model'), ('lease', 0.0)])
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual(1, Config().get_source('model').reclaim())
+
+    def test_acquire_affinity(self):
+        self.useFixture(SourceConfigFixture('model', 'model', reserve=2))
+        source = Config().get_source('model')
+        source.discard(source.provision(1, affinity='proj'))
+        source.discard(source.provision(1))
+        ui, cmd = self.get_test_ui_and_cmd(
+            options=[('source', 'model'), ('affinity', 'proj')])
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual([('rest', 'model-0')], ui.outputs)
+
+    def test_acquire_owner_pid(self):
+        ui, cmd = self.get_test_ui_and_cmd(
+            options=[('source', 'model'), ('owner_pid', os.getpid())])
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        self.assertEqual(0, cmd.execute())
+        source = Config().get_source('model')
+        self.assertEqual(0, source.reap())
+        self.assertEqual(1,
+            source.release_owner(lockfile.process_record(os.getpid())))
+
+    def test_below_reserve_starts_fill(self):
+        ui, cmd = self.get_test_ui_and_cmd(options=[('source', 'model')])
+        self.useFixture(SourceConfigFixture('model', 'model', reserve=2))
+        cmd.execute()
+        self.assertEqual([('rest', 'model-0')], ui.outputs)
+        self.assertEqual([('fill', 'model')], self.spawned)
+
+    def test_at_reserve_does_not_start_fill(self):
+        ui, cmd = self.get_test_ui_and_cmd(options=[('source', 'model')])
+        self.useFixture(SourceConfigFixture('model', 'model', reserve=1))
+        cmd.execute()
+        self.assertEqual([], self.spawned)
@@ -0,0 +1,53 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the daemon command."""
+
+import threading
+
+from cr_cache.commands import daemon
+from cr_cache.store import daemon as daemon_store, write_locked
+from cr_cache.ui.model import UI
+from cr_cache.tests import TestCase
+
+
+class TestCommand(TestCase):
+
+    def get_test_ui_and_cmd(self,args=(), options=()):
+        ui = UI(args=args, options=options)
+        cmd = daemon.daemon(ui)
+        ui.set_command(cmd)
+        return ui, cmd
+
+    def test_serves_until_stopped(self):
+        ui, cmd = self.get_test_ui_and_cmd()
+        results = []
+        thread = threading.Thread(target=lambda:results.append(cmd.execute()))
+        thread.start()
+        try:
+            while getattr(cmd, 'server', None) is None:
+                thread.join(0.001)
+            cmd.server.ready.wait(10)
+            store = daemon_store.Store()
+            try:
+                self.assertIsInstance(store, daemon_store.Client)
+                with write_locked(store):
+                    store['foo'] = 'bar'
+            finally:
+                store.close()
+        finally:
+            cmd.server.stop()
+            thread.join()
+        self.assertEqual([0], results)
+        self.assertEqual([], ui.outputs)
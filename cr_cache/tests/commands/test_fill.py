@@ -0,0 +1,61 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the fill command."""
+
+from cr_cache import cache
+from cr_cache.commands import fill
+from cr_cache.config import Config
+from cr_cache.source import model, pool
+from cr_cache.store import memory
+from cr_cache.ui.model import UI
+from cr_cache.tests import TestCase
+from cr_cache.tests.test_config import SourceConfigFixture
+
+
+class TestCommand(TestCase):
+
+    def get_test_ui_and_cmd(self,args=(), options=()):
+        ui = UI(args=args, options=options)
+        cmd = fill.fill(ui)
+        ui.set_command(cmd)
+        return ui, cmd
+
+    def test_fills_named_source(self):
+        self.useFixture(SourceConfigFixture('model', 'model', reserve=2))
+        ui, cmd = self.get_test_ui_and_cmd(args=['model'])
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual([], ui.outputs)
+        self.assertEqual(2, Config().get_source('model').cached())
+
+    def test_fills_all_sources(self):
+        self.useFixture(SourceConfigFixture('model', 'model', reserve=1))
+        ui, cmd = self.get_test_ui_and_cmd()
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual(1, Config().get_source('model').cached())
+
+
+class TestCachesBelowReserve(TestCase):
+
+    def test_checks_pool_children(self):
+        store = memory.Store({})
+        child = cache.Cache('child', store, model.Source(None, None),
+            reserve=1)
+        other = cache.Cache('other', store, model.Source(None, None))
+        source = pool.Source({'sources': ['child', 'other']},
+            {'child': child, 'other': other}.__getitem__)
+        parent = cache.Cache('parent', store, source)
+        self.assertEqual(['child'], fill.caches_below_reserve([parent]))
+        child.fill_reserve()
+        self.assertEqual([], fill.caches_below_reserve([parent, child]))
@@ -0,0 +1,146 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the gc command."""
+
+import os
+import time
+
+from fixtures import MonkeyPatch
+from testtools.matchers import GreaterThan
+import yaml
+
+from cr_cache import cache
+from cr_cache.commands import gc
+from cr_cache.config import Config
+from cr_cache.store import notify, state_dir
+from cr_cache.store.lockfile import LockFile
+from cr_cache.ui.model import UI
+from cr_cache.tests import TestCase
+from cr_cache.tests.test_config import SourceConfigFixture
+
+
+class TestCommand(TestCase):
+
+    def get_test_ui_and_cmd(self,args=(), options=()):
+        ui = UI(args=args, options=options)
+        cmd = gc.gc(ui)
+        ui.set_command(cmd)
+        return ui, cmd
+
+    def test_collects_discarded(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        source = Config().get_source('model')
+        source.discard(source.provision(2))
+        ui, cmd = self.get_test_ui_and_cmd()
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual([], ui.outputs)
+        self.assertEqual(0, Config().get_source('model').discarding())
+
+    def test_collects_pool_children(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        # SourceConfigFixture always configures model sources.
+        pool_dir = os.path.join(
+            os.environ['HOME'], '.config', 'crcache', 'sources', 'pool')
+        os.makedirs(pool_dir)
+        with open(os.path.join(pool_dir, 'source.conf'), 'wt') as f:
+            yaml.safe_dump({'type': 'pool', 'sources': ['model']}, f)
+        conf = Config()
+        source = conf.get_source('pool')
+        source.discard(source.provision(2))
+        ui, cmd = self.get_test_ui_and_cmd()
+        self.assertEqual(0, cmd.execute())
+        conf = Config()
+        self.assertEqual(0, conf.get_source('pool').discarding())
+        self.assertEqual(0, conf.get_source('model').discarding())
+        self.assertEqual(0, conf.get_source('model').in_use())
+
+    def test_once(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        source = Config().get_source('model')
+        source.discard(source.provision(1))
+        ui, cmd = self.get_test_ui_and_cmd(options=[('once', True)])
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual(0, Config().get_source('model').discarding())
+
+    def test_reclaims_expired_leases(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        source = Config().get_source('model')
+        source.provision(1, lease=0)
+        ui, cmd = self.get_test_ui_and_cmd()
+        self.assertEqual(0, cmd.execute())
+        source = Config().get_source('model')
+        self.assertEqual(0, source.in_use())
+        self.assertEqual(0, source.discarding())
+
+    def test_failing_source_does_not_stop_others(self):
+        self.useFixture(SourceConfigFixture('good', 'model'))
+        self.useFixture(SourceConfigFixture('bad', 'model'))
+        conf = Config()
+        for name in ('bad', 'good'):
+            source = conf.get_source(name)
+            source.discard(source.provision(1))
+        collect = cache.Cache.collect
+        def fail_bad(self, now=None):
+            if self.name == 'bad':
+                raise ValueError('boom')
+            return collect(self, now)
+        self.useFixture(MonkeyPatch('cr_cache.cache.Cache.collect', fail_bad))
+        ui, cmd = self.get_test_ui_and_cmd(options=[('once', True)])
+        self.assertEqual(3, cmd.execute())
+        self.assertEqual(0, Config().get_source('good').discarding())
+        self.assertEqual(1, Config().get_source('bad').discarding())
+
+    def test_exits_when_already_running(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        source = Config().get_source('model')
+        source.discard(source.provision(1))
+        path = state_dir()
+        running = LockFile(os.path.join(path, 'gc.lck'),
+            os.path.join(path, 'gc.wlck'))
+        running.lock(True)
+        self.addCleanup(running.unlock)
+        ui, cmd = self.get_test_ui_and_cmd()
+        self.assertEqual(0, cmd.execute())
+        # Left for the running gc.
+        self.assertEqual(1, Config().get_source('model').discarding())
+
+    def test_wakes_for_new_discards(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        source = Config().get_source('model')
+        source.discard(source.provision(1))
+        collect = cache.Cache.collect
+        def retry_later(self, now=None):
+            # A retry is due in an hour.
+            collect(self, now)
+            return time.time() + 3600
+        self.useFixture(MonkeyPatch('cr_cache.cache.Cache.collect',
+            retry_later))
+        waits = []
+        real_wait_any = notify.wait_any
+        def wait_any(waiters, timeout):
+            waits.append((len(waiters), timeout))
+            self.useFixture(MonkeyPatch('cr_cache.cache.Cache.collect',
+                collect))
+            source.discard(source.provision(1))
+            return real_wait_any(waiters, 0)
+        self.useFixture(MonkeyPatch('cr_cache.store.notify.wait_any',
+            wait_any))
+        ui, cmd = self.get_test_ui_and_cmd()
+        self.assertEqual(0, cmd.execute())
+        # One waiter per source, woken by the discard long before the retry.
+        [(count, timeout)] = waits
+        self.assertEqual(2, count)
+        self.assertThat(timeout, GreaterThan(3000))
+        self.assertEqual(0, Config().get_source('model').discarding())
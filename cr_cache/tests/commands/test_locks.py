@@ -0,0 +1,57 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the locks command."""
+
+from cr_cache.commands import locks
+from cr_cache.config import Config
+from cr_cache.store import read_locked
+from cr_cache.ui.model import UI
+from cr_cache.tests import TestCase
+from cr_cache.tests.test_config import SourceConfigFixture
+
+
+class TestCommand(TestCase):
+
+    def get_test_ui_and_cmd(self,args=(), options=()):
+        ui = UI(args=args, options=options)
+        cmd = locks.locks(ui)
+        ui.set_command(cmd)
+        return ui, cmd
+
+    def test_no_stats(self):
+        ui, cmd = self.get_test_ui_and_cmd()
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual(
+            [('table', [
+                ('source', 'acquired', 'contended', 'timeouts', 'wait',
+                 'max-wait', 'hold', 'max-hold'),
+                ('local', '0', '0', '0', '0.000', '0.000', '0.000', '0.000'),
+                ]),
+            ], ui.outputs)
+
+    def test_shows_saved_stats(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        # Two processes' worth of locking add up.
+        acquired = 0
+        for _ in range(2):
+            store = Config().get_source('model').store
+            with read_locked(store):
+                pass
+            store.lock_stats.save()
+            acquired += store.lock_stats.acquired
+        ui, cmd = self.get_test_ui_and_cmd(args=['model'])
+        self.assertEqual(0, cmd.execute())
+        [(kind, table)] = ui.outputs
+        self.assertEqual(('model', str(acquired), '0', '0'), table[1][:4])
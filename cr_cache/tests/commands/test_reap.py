@@ -0,0 +1,78 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the reap command."""
+
+import os
+import time
+
+from fixtures import MonkeyPatch
+import yaml
+
+from cr_cache.commands import reap
+from cr_cache.config import Config
+from cr_cache.store import lockfile
+from cr_cache.ui.model import UI
+from cr_cache.tests import TestCase
+from cr_cache.tests.test_config import SourceConfigFixture
+
+
+class TestCommand(TestCase):
+
+    def setUp(self):
+        super(TestCommand, self).setUp()
+        self.spawned = []
+        self.useFixture(MonkeyPatch('cr_cache.commands.spawn',
+            lambda *args:self.spawned.append(args)))
+
+    def get_test_ui_and_cmd(self,args=(), options=()):
+        ui = UI(args=args, options=options)
+        cmd = reap.reap(ui)
+        ui.set_command(cmd)
+        return ui, cmd
+
+    def test_reaps_dead_owners(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        source = Config().get_source('model')
+        source.provision(1, owner=lockfile.process_record(2147483647))
+        source.provision(1, owner=lockfile.process_record())
+        ui, cmd = self.get_test_ui_and_cmd()
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual([], ui.outputs)
+        self.assertEqual(1, Config().get_source('model').in_use())
+        self.assertEqual([('gc',)], self.spawned)
+
+    def test_releases_named_owner(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        source = Config().get_source('model')
+        source.provision(2, owner=lockfile.process_record(os.getpid()))
+        ui, cmd = self.get_test_ui_and_cmd(args=['model'],
+            options=[('owner_pid', os.getpid())])
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual(0, Config().get_source('model').in_use())
+
+    def test_evicts_idle(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        path = os.path.join(os.environ['HOME'], '.config', 'crcache',
+            'sources', 'model', 'source.conf')
+        with open(path, 'wt') as f:
+            yaml.safe_dump({'type': 'model', 'reserve': 1,
+                'max_idle': 0.001}, f)
+        Config().get_source('model').fill_reserve()
+        time.sleep(0.002)
+        ui, cmd = self.get_test_ui_and_cmd()
+        self.assertEqual(0, cmd.execute())
+        source = Config().get_source('model')
+        self.assertEqual(0, source.cached())
+        self.assertEqual(1, source.discarding())
@@ -14,6 +14,9 @@
 
 """Tests for the acquire command."""
 
+from fixtures import MonkeyPatch
+
+from cr_cache import cache
 from cr_cache.commands import release
 from cr_cache.config import Config
 from cr_cache.ui.model import UI
@@ -23,6 +26,12 @@ from cr_cache.tests.test_config import SourceConfigFixture
 
 class TestCommand(TestCase):
 
+    def setUp(self):
+        super(TestCommand, self).setUp()
+        self.spawned = []
+        self.useFixture(MonkeyPatch('cr_cache.commands.spawn',
+            lambda *args:self.spawned.append(args)))
+
     def get_test_ui_and_cmd(self,args=(), options=()):
         ui = UI(args=args, options=options)
         cmd = release.release(ui)
@@ -38,3 +47,40 @@ class TestCommand(TestCase):
         result = cmd.execute()
         self.assertEqual([], ui.outputs)
         self.assertEqual(0, result)
+        # The resources are torn down in the background.
+        self.assertEqual(2, Config().get_source('model').discarding())
+        self.assertEqual([('gc',)], self.spawned)
+
+    def test_release_unknown_fails(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        resources = list(Config().get_source('model').provision(1))
+        ui, cmd = self.get_test_ui_and_cmd(args=resources + ['model-typo'])
+        self.assertEqual(3, cmd.execute())
+        self.assertEqual('error', ui.outputs[0][0])
+        self.assertEqual(1, Config().get_source('model').in_use())
+
+    def test_release_to_reserve_does_not_spawn_gc(self):
+        self.useFixture(SourceConfigFixture('model', 'model', reserve=1))
+        conf = Config()
+        resources = list(conf.get_source('model').provision(1))
+        ui, cmd = self.get_test_ui_and_cmd(args=resources)
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual([], self.spawned)
+
+    def test_failing_source_does_not_stop_others(self):
+        self.useFixture(SourceConfigFixture('good', 'model'))
+        self.useFixture(SourceConfigFixture('bad', 'model'))
+        conf = Config()
+        resources = (list(conf.get_source('bad').provision(1))
+            + list(conf.get_source('good').provision(2)))
+        discard = cache.Cache.discard
+        def fail_bad(self, instances, force=False):
+            if self.name == 'bad':
+                raise ValueError('boom')
+            return discard(self, instances, force)
+        self.useFixture(MonkeyPatch('cr_cache.cache.Cache.discard', fail_bad))
+        ui, cmd = self.get_test_ui_and_cmd(args=resources)
+        self.assertEqual(3, cmd.execute())
+        self.assertEqual('error', ui.outputs[0][0])
+        self.assertEqual(2, Config().get_source('good').discarding())
+        self.assertEqual([('gc',)], self.spawned)
@@ -0,0 +1,46 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the renew command."""
+
+from cr_cache.commands import renew
+from cr_cache.config import Config
+from cr_cache.ui.model import UI
+from cr_cache.tests import TestCase
+from cr_cache.tests.test_config import SourceConfigFixture
+
+
+class TestCommand(TestCase):
+
+    def get_test_ui_and_cmd(self,args=(), options=()):
+        ui = UI(args=args, options=options)
+        cmd = renew.renew(ui)
+        ui.set_command(cmd)
+        return ui, cmd
+
+    def test_renews(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        resources = list(Config().get_source('model').provision(2, lease=0))
+        ui, cmd = self.get_test_ui_and_cmd(args=resources,
+            options=[('lease', 60.0)])
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual([], ui.outputs)
+        self.assertEqual(0, Config().get_source('model').reclaim())
+
+    def test_unleased_fails(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        resources = list(Config().get_source('model').provision(1))
+        ui, cmd = self.get_test_ui_and_cmd(args=resources)
+        self.assertEqual(3, cmd.execute())
+        self.assertEqual('error', ui.outputs[0][0])
@@ -106,3 +106,11 @@ class TestCommand(TestCase):
         source.fill_reserve()
         cmd.execute()
         self.assertEqual([('rest', '1')], ui.outputs)
+
+    def test_query_in_use(self):
+        ui, cmd = self.get_test_ui_and_cmd(options=[('query', 'in-use')])
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        source = Config().get_source('model')
+        self.addCleanup(source.discard, source.provision(2))
+        cmd.execute()
+        self.assertEqual([('rest', '2')], ui.outputs)
@@ -0,0 +1,60 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the warm command."""
+
+from fixtures import MonkeyPatch
+
+from cr_cache.commands import warm
+from cr_cache.config import Config
+from cr_cache.store import write_locked
+from cr_cache.ui.model import UI
+from cr_cache.tests import TestCase
+from cr_cache.tests.test_config import SourceConfigFixture
+
+
+class TestCommand(TestCase):
+
+    def setUp(self):
+        super(TestCommand, self).setUp()
+        self.spawned = []
+        self.useFixture(MonkeyPatch('cr_cache.commands.spawn',
+            lambda *args:self.spawned.append(args)))
+
+    def get_test_ui_and_cmd(self,args=(), options=()):
+        ui = UI(args=args, options=options)
+        cmd = warm.warm(ui)
+        ui.set_command(cmd)
+        return ui, cmd
+
+    def test_warms_named_source(self):
+        self.useFixture(SourceConfigFixture('model', 'model', floor=2,
+            ceiling=4))
+        ui, cmd = self.get_test_ui_and_cmd(args=['model'])
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual([], ui.outputs)
+        self.assertEqual(2, Config().get_source('model').cached())
+        self.assertEqual([], self.spawned)
+
+    def test_shrinking_spawns_gc(self):
+        self.useFixture(SourceConfigFixture('model', 'model', ceiling=4))
+        source = Config().get_source('model')
+        with write_locked(source.store):
+            source.store['reserve-target/model'] = '2'
+        source.discard(source.provision(2))
+        self.assertEqual(2, source.cached())
+        ui, cmd = self.get_test_ui_and_cmd()
+        self.assertEqual(0, cmd.execute())
+        self.assertEqual(0, Config().get_source('model').cached())
+        self.assertEqual([('gc',)], self.spawned)
@@ -0,0 +1,53 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the crcache.policy interface."""
+
+from testtools.matchers import raises
+
+from cr_cache.policy import find_policy_type, fifo, priority
+from cr_cache.tests import TestCase
+
+
+class TestFIFO(TestCase):
+
+    def test_ignores_priority(self):
+        policy = fifo.Policy({})
+        self.assertTrue(policy.key(0, 1) < policy.key(10, 2))
+        self.assertEqual(4, policy.limit(0, 4))
+
+
+class TestPriority(TestCase):
+
+    def test_orders_by_priority_then_arrival(self):
+        policy = priority.Policy({})
+        requests = [(0, 1), (10, 3), (0, 2), (10, 4)]
+        requests.sort(key=lambda request:policy.key(*request))
+        self.assertEqual([(10, 3), (10, 4), (0, 1), (0, 2)], requests)
+
+    def test_reserved_capacity(self):
+        policy = priority.Policy({'reserved': {5: '1', 10: 2}})
+        self.assertEqual(1, policy.limit(0, 4))
+        self.assertEqual(2, policy.limit(5, 4))
+        self.assertEqual(4, policy.limit(10, 4))
+        self.assertEqual(0, policy.limit(0, 2))
+
+
+class TestHelpers(TestCase):
+
+    def test_find_policy_type(self):
+        self.assertEqual(fifo.Policy, find_policy_type('fifo'))
+
+    def test_find_policy_type_missing(self):
+        self.assertThat(lambda: find_policy_type('foo'), raises(ImportError))
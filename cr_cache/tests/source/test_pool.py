@@ -14,7 +14,11 @@
 
 """Tests for the crcache.source.pool module."""
 
-from testtools.matchers import Equals, MatchesAny
+import threading
+import time
+
+from fixtures import MonkeyPatch
+from testtools.matchers import Equals, MatchesAny, raises
 
 from cr_cache import cache
 from cr_cache.source import model, pool
@@ -60,6 +64,32 @@ class TestPoolSource(TestCase):
         self.assertEqual(set(['a-2']), sources['a'].provision(1))
         self.assertEqual(set(['b-1']), sources['b'].provision(1))
 
+    def test_children_sharing_a_store_use_one_thread(self):
+        # p draws from pools a and b, which both draw from x.
+        sources = {}
+        get_source = sources.__getitem__
+        sources['x'] = cache.Cache('x', memory.Store({}, 'x'),
+            model.Source(None, None), reserve=2)
+        sources['x'].fill_reserve()
+        for name in 'ab':
+            sources[name] = cache.Cache(name, memory.Store({}, name),
+                pool.Source({'sources': ['x']}, get_source))
+        threads = []
+        provision_from_cache = cache.Cache.provision_from_cache
+        def recording(self, count, check=True):
+            if self.name == 'x':
+                threads.append(threading.current_thread())
+                # Give another thread the chance to take the other child.
+                time.sleep(0.1)
+            return provision_from_cache(self, count, check)
+        self.useFixture(MonkeyPatch(
+            'cr_cache.cache.Cache.provision_from_cache', recording))
+        source = pool.Source(
+            {'sources': ['a', 'b'], 'strategy': 'round-robin'}, get_source)
+        self.assertEqual(set(['a-x-0', 'b-x-1']), set(source.provision(2)))
+        self.assertEqual(2, len(threads))
+        self.assertEqual(threads[0], threads[1])
+
     def test_sums_component_maximums(self):
         config = {}
         config['sources'] = ['a', 'b']
@@ -70,3 +100,159 @@ class TestPoolSource(TestCase):
         sources['b'] = cache.Cache('b', store, backend, maximum=2)
         source = pool.Source(config, sources.__getitem__)
         self.assertEqual(3, source.maximum)
+
+    def make_pool(self, backends, **config):
+        sources = {}
+        for name, backend in backends:
+            sources[name] = cache.Cache(
+                name, memory.Store({}, name), backend, maximum=1)
+        config['sources'] = [name for name, _ in backends]
+        return sources, pool.Source(config, sources.__getitem__)
+
+    def test_strategy_splits_new_instances(self):
+        sources, source = self.make_pool(
+            [('a', model.Source(None, None)), ('b', model.Source(None, None))],
+            strategy='latency')
+        source.strategy.observe(sources['a'], 1, 10.0)
+        self.assertEqual(['b-0'], source.provision(1))
+
+    def test_provisions_children_concurrently(self):
+        both = threading.Event()
+        class Waiting(model.Source):
+            def provision(self, count):
+                # Only returns in time if b is provisioned at the same time.
+                if not both.wait(10):
+                    raise ValueError('children provisioned one at a time')
+                return super(Waiting, self).provision(count)
+        class Signalling(model.Source):
+            def provision(self, count):
+                both.set()
+                return super(Signalling, self).provision(count)
+        sources, source = self.make_pool(
+            [('a', Waiting(None, None)), ('b', Signalling(None, None))])
+        self.assertEqual(set(['a-0', 'b-0']), set(source.provision(2)))
+
+    def test_health_checks_run_unlocked(self):
+        sources, source = self.make_pool(
+            [('a', model.Source(None, None)), ('b', model.Source(None, None))])
+        locks = []
+        def check(instance):
+            locks.append([sources[name].store._lock for name in 'ab'])
+            return True
+        now = time.time()
+        self.useFixture(MonkeyPatch('time.time', lambda:now))
+        for child in sources.values():
+            child.health_check = check
+            child.reserve = 1
+            child.fill_reserve()
+        now += child.check_ttl + 1
+        self.assertEqual(set(['a-0', 'b-0']), set(source.provision(2)))
+        # Neither child's store was held while the other was checked.
+        self.assertEqual([['u', 'u'], ['u', 'u']], locks)
+
+    def make_failing_pool(self, **config):
+        class Failing(model.Source):
+            def provision(self, count):
+                raise ValueError('boom')
+        return self.make_pool(
+            [('a', model.Source(None, None)), ('b', Failing(None, None))],
+            **config)
+
+    def test_partial_failure_rolls_back(self):
+        sources, source = self.make_failing_pool()
+        self.assertThat(lambda:source.provision(2), raises(ValueError))
+        self.assertEqual(0, sources['a'].in_use())
+        self.assertEqual(1, sources['a'].discarding())
+
+    def test_partial_failure_keeps(self):
+        sources, source = self.make_failing_pool(partial='keep')
+        self.assertEqual(['a-0'], source.provision(2))
+        self.assertEqual(1, sources['a'].in_use())
+
+    def test_partial_failure_keeps_nothing_fails(self):
+        sources, source = self.make_failing_pool(partial='keep')
+        sources['a'].provision(1)
+        self.assertThat(lambda:source.provision(1), raises(ValueError))
+
+    def test_unknown_partial_policy(self):
+        self.assertThat(
+            lambda:self.make_pool([], partial='maybe'), raises(ValueError))
+
+    def make_flaky_pool(self, **config):
+        class Flaky(model.Source):
+            broken = True
+            def provision(self, count):
+                if self.broken:
+                    raise ValueError('boom')
+                return super(Flaky, self).provision(count)
+        flaky = Flaky(None, None)
+        sources, source = self.make_pool(
+            [('a', flaky), ('b', model.Source(None, None)),
+             ('c', model.Source(None, None))], **config)
+        for child in sources.values():
+            child.maximum = 0
+        return flaky, sources, source
+
+    def test_failure_retried_on_other_children(self):
+        flaky, sources, source = self.make_flaky_pool()
+        self.assertEqual(set(['b-0', 'b-1']), set(source.provision(2)))
+        self.assertEqual(0, sources['a'].in_use())
+
+    def test_breaker_skips_failing_child(self):
+        flaky, sources, source = self.make_flaky_pool(breaker_failures=2)
+        source.provision(1)
+        source.provision(1)
+        calls = len(flaky._calls)
+        source.provision(1)
+        self.assertEqual(calls, len(flaky._calls))
+        # Other pools over the same children see the open breaker too.
+        other = pool.Source(
+            {'sources': ['a', 'b'], 'breaker_failures': 2},
+            sources.__getitem__)
+        other.provision(1)
+        self.assertEqual(calls, len(flaky._calls))
+
+    def test_breaker_probes_after_cooldown(self):
+        flaky, sources, source = self.make_flaky_pool(
+            breaker_failures=1, breaker_cooldown=60)
+        now = time.time()
+        self.useFixture(MonkeyPatch('time.time', lambda:now))
+        source.provision(1)
+        flaky.broken = False
+        self.assertEqual(['b-1'], source.provision(1))
+        now += 61
+        # The probe goes to a, and succeeds, closing the breaker.
+        self.assertEqual(['a-0'], source.provision(1))
+        self.assertEqual(['a-1'], source.provision(1))
+
+    def test_all_children_failing_fails(self):
+        flaky, sources, source = self.make_flaky_pool()
+        source = pool.Source({'sources': ['a'], 'breaker_failures': 1},
+            sources.__getitem__)
+        self.assertThat(lambda:source.provision(1), raises(ValueError))
+        # Once the breaker is open, there is nothing to provision from.
+        self.assertThat(lambda:source.provision(1), raises(ValueError(
+            'All children unavailable (circuit open).')))
+
+    def test_open_breakers_roll_back(self):
+        flaky, sources, source = self.make_flaky_pool()
+        source = pool.Source({'sources': ['a', 'b'], 'breaker_failures': 1},
+            sources.__getitem__)
+        self.assertEqual(['b-0'], source.provision(1))
+        sources['b'].maximum = 2
+        # b can provide one of the two, and a's breaker is open.
+        self.assertThat(lambda:source.provision(2), raises(ValueError(
+            'All children unavailable (circuit open).')))
+        self.assertEqual(1, sources['b'].in_use())
+        self.assertEqual(1, sources['b'].discarding())
+
+    def test_discard_failure_does_not_stop_other_children(self):
+        sources, source = self.make_pool(
+            [('a', model.Source(None, None)), ('b', model.Source(None, None))])
+        instances = source.provision(2)
+        def fail(instances, force=False):
+            raise ValueError('boom')
+        sources['a'].discard = fail
+        self.assertThat(lambda:source.discard(instances), raises(ValueError))
+        self.assertEqual(1, sources['a'].in_use())
+        self.assertEqual(0, sources['b'].in_use())
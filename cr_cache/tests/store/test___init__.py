@@ -15,20 +15,40 @@
 """Tests for the store contract and common facilities."""
 
 from functools import partial
+import os.path
 
 from testtools.matchers import raises
 
-from cr_cache.store import local, memory, read_locked, write_locked
+from cr_cache.store import (
+    LockStats,
+    journal,
+    local,
+    memory,
+    read_locked,
+    read_locked_all,
+    sqlite,
+    stats_path,
+    write_locked,
+    write_locked_all,
+    )
 from cr_cache.tests import TestCase
+from cr_cache.tests.store.test_daemon import DaemonFixture
 
-def memory_factory():
+def memory_factory(test):
     backend = {}
     return partial(memory.Store, backend)
 
+def daemon_factory(test):
+    fixture = test.useFixture(DaemonFixture())
+    return fixture.client
+
 # what implementations do we need to test?
 store_implementations = [
-    ('Local', {'store_factory_factory': lambda:local.Store}),
+    ('Local', {'store_factory_factory': lambda test:local.Store}),
     ('Memory', {'store_factory_factory': memory_factory}),
+    ('Sqlite', {'store_factory_factory': lambda test:sqlite.Store}),
+    ('Journal', {'store_factory_factory': lambda test:journal.Store}),
+    ('Daemon', {'store_factory_factory': daemon_factory}),
     ]
 
 
@@ -38,7 +58,7 @@ class TestStoreContract(TestCase):
 
     def make_store(self):
         if not getattr(self, 'store_factory', None):
-            self.store_factory = self.store_factory_factory()
+            self.store_factory = self.store_factory_factory(self)
         return self.store_factory()
 
     def test_put(self):
@@ -118,6 +138,68 @@ class TestStoreContract(TestCase):
         s.lock_read()
         s.unlock()
 
+    def test_set_missing_is_empty(self):
+        s = self.make_store()
+        with read_locked(s):
+            self.assertEqual(set(), s.smembers('pool/foo'))
+            self.assertEqual(0, s.scard('pool/foo'))
+            self.assertFalse(s.sismember('pool/foo', 'a'))
+
+    def test_sadd(self):
+        s = self.make_store()
+        s2 = self.make_store()
+        with write_locked(s):
+            s.sadd('pool/foo', ['a', 'b'])
+            s.sadd('pool/foo', ['b', 'c'])
+        with read_locked(s2):
+            self.assertEqual(set(['a', 'b', 'c']), s2.smembers('pool/foo'))
+            self.assertEqual(3, s2.scard('pool/foo'))
+            self.assertTrue(s2.sismember('pool/foo', 'b'))
+            # Sets are independent of each other.
+            self.assertEqual(0, s2.scard('pool/bar'))
+
+    def test_srem(self):
+        s = self.make_store()
+        s2 = self.make_store()
+        with write_locked(s):
+            s.sadd('pool/foo', ['a', 'b', 'c'])
+            s.srem('pool/foo', ['a', 'c', 'd'])
+        with read_locked(s2):
+            self.assertEqual(set(['b']), s2.smembers('pool/foo'))
+            self.assertEqual(1, s2.scard('pool/foo'))
+            self.assertFalse(s2.sismember('pool/foo', 'a'))
+
+    def test_srem_all(self):
+        s = self.make_store()
+        with write_locked(s):
+            s.sadd('pool/foo', ['a', 'b', 'c'])
+            s.srem('pool/foo', ['c', 'a', 'b'])
+            s.sadd('pool/foo', ['d'])
+        with read_locked(s):
+            self.assertEqual(set(['d']), s.smembers('pool/foo'))
+
+    def test_smembers_limit(self):
+        s = self.make_store()
+        with write_locked(s):
+            s.sadd('pool/foo', ['a', 'b', 'c'])
+        with read_locked(s):
+            members = s.smembers('pool/foo', limit=2)
+            self.assertEqual(2, len(members))
+            self.assertTrue(members.issubset(set(['a', 'b', 'c'])))
+            self.assertEqual(3, len(s.smembers('pool/foo', limit=5)))
+
+    def test_sdiff_count(self):
+        s = self.make_store()
+        with write_locked(s):
+            s.sadd('pool/foo', ['a', 'b', 'c'])
+            s.sadd('allocated/foo', ['b'])
+            s.sadd('other/foo', ['a', 'b', 'd', 'e'])
+        with read_locked(s):
+            self.assertEqual(2, s.sdiff_count('pool/foo', 'allocated/foo'))
+            self.assertEqual(0, s.sdiff_count('allocated/foo', 'pool/foo'))
+            self.assertEqual(1, s.sdiff_count('pool/foo', 'other/foo'))
+            self.assertEqual(3, s.sdiff_count('pool/foo', 'missing/foo'))
+
 
 class TestDecorators(TestCase):
 
@@ -134,3 +216,68 @@ class TestDecorators(TestCase):
         with write_locked(s):
             self.assertEqual('w', s._lock)
         self.assertEqual('u', s._lock)
+
+    def test_write_locked_all_locks_in_shard_order(self):
+        order = []
+        class RecordingStore(memory.Store):
+            def lock_write(self):
+                order.append(self.shard)
+                super(RecordingStore, self).lock_write()
+        stores = [RecordingStore({}, 'b'), RecordingStore({}),
+            RecordingStore({}, 'a')]
+        with write_locked_all(stores):
+            self.assertEqual(['w', 'w', 'w'], [s._lock for s in stores])
+        self.assertEqual([None, 'a', 'b'], order)
+        self.assertEqual(['u', 'u', 'u'], [s._lock for s in stores])
+
+    def test_read_locked_all_locks_each_store_once(self):
+        order = []
+        class RecordingStore(memory.Store):
+            def lock_read(self):
+                order.append(self.shard)
+                super(RecordingStore, self).lock_read()
+        a = RecordingStore({}, 'a')
+        stores = [RecordingStore({}, 'b'), a, RecordingStore({}), a]
+        with read_locked_all(stores):
+            self.assertEqual(['r', 'r', 'r', 'r'], [s._lock for s in stores])
+        self.assertEqual([None, 'a', 'b'], order)
+        self.assertEqual(['u', 'u', 'u', 'u'], [s._lock for s in stores])
+
+    def test_write_locked_all_aborts_every_store(self):
+        stores = [local.Store(shard='b'), local.Store(shard='a')]
+        def fail():
+            with write_locked_all(stores):
+                for store in stores:
+                    store['foo'] = 'bar'
+                raise ValueError('boom')
+        self.assertThat(fail, raises(ValueError))
+        for store in stores:
+            with read_locked(store):
+                self.assertThat(lambda:store['foo'], raises(KeyError))
+
+
+class TestLockStats(TestCase):
+
+    def test_save_adds_to_saved_totals(self):
+        path = stats_path('foo')
+        os.makedirs(os.path.dirname(path))
+        for wait in (0.5, 2.0):
+            stats = LockStats(path)
+            stats.waited(wait, True)
+            stats.held(1.0)
+            stats.save()
+            # Saving again only adds what was recorded since.
+            stats.save()
+        totals = LockStats.load(path)
+        self.assertEqual((2, 2, 0, 2.5, 2.0, 2.0, 1.0),
+            (totals.acquired, totals.contended, totals.timeouts,
+             totals.wait_time, totals.max_wait, totals.hold_time,
+             totals.max_hold))
+
+    def test_load_missing(self):
+        self.assertEqual(0, LockStats.load(stats_path('foo')).acquired)
+
+    def test_save_without_path_is_ignored(self):
+        stats = LockStats()
+        stats.waited(1.0, False)
+        stats.save()
@@ -0,0 +1,206 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests and test support for the daemon store."""
+
+import json
+import socket
+import threading
+
+from fixtures import Fixture
+from testtools.matchers import IsInstance, raises
+
+from cr_cache.store import (
+    daemon,
+    local,
+    LockTimeout,
+    read_locked,
+    write_locked,
+    )
+from cr_cache.tests import TestCase
+
+
+class DaemonFixture(Fixture):
+    """Runs a daemon Server in a thread."""
+
+    def __init__(self, persist_interval=0.5):
+        super(DaemonFixture, self).__init__()
+        self._persist_interval = persist_interval
+
+    def setUp(self):
+        super(DaemonFixture, self).setUp()
+        self.server = daemon.Server(persist_interval=self._persist_interval)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+        self.addCleanup(self.stop)
+        self.server.ready.wait(10)
+
+    def stop(self):
+        self.server.stop()
+        self.thread.join()
+
+    def client(self, lock_timeout=60, shard=None):
+        """Return a connected Client, closed when the fixture is cleaned up."""
+        client = daemon.Client(lock_timeout=lock_timeout, shard=shard)
+        self.addCleanup(client.close)
+        return client
+
+
+class TestDaemonStore(TestCase):
+
+    def test_falls_back_to_local_store(self):
+        self.assertThat(daemon.Store(), IsInstance(local.Store))
+
+    def test_connects_to_daemon(self):
+        fixture = self.useFixture(DaemonFixture())
+        store = daemon.Store()
+        self.addCleanup(store.close)
+        self.assertThat(store, IsInstance(daemon.Client))
+
+    def test_writer_waits_for_reader(self):
+        fixture = self.useFixture(DaemonFixture())
+        reader = fixture.client()
+        writer = fixture.client(lock_timeout=0.01)
+        with read_locked(reader):
+            self.assertThat(writer.lock_write, raises(LockTimeout))
+        with write_locked(writer):
+            writer['foo'] = 'bar'
+
+    def test_waiting_writer_holds_back_new_readers(self):
+        fixture = self.useFixture(DaemonFixture())
+        reader = fixture.client()
+        writer = fixture.client()
+        late_reader = fixture.client(lock_timeout=0.05)
+        reader.lock_read()
+        waiter = threading.Thread(target=writer.lock_write)
+        waiter.start()
+        try:
+            # Let the writer queue before the late reader asks.
+            while not fixture.server._shards[None].queue:
+                waiter.join(0.001)
+            self.assertThat(late_reader.lock_read, raises(LockTimeout))
+        finally:
+            reader.unlock()
+            waiter.join()
+            writer.unlock()
+
+    def test_disconnect_aborts_and_releases(self):
+        fixture = self.useFixture(DaemonFixture())
+        store = daemon.Client()
+        store.lock_write()
+        store['foo'] = 'bar'
+        store.close()
+        store2 = fixture.client(lock_timeout=1)
+        with read_locked(store2):
+            self.assertThat(lambda:store2['foo'], raises(KeyError))
+
+    def test_persists_to_local_store(self):
+        fixture = self.useFixture(DaemonFixture(persist_interval=60))
+        store = fixture.client()
+        with write_locked(store):
+            store['foo'] = 'bar'
+            store.sadd('pool/foo', ['a', 'b'])
+        fixture.stop()
+        # With the daemon gone, the local store sees its state.
+        store2 = daemon.Store()
+        self.assertThat(store2, IsInstance(local.Store))
+        with read_locked(store2):
+            self.assertEqual('bar', store2['foo'])
+            self.assertEqual(set(['a', 'b']), store2.smembers('pool/foo'))
+
+    def test_loads_local_store(self):
+        store = local.Store()
+        with write_locked(store):
+            store['foo'] = 'bar'
+        fixture = self.useFixture(DaemonFixture())
+        store2 = fixture.client()
+        with read_locked(store2):
+            self.assertEqual('bar', store2['foo'])
+
+    def test_shards_lock_independently(self):
+        fixture = self.useFixture(DaemonFixture())
+        store = fixture.client(shard='a')
+        other = fixture.client(lock_timeout=0.01, shard='b')
+        same = fixture.client(lock_timeout=0.01, shard='a')
+        with write_locked(store):
+            store['foo'] = 'bar'
+            with write_locked(other):
+                self.assertThat(lambda:other['foo'], raises(KeyError))
+            self.assertThat(same.lock_read, raises(LockTimeout))
+
+    def test_persists_shards_separately(self):
+        fixture = self.useFixture(DaemonFixture(persist_interval=60))
+        store = fixture.client(shard='a')
+        with write_locked(store):
+            store['foo'] = 'bar'
+        fixture.stop()
+        store_a = local.Store(shard='a')
+        with read_locked(store_a):
+            self.assertEqual('bar', store_a['foo'])
+        store_b = local.Store(shard='b')
+        with read_locked(store_b):
+            self.assertThat(lambda:store_b['foo'], raises(KeyError))
+
+    def test_bad_requests_fail_alone(self):
+        fixture = self.useFixture(DaemonFixture())
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.connect(daemon.socket_path())
+        conn = sock.makefile('rwb')
+        conn.write(b'not json\n')
+        conn.flush()
+        self.assertIn('error', json.loads(conn.readline().decode('utf8')))
+        store = fixture.client()
+        with write_locked(store):
+            # Errors the client has no type for are IOErrors.
+            self.assertThat(lambda:store._call('get'), raises(IOError))
+            store['foo'] = 'bar'
+        with read_locked(store):
+            self.assertEqual('bar', store['foo'])
+
+    def test_loading_shard_does_not_stall_others(self):
+        fixture = self.useFixture(DaemonFixture())
+        # Another process holds the shard.
+        busy = local.Store(shard='busy')
+        busy.lock_write()
+        clients = []
+        connecting = threading.Thread(
+            target=lambda:clients.append(fixture.client(shard='busy')))
+        connecting.start()
+        try:
+            while not fixture.server._shards.get('busy', None) or not (
+                fixture.server._shards['busy'].loading):
+                connecting.join(0.001)
+            store = fixture.client(lock_timeout=1)
+            with write_locked(store):
+                store['foo'] = 'bar'
+        finally:
+            busy.unlock()
+            connecting.join()
+        with write_locked(clients[0]):
+            clients[0]['foo'] = 'baz'
+
+    def test_lock_stats(self):
+        fixture = self.useFixture(DaemonFixture())
+        store = fixture.client()
+        store2 = fixture.client(lock_timeout=0.01)
+        with write_locked(store):
+            self.assertThat(store2.lock_read, raises(LockTimeout))
+        with read_locked(store2):
+            with read_locked(store2):
+                pass
+        self.assertEqual((1, 0), (store.lock_stats.acquired,
+            store.lock_stats.contended))
+        self.assertEqual((1, 1, 1), (store2.lock_stats.acquired,
+            store2.lock_stats.contended, store2.lock_stats.timeouts))
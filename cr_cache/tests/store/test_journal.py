@@ -0,0 +1,116 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the journal store implementation."""
+
+import os.path
+
+from testtools.matchers import raises
+
+from cr_cache.store import journal, read_locked, write_locked
+from cr_cache.tests import TestCase
+
+
+class TestJournalStore(TestCase):
+
+    def segment(self, store, segment=0):
+        return os.path.join(store.path, 'journal.%d' % segment)
+
+    def test_writes_append(self):
+        store = journal.Store()
+        with write_locked(store):
+            store['foo'] = 'bar'
+            store.sadd('pool/foo', ['a', 'b'])
+        with open(self.segment(store), 'rb') as f:
+            first = f.read()
+        with write_locked(store):
+            del store['foo']
+            store.srem('pool/foo', ['a'])
+        with open(self.segment(store), 'rb') as f:
+            both = f.read()
+        self.assertTrue(both.startswith(first))
+        self.assertEqual(4, len(both.splitlines()))
+
+    def test_torn_record_ignored_and_truncated(self):
+        store = journal.Store()
+        with write_locked(store):
+            store['foo'] = 'bar'
+        # A writer died part way through appending.
+        with open(self.segment(store), 'ab') as f:
+            f.write(b'["set", "foo", "ba')
+        store2 = journal.Store()
+        with read_locked(store2):
+            self.assertEqual('bar', store2['foo'])
+        with write_locked(store2):
+            store2['other'] = 'thing'
+        store3 = journal.Store()
+        with read_locked(store3):
+            self.assertEqual('bar', store3['foo'])
+            self.assertEqual('thing', store3['other'])
+
+    def test_exception_discards_writes(self):
+        store = journal.Store()
+        with write_locked(store):
+            store.sadd('pool/foo', ['a'])
+        def fail():
+            with write_locked(store):
+                store.sadd('pool/foo', ['b'])
+                raise ValueError('boom')
+        with write_locked(store):
+            store['outer'] = 'value'
+            self.assertThat(fail, raises(ValueError))
+        store2 = journal.Store()
+        for s in (store, store2):
+            with read_locked(s):
+                self.assertEqual(set(['a']), s.smembers('pool/foo'))
+                self.assertEqual('value', s['outer'])
+
+    def test_compact(self):
+        store = journal.Store()
+        reader = journal.Store()
+        with write_locked(store):
+            store['foo'] = 'bar'
+            store['gone'] = 'soon'
+            store.sadd('pool/foo', ['a', 'b'])
+        with read_locked(reader):
+            self.assertEqual('bar', reader['foo'])
+        with write_locked(store):
+            del store['gone']
+            store.srem('pool/foo', ['b'])
+        self.assertTrue(store.compact())
+        self.assertEqual(
+            ['journal.1', 'snapshot.1'],
+            sorted(name for name in os.listdir(store.path)
+                if '.' in name and not name.endswith('lock')))
+        with write_locked(store):
+            store['after'] = 'compaction'
+        # Both a Store that saw the old journal and a fresh one agree.
+        for s in (reader, journal.Store()):
+            with read_locked(s):
+                self.assertEqual('bar', s['foo'])
+                self.assertEqual('compaction', s['after'])
+                self.assertThat(lambda:s['gone'], raises(KeyError))
+                self.assertEqual(set(['a']), s.smembers('pool/foo'))
+
+    def test_compaction_triggered_by_size(self):
+        store = journal.Store(compact_threshold=0)
+        with write_locked(store):
+            store['foo'] = 'bar'
+        # Exiting does not wait for compaction.
+        self.assertTrue(store._compactor.daemon)
+        store._compactor.join()
+        self.assertTrue(
+            os.path.exists(os.path.join(store.path, 'snapshot.1')))
+        with read_locked(journal.Store()) as s:
+            self.assertEqual('bar', s['foo'])
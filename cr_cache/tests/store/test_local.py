@@ -14,9 +14,14 @@
 
 """Tests for the local store implementation."""
 
+import fcntl
 import os.path
 
-from cr_cache.store import local
+from extras import try_imports
+dbm = try_imports(['dbm', 'dbm.ndbm'])
+from testtools.matchers import raises
+
+from cr_cache.store import local, LockTimeout, read_locked, write_locked
 from cr_cache.tests import TestCase
 
 
@@ -28,3 +33,159 @@ class TestLocalStore(TestCase):
         store = local.Store()
         self.assertTrue(
             os.path.exists(os.path.expanduser('~/.cache/crcache/state.db')))
+
+    def test_concurrent_readers(self):
+        store = local.Store(lock_timeout=0)
+        store2 = local.Store(lock_timeout=0)
+        with read_locked(store):
+            with read_locked(store2):
+                pass
+
+    def test_construct_while_locked(self):
+        store = local.Store(lock_timeout=0)
+        with read_locked(store):
+            # Once the dbm exists, making a store does not lock.
+            store2 = local.Store(lock_timeout=0)
+            with read_locked(store2):
+                pass
+
+    def test_writer_waits_for_reader(self):
+        store = local.Store(lock_timeout=0)
+        store2 = local.Store(lock_timeout=0.01)
+        with read_locked(store):
+            self.assertThat(store2.lock_write, raises(LockTimeout))
+        # Once the reader is gone the writer can proceed.
+        with write_locked(store2):
+            pass
+
+    def test_reader_waits_for_writer(self):
+        store = local.Store(lock_timeout=0)
+        store2 = local.Store(lock_timeout=0.01)
+        with write_locked(store):
+            self.assertThat(store2.lock_read, raises(LockTimeout))
+
+    def test_read_lock_not_upgradable(self):
+        store = local.Store()
+        with read_locked(store):
+            self.assertThat(store.lock_write, raises(AssertionError))
+            # The read lock is still held and usable.
+            self.assertThat(lambda:store['missing'], raises(KeyError))
+
+    def test_waiting_writer_holds_back_new_readers(self):
+        store = local.Store(lock_timeout=0.01)
+        # A writer queued behind existing readers holds the turnstile.
+        fd = os.open(store.dbm_turnstile, os.O_RDWR)
+        self.addCleanup(os.close, fd)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self.assertThat(store.lock_read, raises(LockTimeout))
+
+    def test_writes_buffered_until_unlock(self):
+        store = local.Store()
+        with write_locked(store):
+            store['foo'] = 'bar'
+            # Reads see the buffered write, but the dbm does not have it yet.
+            self.assertEqual('bar', store['foo'])
+            db = dbm.open(store.dbm_path, 'r')
+            self.addCleanup(db.close)
+            self.assertThat(lambda:db['foo'], raises(KeyError))
+            del store['foo']
+            self.assertThat(lambda:store['foo'], raises(KeyError))
+            store['foo'] = 'baz'
+        with read_locked(store):
+            self.assertEqual('baz', store['foo'])
+
+    def test_exception_discards_writes(self):
+        store = local.Store()
+        with write_locked(store):
+            store['foo'] = 'bar'
+        def fail():
+            with write_locked(store):
+                store['foo'] = 'quux'
+                store['other'] = 'thing'
+                raise ValueError('boom')
+        self.assertThat(fail, raises(ValueError))
+        with read_locked(store):
+            self.assertEqual('bar', store['foo'])
+            self.assertThat(lambda:store['other'], raises(KeyError))
+
+    def test_nested_abort_keeps_outer_writes(self):
+        store = local.Store()
+        def fail():
+            with write_locked(store):
+                store['inner'] = 'value'
+                raise ValueError('boom')
+        with write_locked(store):
+            store['outer'] = 'value'
+            self.assertThat(fail, raises(ValueError))
+        with read_locked(store):
+            self.assertEqual('value', store['outer'])
+            self.assertThat(lambda:store['inner'], raises(KeyError))
+
+    def test_repeat_reads_do_not_reopen(self):
+        store = local.Store()
+        with write_locked(store):
+            store['foo'] = 'bar'
+        with read_locked(store):
+            self.assertThat(lambda:store['missing'], raises(KeyError))
+        opens = []
+        real_open = dbm.open
+        def counting_open(*args):
+            opens.append(args)
+            return real_open(*args)
+        self.patch(dbm, 'open', counting_open)
+        for _ in range(3):
+            with read_locked(store):
+                self.assertEqual('bar', store['foo'])
+                self.assertThat(lambda:store['missing'], raises(KeyError))
+        self.assertEqual([], opens)
+
+    def test_other_writers_invalidate_cache(self):
+        store = local.Store()
+        store2 = local.Store()
+        with write_locked(store):
+            store['foo'] = 'bar'
+        with read_locked(store):
+            self.assertEqual('bar', store['foo'])
+            self.assertThat(lambda:store['new'], raises(KeyError))
+        with write_locked(store2):
+            store2['foo'] = 'baz'
+            store2['new'] = 'value'
+        with read_locked(store):
+            self.assertEqual('baz', store['foo'])
+            self.assertEqual('value', store['new'])
+
+    def test_flush_keeps_lock(self):
+        store = local.Store()
+        store2 = local.Store(lock_timeout=0)
+        with write_locked(store):
+            store['foo'] = 'bar'
+            store.flush()
+            db = dbm.open(store.dbm_path, 'r')
+            self.addCleanup(db.close)
+            self.assertEqual(b'bar', db['foo'])
+            self.assertThat(store2.lock_read, raises(LockTimeout))
+
+    def test_keys(self):
+        store = local.Store()
+        with write_locked(store):
+            store['foo'] = 'bar'
+            store['gone'] = 'soon'
+        with write_locked(store):
+            del store['gone']
+            store['new'] = 'value'
+            self.assertEqual(set(['foo', 'new']), store.keys())
+
+    def test_shards_lock_independently(self):
+        store = local.Store(lock_timeout=0, shard='a')
+        store2 = local.Store(lock_timeout=0, shard='b')
+        store3 = local.Store(lock_timeout=0, shard='a')
+        with write_locked(store):
+            store['foo'] = 'bar'
+            with write_locked(store2):
+                store2['foo'] = 'quux'
+            self.assertThat(store3.lock_read, raises(LockTimeout))
+        with read_locked(store3):
+            self.assertEqual('bar', store3['foo'])
+        self.assertEqual(
+            os.path.expanduser('~/.cache/crcache/shards/a/state'),
+            store.dbm_path)
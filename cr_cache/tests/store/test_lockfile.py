@@ -0,0 +1,140 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for file based reader/writer locking."""
+
+import os
+import socket
+import os.path
+import subprocess
+import sys
+import time
+
+from fixtures import MonkeyPatch, TempDir
+from testtools.matchers import raises
+
+from cr_cache.store import lockfile, LockTimeout
+from cr_cache.tests import TestCase
+
+
+def dead_pid():
+    """Return the pid of a process that has exited."""
+    proc = subprocess.Popen([sys.executable, '-c', ''])
+    proc.wait()
+    return proc.pid
+
+
+class TestLockFile(TestCase):
+
+    def make_lock(self, timeout=0):
+        path = self.useFixture(TempDir()).path
+        return lockfile.LockFile(os.path.join(path, 'lock'),
+            os.path.join(path, 'wlock'), timeout)
+
+    def test_writer_recorded_as_owner(self):
+        lock = self.make_lock()
+        lock.lock(True)
+        try:
+            with open(lock.path, 'rt') as f:
+                self.assertEqual(lockfile._owner(), f.read())
+        finally:
+            lock.unlock()
+        with open(lock.path, 'rt') as f:
+            self.assertEqual('', f.read())
+
+    def test_timeout_names_holder(self):
+        lock = self.make_lock()
+        lock2 = lockfile.LockFile(lock.path, lock.turnstile, 0.01)
+        lock.lock(True)
+        try:
+            e = self.assertRaises(LockTimeout, lock2.lock, False)
+        finally:
+            lock.unlock()
+        self.assertEqual('held by pid %d on' % os.getpid(),
+            e.args[1].rsplit(' ', 1)[0])
+
+    def test_stats(self):
+        lock = self.make_lock()
+        lock2 = lockfile.LockFile(lock.path, lock.turnstile, 0.01)
+        lock.lock(True)
+        try:
+            time.sleep(0.01)
+            self.assertThat(lambda:lock2.lock(True), raises(LockTimeout))
+        finally:
+            lock.unlock()
+        lock2.lock(False)
+        lock2.unlock()
+        self.assertEqual(1, lock.stats.acquired)
+        self.assertEqual(0, lock.stats.contended)
+        self.assertTrue(lock.stats.hold_time >= 0.01)
+        self.assertEqual(lock.stats.hold_time, lock.stats.max_hold)
+        self.assertEqual(1, lock2.stats.acquired)
+        self.assertEqual(1, lock2.stats.timeouts)
+        self.assertEqual(1, lock2.stats.contended)
+        self.assertTrue(lock2.stats.wait_time >= 0.01)
+
+
+class TestLockFileWithoutFlock(TestCase):
+
+    def setUp(self):
+        super(TestLockFileWithoutFlock, self).setUp()
+        self.useFixture(MonkeyPatch('cr_cache.store.lockfile.fcntl', None))
+        path = self.useFixture(TempDir()).path
+        self.lock = lockfile.LockFile(os.path.join(path, 'lock'),
+            os.path.join(path, 'wlock'), 0.01)
+
+    def write_owner(self, owner):
+        with open(self.lock.path, 'wt') as f:
+            f.write(owner)
+
+    def test_exclusive(self):
+        lock2 = lockfile.LockFile(self.lock.path, self.lock.turnstile, 0.01)
+        self.lock.lock(False)
+        try:
+            self.assertThat(lambda:lock2.lock(False), raises(LockTimeout))
+        finally:
+            self.lock.unlock()
+        self.assertFalse(os.path.exists(self.lock.path))
+
+    def test_dead_owner_reclaimed(self):
+        self.write_owner('%s %d -\n' % (socket.gethostname(), dead_pid()))
+        self.lock.lock(True)
+        self.assertEqual(lockfile._owner(), lockfile._read_owner(
+            self.lock.path))
+        self.lock.unlock()
+        self.assertEqual(1, self.lock.stats.contended)
+
+    def test_reused_pid_reclaimed(self):
+        self.write_owner('%s %d 1\n' % (socket.gethostname(), os.getpid()))
+        if lockfile._start_time(os.getpid()) == '-':
+            self.skipTest('process start times unavailable')
+        self.lock.lock(True)
+        self.lock.unlock()
+
+    def test_live_owner_kept(self):
+        self.write_owner(lockfile._owner())
+        self.assertThat(lambda:self.lock.lock(True), raises(LockTimeout))
+        self.assertTrue(os.path.exists(self.lock.path))
+
+    def test_other_host_kept(self):
+        self.write_owner('elsewhere.invalid %d -\n' % dead_pid())
+        self.assertThat(lambda:self.lock.lock(True), raises(LockTimeout))
+
+    def test_unowned_reclaimed_after_grace(self):
+        self.write_owner('')
+        self.assertThat(lambda:self.lock.lock(True), raises(LockTimeout))
+        old = time.time() - lockfile._UNOWNED_GRACE - 1
+        os.utime(self.lock.path, (old, old))
+        self.lock.lock(True)
+        self.lock.unlock()
@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for waking waiting processes."""
+
+import os.path
+
+from fixtures import TempDir
+
+from cr_cache.store import notify
+from cr_cache.tests import TestCase
+
+
+class TestNotify(TestCase):
+
+    def make_waiter(self, name='1'):
+        self.directory = os.path.join(self.useFixture(TempDir()).path, 'w')
+        waiter = notify.Waiter(os.path.join(self.directory, name))
+        self.addCleanup(waiter.close)
+        return waiter
+
+    def test_wait_times_out(self):
+        waiter = self.make_waiter()
+        self.assertEqual(False, waiter.wait(0.01))
+
+    def test_notify_wakes(self):
+        waiter = self.make_waiter()
+        notify.notify(self.directory)
+        notify.notify(self.directory)
+        self.assertEqual(True, waiter.wait(5))
+        # Both wakeups were consumed.
+        self.assertEqual(False, waiter.wait(0))
+
+    def test_notify_skips_pipes_without_readers(self):
+        waiter = self.make_waiter()
+        os.mkfifo(os.path.join(self.directory, 'abandoned'))
+        notify.notify(self.directory)
+        self.assertEqual(True, waiter.wait(5))
+
+    def test_notify_missing_directory(self):
+        notify.notify(os.path.join(self.useFixture(TempDir()).path, 'w'))
+
+    def test_close_removes_pipe(self):
+        waiter = self.make_waiter()
+        waiter.close()
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_wait_any(self):
+        waiter = self.make_waiter()
+        other = notify.Waiter(os.path.join(self.directory, '2'))
+        self.addCleanup(other.close)
+        self.assertEqual(False, notify.wait_any([waiter, other], 0.01))
+        notify.notify(self.directory)
+        self.assertEqual(True, notify.wait_any([waiter, other], 5))
+        # Every waiter's wakeup was consumed.
+        self.assertEqual(False, waiter.wait(0))
+        self.assertEqual(False, other.wait(0))
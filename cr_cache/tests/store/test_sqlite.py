@@ -0,0 +1,139 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the sqlite store implementation."""
+
+import os.path
+import threading
+
+from testtools.matchers import raises
+
+from cr_cache.store import LockTimeout, read_locked, sqlite, write_locked
+from cr_cache.tests import TestCase
+
+
+class TestSqliteStore(TestCase):
+
+    def test_db_in_homedir(self):
+        path = os.path.expanduser('~/.cache/crcache/state.sqlite')
+        self.assertFalse(os.path.exists(path))
+        store = sqlite.Store()
+        self.assertTrue(os.path.exists(path))
+
+    def test_wal_mode(self):
+        store = sqlite.Store()
+        self.assertEqual(
+            'wal', store._db.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def test_reader_does_not_block_writer(self):
+        store = sqlite.Store(lock_timeout=0)
+        store2 = sqlite.Store(lock_timeout=0)
+        with read_locked(store):
+            self.assertThat(lambda:store['foo'], raises(KeyError))
+            with write_locked(store2):
+                store2['foo'] = 'bar'
+        with read_locked(store):
+            self.assertEqual('bar', store['foo'])
+
+    def test_writers_exclusive(self):
+        store = sqlite.Store(lock_timeout=0)
+        store2 = sqlite.Store(lock_timeout=0)
+        with write_locked(store):
+            self.assertThat(store2.lock_write, raises(LockTimeout))
+
+    def test_no_lock_timeout(self):
+        store = sqlite.Store(lock_timeout=None)
+        with write_locked(store):
+            store['foo'] = 'bar'
+        with read_locked(store):
+            self.assertEqual('bar', store['foo'])
+
+    def test_construct_while_write_locked(self):
+        sqlite.Store()
+        store = sqlite.Store(lock_timeout=0)
+        with write_locked(store):
+            store2 = sqlite.Store(lock_timeout=0)
+        with read_locked(store2):
+            self.assertThat(lambda:store2['foo'], raises(KeyError))
+
+    def test_usable_from_other_threads(self):
+        store = sqlite.Store()
+        errors = []
+        def write():
+            try:
+                with write_locked(store):
+                    store['foo'] = 'bar'
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join()
+        self.assertEqual([], errors)
+        with read_locked(store):
+            self.assertEqual('bar', store['foo'])
+
+    def test_resources_table(self):
+        store = sqlite.Store()
+        with write_locked(store):
+            store['resource/0'] = 'foo'
+        self.assertEqual(
+            [('0', 'foo')],
+            store._db.execute('SELECT * FROM resources').fetchall())
+
+    def test_exception_discards_writes(self):
+        store = sqlite.Store()
+        def fail():
+            with write_locked(store):
+                store['foo'] = 'quux'
+                raise ValueError('boom')
+        self.assertThat(fail, raises(ValueError))
+        with read_locked(store):
+            self.assertThat(lambda:store['foo'], raises(KeyError))
+
+    def test_nested_abort_keeps_outer_writes(self):
+        store = sqlite.Store()
+        def fail():
+            with write_locked(store):
+                store.sadd('pool/foo', ['b'])
+                raise ValueError('boom')
+        with write_locked(store):
+            store.sadd('pool/foo', ['a'])
+            self.assertThat(fail, raises(ValueError))
+        with read_locked(store):
+            self.assertEqual(set(['a']), store.smembers('pool/foo'))
+            self.assertEqual(1, store.scard('pool/foo'))
+
+    def test_shards_lock_independently(self):
+        store = sqlite.Store(lock_timeout=0, shard='a')
+        store2 = sqlite.Store(lock_timeout=0, shard='b')
+        with write_locked(store):
+            store['foo'] = 'bar'
+            with write_locked(store2):
+                self.assertThat(lambda:store2['foo'], raises(KeyError))
+        self.assertTrue(os.path.exists(os.path.expanduser(
+            '~/.cache/crcache/shards/a/state.sqlite')))
+
+    def test_lock_stats(self):
+        store = sqlite.Store(lock_timeout=0)
+        store2 = sqlite.Store(lock_timeout=0.01)
+        with write_locked(store):
+            self.assertThat(store2.lock_write, raises(LockTimeout))
+        with write_locked(store2):
+            pass
+        self.assertEqual(0, store.lock_stats.contended)
+        # The schema setup in the constructor takes a lock too.
+        self.assertEqual(2, store.lock_stats.acquired)
+        self.assertEqual(1, store2.lock_stats.timeouts)
+        self.assertEqual(1, store2.lock_stats.contended)
+        self.assertTrue(store2.lock_stats.wait_time > 0)
@@ -0,0 +1,123 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for the crcache.strategy interface."""
+
+from testtools.matchers import raises
+
+from cr_cache import cache
+from cr_cache.source import model
+from cr_cache.store import memory
+from cr_cache.strategy import (
+    find_strategy_type,
+    in_order,
+    latency,
+    least_loaded,
+    round_robin,
+    weighted,
+    )
+from cr_cache.tests import TestCase
+
+
+def make_children(*maximums):
+    return [cache.Cache(name, memory.Store({}, name), model.Source(None, None),
+        maximum=maximum) for name, maximum in zip('abcdef', maximums)]
+
+
+def counts(requests):
+    return [(child.name, count) for child, count in requests]
+
+
+class TestInOrder(TestCase):
+
+    def test_fills_in_order(self):
+        children = make_children(2, 3, 0)
+        children[0].provision(1)
+        strategy = in_order.Strategy({})
+        self.assertEqual([('a', 1), ('b', 3), ('c', 2)],
+            counts(strategy.split(children, 6)))
+        self.assertEqual([('a', 1)], counts(strategy.split(children, 1)))
+
+
+class TestRoundRobin(TestCase):
+
+    def test_takes_turns_across_requests(self):
+        children = make_children(2, 2, 2)
+        strategy = round_robin.Strategy({})
+        self.assertEqual([('a', 1), ('b', 1)],
+            counts(strategy.split(children, 2)))
+        self.assertEqual([('c', 1)], counts(strategy.split(children, 1)))
+
+    def test_skips_full_children(self):
+        children = make_children(1, 2, 0)
+        children[1].provision(2)
+        strategy = round_robin.Strategy({})
+        self.assertEqual([('a', 1), ('c', 3)],
+            counts(strategy.split(children, 4)))
+
+
+class TestLeastLoaded(TestCase):
+
+    def test_evens_out_load(self):
+        children = make_children(4, 2)
+        children[0].provision(2)
+        strategy = least_loaded.Strategy({})
+        # b is emptier, until it is half full too.
+        self.assertEqual([('a', 1), ('b', 2)],
+            counts(strategy.split(children, 3)))
+
+
+class TestWeighted(TestCase):
+
+    def test_splits_by_weight(self):
+        children = make_children(0, 0)
+        strategy = weighted.Strategy({'weights': {'a': 3}})
+        self.assertEqual([('a', 6), ('b', 2)],
+            counts(strategy.split(children, 8)))
+
+    def test_weights_must_be_positive(self):
+        self.assertThat(lambda:weighted.Strategy({'weights': {'a': 0}}),
+            raises(ValueError))
+
+
+class TestLatency(TestCase):
+
+    def test_fills_fastest_first(self):
+        children = make_children(2, 2, 2)
+        strategy = latency.Strategy({})
+        strategy.observe(children[0], 1, 30.0)
+        strategy.observe(children[1], 1, 5.0)
+        # c has never been measured, so is tried first.
+        self.assertEqual([('c', 2), ('b', 2), ('a', 1)],
+            counts(strategy.split(children, 5)))
+
+    def test_averages_observations(self):
+        children = make_children(1, 1)
+        strategy = latency.Strategy({})
+        strategy.observe(children[0], 1, 10.0)
+        strategy.observe(children[1], 1, 20.0)
+        strategy.observe(children[0], 1, 50.0)
+        # a averages 22, so b is now faster.
+        self.assertEqual([('b', 1)], counts(strategy.split(children, 1)))
+
+
+class TestHelpers(TestCase):
+
+    def test_find_strategy_type(self):
+        self.assertEqual(
+            round_robin.Strategy, find_strategy_type('round-robin'))
+
+    def test_find_strategy_type_missing(self):
+        self.assertThat(
+            lambda: find_strategy_type('foo'), raises(ImportError))
@@ -0,0 +1,76 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for circuit breakers."""
+
+from cr_cache import breaker, cache
+from cr_cache.source import model
+from cr_cache.store import memory
+from cr_cache.tests import TestCase
+
+
+class TestBreaker(TestCase):
+
+    def make_breaker(self, failures=2, cooldown=60):
+        c = cache.Cache('foo', memory.Store({}), model.Source(None, None))
+        return breaker.Breaker(c, failures, cooldown)
+
+    def test_opens_after_failures_in_a_row(self):
+        b = self.make_breaker()
+        b.failed(now=100)
+        self.assertTrue(b.allow(now=100))
+        b.succeeded()
+        b.failed(now=100)
+        self.assertTrue(b.allow(now=100))
+        b.failed(now=100)
+        self.assertFalse(b.ready(now=100))
+        self.assertFalse(b.allow(now=159))
+
+    def test_shared_through_the_store(self):
+        b = self.make_breaker(failures=1)
+        b.failed(now=100)
+        other = breaker.Breaker(b.cache, 1, 60)
+        self.assertFalse(other.allow(now=100))
+
+    def test_half_open_lets_one_probe_through(self):
+        b = self.make_breaker(failures=1)
+        b.failed(now=100)
+        self.assertTrue(b.ready(now=160))
+        self.assertTrue(b.allow(now=160))
+        self.assertFalse(b.ready(now=160))
+        self.assertFalse(b.allow(now=161))
+        # An abandoned probe is given up on.
+        self.assertTrue(b.allow(now=160 + breaker._PROBE_SECONDS))
+
+    def test_probe_success_closes(self):
+        b = self.make_breaker(failures=1)
+        b.failed(now=100)
+        b.allow(now=160)
+        b.succeeded()
+        self.assertTrue(b.allow(now=160))
+        self.assertTrue(b.allow(now=160))
+
+    def test_probe_failure_reopens(self):
+        b = self.make_breaker(failures=3)
+        for _ in range(3):
+            b.failed(now=100)
+        b.allow(now=160)
+        b.failed(now=160)
+        self.assertFalse(b.allow(now=219))
+        self.assertTrue(b.allow(now=220))
+
+    def test_disabled(self):
+        b = self.make_breaker(failures=0)
+        b.failed(now=100)
+        self.assertTrue(b.allow(now=100))
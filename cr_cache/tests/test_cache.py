@@ -15,12 +15,21 @@
 """Tests for the crcache resource cache."""
 
 import os.path
+import socket
 
+from fixtures import MonkeyPatch
 from testtools.matchers import Equals, MatchesAny, raises
 
 from cr_cache import cache
-from cr_cache.source import local, model, pool
-from cr_cache.store import memory, read_locked
+from cr_cache.policy import fifo, priority
+from cr_cache.source import UnknownInstance, local, model, pool
+from cr_cache.store import (
+    lockfile,
+    memory,
+    notify,
+    read_locked,
+    write_locked,
+    )
 from cr_cache.tests import TestCase
 
 class TestCache(TestCase):
@@ -71,8 +80,9 @@ class TestCache(TestCase):
         self.assertEqual(2, c.cached())
         # Check its all mapped correctly.
         with read_locked(c.store):
-            self.assertEqual('0,1,2', c.store['pool/foo'])
-            self.assertEqual('0', c.store['allocated/foo'])
+            self.assertEqual(set(['0', '1', '2']), c.store.smembers('pool/foo'))
+            self.assertEqual(set(['0']), c.store.smembers('allocated/foo'))
+            self.assertEqual(set(['1', '2']), c.store.smembers('cached/foo'))
             self.assertEqual('foo', c.store['resource/0'])
             self.assertEqual('foo', c.store['resource/1'])
             self.assertEqual('foo', c.store['resource/2'])
@@ -86,7 +96,7 @@ class TestCache(TestCase):
         self.assertEqual(1, c.in_use())
         # The instance should have been mapped in both directions in the store.
         with read_locked(c.store):
-            self.assertEqual('0', c.store['pool/foo'])
+            self.assertEqual(set(['0']), c.store.smembers('pool/foo'))
             self.assertEqual('foo', c.store['resource/0'])
 
     def test_provision_several(self):
@@ -97,7 +107,7 @@ class TestCache(TestCase):
         self.assertEqual(3, c.in_use())
         # The instances should have been mapped in both directions in the store.
         with read_locked(c.store):
-            self.assertEqual('0,1,2', c.store['pool/foo'])
+            self.assertEqual(set(['0', '1', '2']), c.store.smembers('pool/foo'))
             self.assertEqual('foo', c.store['resource/0'])
             self.assertEqual('foo', c.store['resource/1'])
             self.assertEqual('foo', c.store['resource/2'])
@@ -111,7 +121,8 @@ class TestCache(TestCase):
         self.assertEqual(4, c.in_use())
         # The instances should have been mapped in both directions in the store.
         with read_locked(c.store):
-            self.assertEqual('0,1,2,3', c.store['pool/foo'])
+            self.assertEqual(
+                set(['0', '1', '2', '3']), c.store.smembers('pool/foo'))
             self.assertEqual('foo', c.store['resource/0'])
             self.assertEqual('foo', c.store['resource/1'])
             self.assertEqual('foo', c.store['resource/2'])
@@ -128,7 +139,8 @@ class TestCache(TestCase):
         self.assertEqual(0, c.cached())
         # The instances should have been mapped in both directions in the store.
         with read_locked(c.store):
-            self.assertEqual('0,1,2', c.store['pool/foo'])
+            self.assertEqual(set(), c.store.smembers('cached/foo'))
+            self.assertEqual(set(['0', '1', '2']), c.store.smembers('pool/foo'))
             self.assertEqual('foo', c.store['resource/0'])
             self.assertEqual('foo', c.store['resource/1'])
             self.assertEqual('foo', c.store['resource/2'])
@@ -148,7 +160,7 @@ class TestCache(TestCase):
         # The source was not interrogated for more resources.
         self.assertEqual(['2'], source.provision(1))
         with read_locked(c.store):
-            self.assertEqual('0,1', c.store['pool/foo'])
+            self.assertEqual(set(['0', '1']), c.store.smembers('pool/foo'))
             self.assertThat(lambda:c.store['resource/2'], raises(KeyError))
 
     def test_provision_beyond_cap(self):
@@ -162,17 +174,29 @@ class TestCache(TestCase):
         c.discard(c.provision(2))
         self.assertEqual(set(['foo-0', 'foo-1']), c.provision_from_cache(5))
 
+    def test_adopt(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source)
+        c.adopt(['0', '1', '2'], ['1'])
+        c.adopt(['0'], [])
+        self.assertEqual((1, 2), (c.in_use(), c.cached()))
+        self.assertEqual(set(['foo-1']), c.instances())
+        with read_locked(c.store):
+            self.assertEqual('foo', c.store['resource/2'])
+        self.assertEqual(set(['foo-0', 'foo-2']), c.provision_from_cache(2))
+
     def test_discard_single(self):
         source = model.Source(None, None)
         c = cache.Cache("foo", memory.Store({}), source)
         c.provision(2)
         c.discard(['foo-0'])
+        c.collect()
         self.assertEqual(1, c.in_use())
         self.assertEqual(0, c.cached())
         # The instance should have been unmapped in both directions from the
         # store.
         with read_locked(c.store):
-            self.assertEqual('1', c.store['pool/foo'])
+            self.assertEqual(set(['1']), c.store.smembers('pool/foo'))
             self.assertThat(lambda:c.store['resource/0'], raises(KeyError))
 
     def test_discard_multiple(self):
@@ -180,6 +204,7 @@ class TestCache(TestCase):
         c = cache.Cache("foo", memory.Store({}), source)
         c.provision(4)
         c.discard(['foo-0', 'foo-2'])
+        c.collect()
         self.assertEqual(2, c.in_use())
         self.assertEqual(0, c.cached())
         self.assertEqual(
@@ -187,7 +212,7 @@ class TestCache(TestCase):
         # The instances should have been unmapped in both directions from the
         # store.
         with read_locked(c.store):
-            self.assertEqual('1,3', c.store['pool/foo'])
+            self.assertEqual(set(['1', '3']), c.store.smembers('pool/foo'))
             self.assertThat(lambda:c.store['resource/0'], raises(KeyError))
             self.assertThat(lambda:c.store['resource/2'], raises(KeyError))
 
@@ -195,6 +220,7 @@ class TestCache(TestCase):
         source = model.Source(None, None)
         c = cache.Cache("foo", memory.Store({}), source, reserve=1)
         c.discard(c.provision(2))
+        c.collect()
         self.assertEqual(0, c.in_use())
         self.assertEqual(1, c.cached())
         self.assertThat(source._calls, MatchesAny(
@@ -209,7 +235,9 @@ class TestCache(TestCase):
         # The instance should have been unmapped in both directions from the
         # store.
         with read_locked(c.store):
-            self.assertEqual(remaining, c.store['pool/foo'])
+            self.assertEqual(set([remaining]), c.store.smembers('pool/foo'))
+            self.assertEqual(
+                set([remaining]), c.store.smembers('cached/foo'))
             self.assertThat(lambda:c.store[gone], raises(KeyError))
             self.assertEqual('foo', c.store['resource/' + remaining])
 
@@ -218,19 +246,21 @@ class TestCache(TestCase):
         c = cache.Cache("foo", memory.Store({}), source, reserve=1, maximum=4)
         self.assertEqual(4, c.available())
         c.discard(c.provision(2))
+        c.collect()
         self.assertEqual(4, c.available())
 
     def test_discard_force_ignores_reserve(self):
         source = model.Source(None, None)
         c = cache.Cache("foo", memory.Store({}), source, reserve=1)
         c.discard(c.provision(2), force=True)
+        c.collect()
         self.assertThat(source._calls, MatchesAny(
             Equals([('provision', 2), ('discard', ['0', '1'])]),
             Equals([('provision', 2), ('discard', ['1', '0'])])))
         # The instance should have been unmapped in both directions from the
         # store.
         with read_locked(c.store):
-            self.assertEqual('', c.store['pool/foo'])
+            self.assertEqual(set(), c.store.smembers('pool/foo'))
             self.assertThat(lambda:c.store['resource/0'], raises(KeyError))
             self.assertThat(lambda:c.store['resource/1'], raises(KeyError))
 
@@ -242,3 +272,567 @@ class TestCache(TestCase):
         self.assertEqual(set(instances), c.instances())
         c.discard(c.instances())
         self.assertEqual(0, c.in_use())
+
+    def test_snapshot(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source, reserve=3, maximum=4)
+        instances = c.provision(2)
+        # The reserve counts the instances in use.
+        c.fill_reserve()
+        snapshot = c.snapshot()
+        self.assertEqual("foo", snapshot.name)
+        self.assertEqual(1, snapshot.cached)
+        self.assertEqual(2, snapshot.in_use)
+        self.assertEqual(4, snapshot.maximum)
+        self.assertEqual(c.available(), snapshot.available)
+        self.assertEqual(sorted(instances), snapshot.instances)
+
+    def test_snapshot_all_shares_one_lock_pass(self):
+        locks = []
+        class RecordingStore(memory.Store):
+            def lock_read(self):
+                locks.append(self.shard)
+                super(RecordingStore, self).lock_read()
+        backend = {}
+        store = RecordingStore(backend)
+        foo = cache.Cache("foo", store, model.Source(None, None))
+        bar = cache.Cache("bar", store, model.Source(None, None), maximum=2)
+        bar.provision(1)
+        del locks[:]
+        snapshots = cache.snapshot_all([foo, bar])
+        self.assertEqual([None], locks)
+        self.assertEqual(["foo", "bar"], [s.name for s in snapshots])
+        self.assertEqual([0, 1], [s.in_use for s in snapshots])
+        self.assertEqual([0, 1], [s.available for s in snapshots])
+
+    def test_provision_unlocks_during_source_provision(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source, maximum=4)
+        seen = []
+        def provision(count):
+            seen.append((c.store._lock, c.available()))
+            # Capacity being provisioned counts against the limit.
+            self.assertThat(lambda:c.provision(2), raises(ValueError))
+            return model.Source.provision(source, count)
+        source.provision = provision
+        c.provision(3)
+        self.assertEqual([('u', 1)], seen)
+        self.assertEqual(1, c.available())
+        with read_locked(c.store):
+            self.assertEqual(0, c.store.scard('provisioning/foo'))
+
+    def test_provision_failure_releases_reservation(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source, reserve=1, maximum=3)
+        c.fill_reserve()
+        def provision(count):
+            raise ValueError('boom')
+        source.provision = provision
+        self.assertThat(lambda:c.provision(2), raises(ValueError))
+        self.assertEqual(3, c.available())
+        self.assertEqual(0, c.in_use())
+        self.assertEqual(1, c.cached())
+        with read_locked(c.store):
+            self.assertEqual(0, c.store.scard('provisioning/foo'))
+
+    def test_provision_uses_cached_at_cap(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source, reserve=1, maximum=1)
+        c.fill_reserve()
+        self.assertEqual(set(['foo-0']), c.provision(1))
+        self.assertEqual([('provision', 1)], source._calls)
+
+    def test_fill_reserve_unlocks_during_source_provision(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source, reserve=2)
+        seen = []
+        def provision(count):
+            seen.append(c.store._lock)
+            # A concurrent fill does not provision the same capacity again.
+            c.fill_reserve()
+            return model.Source.provision(source, count)
+        source.provision = provision
+        c.fill_reserve()
+        self.assertEqual(['u'], seen)
+        self.assertEqual(2, c.cached())
+
+    def test_discard_queues_for_collect(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source, maximum=4)
+        c.discard(c.provision(2))
+        self.assertEqual([('provision', 2)], source._calls)
+        # Until torn down, discarded instances still use capacity.
+        self.assertEqual(2, c.discarding())
+        self.assertEqual(2, c.available())
+        self.assertThat(lambda:c.provision(3), raises(ValueError))
+        self.assertEqual(None, c.collect())
+        self.assertEqual(0, c.discarding())
+        self.assertEqual(4, c.available())
+
+    def test_collect_retries_with_backoff(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source)
+        c.discard(c.provision(1))
+        calls = []
+        def discard(instances):
+            calls.append(instances)
+            raise ValueError('boom')
+        source.discard = discard
+        self.assertEqual(105.0, c.collect(now=100))
+        # Not due yet.
+        self.assertEqual(105.0, c.collect(now=101))
+        self.assertEqual(115.0, c.collect(now=105))
+        self.assertEqual([['0'], ['0']], calls)
+        del source.discard
+        self.assertEqual(None, c.collect(now=115))
+        self.assertEqual(0, c.discarding())
+        with read_locked(c.store):
+            self.assertThat(lambda:c.store['retry/0'], raises(KeyError))
+
+    def test_collect_skips_claimed(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source)
+        c.discard(c.provision(2))
+        def discard(instances):
+            # A concurrent collector finds nothing due.
+            self.assertEqual(100.0 + cache._CLAIM_SECONDS, c.collect(now=100))
+            return model.Source.discard(source, instances)
+        source.discard = discard
+        c.collect(now=100)
+        self.assertEqual(1, len([call for call in source._calls
+            if call[0] == 'discard']))
+
+    def test_reserve_shortfall(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source, reserve=3)
+        self.assertEqual(3, c.reserve_shortfall())
+        c.provision(1)
+        self.assertEqual(2, c.reserve_shortfall())
+        def provision(count):
+            # In-flight instances count towards the reserve.
+            self.assertEqual(0, c.reserve_shortfall())
+            return model.Source.provision(source, count)
+        source.provision = provision
+        c.fill_reserve()
+        self.assertEqual(0, c.reserve_shortfall())
+        c.discard(c.instances(), force=True)
+        self.assertEqual(1, c.reserve_shortfall())
+
+    def test_reserve_shortfall_no_reserve(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source)
+        self.assertEqual(0, c.reserve_shortfall())
+
+    def make_timed_cache(self, **kwargs):
+        # Start at hour 9 on a fixed day, local time, whatever the timezone.
+        self.now = 1000 * 86400.0
+        self.now += (9 - cache._hour_of_day(int(self.now // 3600))) * 3600
+        self.useFixture(MonkeyPatch('time.time', lambda:self.now))
+        return cache.Cache("foo", memory.Store({}), model.Source(None, None),
+            **kwargs)
+
+    def test_warm_without_ceiling_keeps_reserve(self):
+        c = self.make_timed_cache(reserve=2)
+        self.assertEqual(2, c.warm())
+        self.assertEqual(0, c.cached())
+        with read_locked(c.store):
+            self.assertThat(lambda:c.store['demand/foo'], raises(KeyError))
+
+    def test_warm_without_history_uses_floor(self):
+        c = self.make_timed_cache(floor=1, ceiling=5)
+        self.assertEqual(1, c.warm())
+        self.assertEqual(1, c.cached())
+        self.assertEqual(0, c.reserve_shortfall())
+
+    def test_warm_follows_daily_demand(self):
+        c = self.make_timed_cache(floor=1, ceiling=5)
+        c.warm()
+        # A spike at 9.
+        instances = c.provision(3)
+        self.now += 3600
+        c.discard(instances)
+        c.collect()
+        self.assertEqual(1, c.cached())
+        # At 8 the next day, the reserve grows ready for 9.
+        self.now += 23 * 3600
+        self.assertEqual(3, c.warm())
+        self.assertEqual(3, c.cached())
+        # And shrinks again in the evening.
+        self.now += 10 * 3600
+        self.assertEqual(1, c.warm())
+        self.assertEqual(2, c.discarding())
+        c.collect()
+        self.assertEqual(1, c.cached())
+
+    def test_warm_capped_by_ceiling(self):
+        c = self.make_timed_cache(ceiling=2)
+        c.discard(c.provision(4))
+        self.now += 23 * 3600
+        self.assertEqual(2, c.warm())
+
+    def test_forecast_is_weighted_average(self):
+        c = self.make_timed_cache(ceiling=10)
+        c.discard(c.provision(4))
+        self.now += 86400
+        c.discard(c.provision(8))
+        self.now += 3600
+        c.warm()
+        with read_locked(c.store):
+            forecast = c._forecast(int(self.now // 3600) - 1)
+        self.assertEqual(4 + cache._FORECAST_ALPHA * 4, forecast)
+
+    def test_provision_wait_times_out(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None),
+            maximum=1)
+        c.provision(1)
+        self.assertThat(lambda:c.provision(1, wait=True, timeout=0),
+            raises(ValueError))
+        with read_locked(c.store):
+            self.assertEqual(0, c.store.scard('waiting/foo'))
+
+    def test_provision_wait_larger_than_maximum(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None),
+            maximum=1)
+        self.assertThat(lambda:c.provision(2, wait=True), raises(ValueError))
+
+    def test_provision_wait_woken_by_discard(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None),
+            maximum=1)
+        held = c.provision(1)
+        woken = []
+        original = notify.Waiter.wait
+        def wait(waiter, timeout):
+            # Another process releases its instance, waking the waiter.
+            c.discard(held)
+            c.collect()
+            woken.append(original(waiter, timeout))
+            return woken[-1]
+        self.useFixture(MonkeyPatch('cr_cache.store.notify.Waiter.wait', wait))
+        self.assertEqual(1, len(c.provision(1, wait=True)))
+        self.assertEqual([True], woken)
+
+    def test_provision_waiters_served_in_order(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None),
+            maximum=2)
+        held = c.provision(2)
+        ahead = '0 0 %s' % lockfile.process_record()
+        with write_locked(c.store):
+            c.store.sadd('waiting/foo', [ahead])
+        c.discard(held)
+        c.collect()
+        # There is capacity, but only for the waiter at the head of the queue.
+        self.assertThat(lambda:c.provision(1), raises(ValueError))
+        self.assertThat(lambda:c.provision(1, wait=True, timeout=0),
+            raises(ValueError))
+        with write_locked(c.store):
+            c.store.srem('waiting/foo', [ahead])
+        self.assertEqual(1, len(c.provision(1, wait=True, timeout=0)))
+
+    def test_provision_drops_dead_waiters(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None),
+            maximum=1)
+        with write_locked(c.store):
+            c.store.sadd('waiting/foo', [
+                '0 0 %s 2147483647 -' % socket.gethostname()])
+        self.assertEqual(1, len(c.provision(1)))
+        with read_locked(c.store):
+            self.assertEqual(0, c.store.scard('waiting/foo'))
+
+    def test_provision_priority_jumps_queue(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None),
+            maximum=1)
+        with write_locked(c.store):
+            c.store.sadd('waiting/foo', ['0 0 %s' % lockfile.process_record()])
+        self.assertThat(lambda:c.provision(1), raises(ValueError))
+        self.assertEqual(1, len(c.provision(1, priority=1)))
+
+    def test_provision_fifo_policy_ignores_priority(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None),
+            maximum=1, policy=fifo.Policy({}))
+        with write_locked(c.store):
+            c.store.sadd('waiting/foo', ['0 0 %s' % lockfile.process_record()])
+        self.assertThat(lambda:c.provision(1, priority=1), raises(ValueError))
+
+    def test_provision_reserved_capacity(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None),
+            maximum=3, policy=priority.Policy({'reserved': {10: 1}}))
+        c.discard(c.provision(2, priority=10))
+        c.collect()
+        c.provision(2)
+        # The last instance is held back for important requests.
+        self.assertThat(lambda:c.provision(1), raises(ValueError))
+        self.assertThat(lambda:c.provision(3, wait=True), raises(ValueError))
+        self.assertEqual(1, len(c.provision(1, priority=10)))
+
+    def test_lease_expiry_reclaims(self):
+        c = self.make_timed_cache(maximum=2)
+        leased = c.provision(1, lease=30)
+        kept = c.provision(1)
+        self.assertEqual(0, c.reclaim())
+        self.now += 31
+        self.assertEqual(1, c.reclaim())
+        self.assertEqual(1, c.discarding())
+        self.assertEqual(kept, set(c.instances()))
+        # A late release of a reclaimed instance is ignored.
+        c.discard(leased)
+        self.assertEqual(1, c.discarding())
+
+    def test_discard_unknown_fails(self):
+        source = model.Source(None, None)
+        c = cache.Cache("foo", memory.Store({}), source)
+        instances = c.provision(1)
+        self.assertThat(lambda:c.discard(list(instances) + ['foo-typo']),
+            raises(UnknownInstance))
+        # Nothing was discarded.
+        self.assertEqual((1, 0), (c.in_use(), c.discarding()))
+
+    def test_lease_renew(self):
+        c = self.make_timed_cache()
+        leased = c.provision(1, lease=30)
+        self.now += 20
+        c.renew(leased, 30)
+        self.now += 20
+        self.assertEqual(0, c.reclaim())
+        self.now += 20
+        self.assertEqual(1, c.reclaim())
+        self.assertThat(lambda:c.renew(leased, 30), raises(ValueError))
+
+    def test_renew_without_lease(self):
+        c = self.make_timed_cache()
+        self.assertThat(lambda:c.renew(c.provision(1), 30),
+            raises(ValueError))
+
+    def test_release_drops_lease(self):
+        c = self.make_timed_cache(reserve=1)
+        c.discard(c.provision(1, lease=30))
+        self.now += 31
+        self.assertEqual(0, c.reclaim())
+        self.assertEqual(1, c.cached())
+
+    def test_reclaim_only_visits_due_buckets(self):
+        c = self.make_timed_cache()
+        c.provision(1, lease=3600)
+        c.provision(1, lease=30)
+        visited = []
+        smembers = c.store.smembers
+        def recording_smembers(setname, limit=None):
+            if setname.startswith('leases/'):
+                visited.append(setname)
+            return smembers(setname, limit)
+        c.store.smembers = recording_smembers
+        self.now += 31
+        self.assertEqual(1, c.reclaim())
+        self.assertTrue(len(visited) <= 2, visited)
+        del visited[:]
+        self.assertEqual(0, c.reclaim())
+        self.assertTrue(len(visited) <= 1, visited)
+
+    def test_reclaim_after_idle_visits_occupied_buckets(self):
+        c = self.make_timed_cache()
+        c.provision(1, lease=30)
+        c.provision(1, lease=7200)
+        visited = []
+        smembers = c.store.smembers
+        def recording_smembers(setname, limit=None):
+            visited.append(setname)
+            return smembers(setname, limit)
+        c.store.smembers = recording_smembers
+        # A day later, only the two occupied buckets are looked in.
+        self.now += 86400
+        self.assertEqual(2, c.reclaim())
+        self.assertEqual(2, len(
+            [setname for setname in visited if setname.startswith('leases/')]))
+        c.provision(1, lease=120)
+        del visited[:]
+        # Nothing is due, so no buckets are looked in at all.
+        self.assertEqual(0, c.reclaim())
+        self.assertEqual([], visited)
+
+    def test_provision_reclaims_expired_leases(self):
+        c = self.make_timed_cache(maximum=1, reserve=1)
+        c.provision(1, lease=30)
+        self.assertThat(lambda:c.provision(1), raises(ValueError))
+        self.now += 31
+        # The expired instance is kept in the reserve, and handed out.
+        self.assertEqual(set(['foo-0']), c.provision(1))
+
+    def test_reap_dead_owner(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None))
+        dead = '%s 2147483647 -' % socket.gethostname()
+        kept = c.provision(1, owner=lockfile.process_record())
+        c.provision(2, owner=dead)
+        self.assertEqual(2, c.reap())
+        self.assertEqual(kept, set(c.instances()))
+        self.assertEqual(0, c.reap())
+        with read_locked(c.store):
+            self.assertEqual(set([lockfile.process_record()]),
+                c.store.smembers('owners/foo'))
+
+    def test_release_owner(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None))
+        owner = lockfile.process_record()
+        c.provision(2, owner=owner)
+        c.discard(c.provision(1, owner=owner))
+        self.assertEqual(2, c.release_owner(owner))
+        self.assertEqual(3, c.discarding())
+        with read_locked(c.store):
+            self.assertEqual(0, c.store.scard('owners/foo'))
+
+    def test_provision_reaps_dead_owners(self):
+        c = cache.Cache("foo", memory.Store({}), model.Source(None, None),
+            maximum=1, reserve=1)
+        c.provision(1, owner='%s 2147483647 -' % socket.gethostname())
+        self.assertEqual(set(['foo-0']), c.provision(1))
+
+    def test_health_check_quarantines_failures(self):
+        checked = []
+        def check(instance):
+            checked.append(instance)
+            return instance != '0'
+        c = self.make_timed_cache(reserve=2, health_check=check, check_ttl=60)
+        c.fill_reserve()
+        self.now += 61
+        # The failed instance is replaced transparently.
+        self.assertEqual(set(['foo-1', 'foo-2']), c.provision(2))
+        self.assertEqual(['0', '1'], sorted(checked))
+        self.assertEqual(1, c.quarantined())
+        self.assertEqual(1, c.discarding())
+        c.collect()
+        self.assertEqual(0, c.quarantined())
+
+    def test_health_check_result_cached(self):
+        checked = []
+        def check(instance):
+            checked.append(instance)
+            return True
+        c = self.make_timed_cache(reserve=1, health_check=check, check_ttl=60)
+        c.fill_reserve()
+        # Newly provisioned instances count as checked.
+        c.discard(c.provision(1))
+        self.assertEqual([], checked)
+        self.now += 61
+        c.discard(c.provision(1))
+        self.assertEqual(['0'], checked)
+        c.discard(c.provision(1))
+        self.assertEqual(['0'], checked)
+
+    def test_health_check_errors_quarantine(self):
+        def check(instance):
+            raise ValueError('boom')
+        c = self.make_timed_cache(reserve=1, health_check=check, check_ttl=60)
+        c.fill_reserve()
+        self.now += 61
+        self.assertEqual(set(), c.provision_from_cache(1))
+        self.assertEqual(1, c.quarantined())
+
+    def make_eviction_history(self, **kwargs):
+        """Leave instances differing in when they were released and used."""
+        c = self.make_timed_cache(reserve=2, **kwargs)
+        c.discard(c.provision(2))
+        self.now += 10
+        recent = c.provision(1)
+        c.discard(recent)
+        self.now += 10
+        instances = c.provision(3)
+        stale = instances - recent - set(['foo-2'])
+        c.discard(instances)
+        return c, recent, stale
+
+    def test_discard_evicts_lru(self):
+        # One of the three released instances must go: the one that had been
+        # idle longest before.
+        c, recent, stale = self.make_eviction_history()
+        self.assertEqual(recent | set(['foo-2']), c.provision(2))
+
+    def test_discard_evicts_lfu(self):
+        # The newest instance has been handed out least.
+        c, recent, stale = self.make_eviction_history(eviction='lfu')
+        self.assertEqual(recent | stale, c.provision(2))
+
+    def test_discard_max_uses(self):
+        c = self.make_timed_cache(reserve=1, max_uses=2)
+        c.discard(c.provision(1))
+        self.assertEqual(1, c.cached())
+        c.discard(c.provision(1))
+        self.assertEqual(0, c.cached())
+        self.assertEqual(1, c.discarding())
+
+    def test_evict_idle_and_old(self):
+        c = self.make_timed_cache(reserve=2, max_idle=60, max_age=300)
+        c.fill_reserve()
+        self.now += 30
+        c.discard(c.provision(1))
+        self.assertEqual(0, c.evict())
+        self.now += 40
+        # One has been idle 70 seconds, the other 40.
+        self.assertEqual(1, c.evict())
+        self.now += 300
+        c.discard(c.provision(1))
+        self.assertEqual(2, c.discarding())
+        self.assertEqual(0, c.evict())
+
+    def test_evict_needs_limits(self):
+        c = self.make_timed_cache(reserve=1)
+        c.fill_reserve()
+        self.now += 10 ** 6
+        self.assertEqual(0, c.evict())
+
+    def test_unknown_eviction(self):
+        self.assertThat(lambda:cache.Cache("foo", memory.Store({}),
+            model.Source(None, None), eviction='mru'), raises(ValueError))
+
+    def test_affinity_prefers_same_key(self):
+        c = self.make_timed_cache(reserve=3)
+        a = c.provision(1, affinity='a')
+        b = c.provision(1, affinity='b')
+        plain = c.provision(1)
+        c.discard(a | b | plain)
+        self.assertEqual(b, c.provision(1, affinity='b'))
+        self.assertEqual(a, c.provision(1, affinity='a'))
+        with read_locked(c.store):
+            self.assertEqual(set(), c.store.smembers('idle/foo/a'))
+
+    def test_affinity_falls_back_to_lru(self):
+        c = self.make_timed_cache(reserve=2)
+        first = c.provision(1, affinity='a')
+        second = c.provision(1, affinity='b')
+        c.discard(first)
+        self.now += 10
+        c.discard(second)
+        # first has been idle longest.
+        self.assertEqual(first, c.provision(1, affinity='c'))
+        self.assertEqual(second, c.provision(1, affinity='c'))
+
+    def test_affinity_forgotten_by_plain_handout(self):
+        c = self.make_timed_cache(reserve=2)
+        a = c.provision(1, affinity='a')
+        c.discard(a)
+        self.assertEqual(a, c.provision(1))
+        c.discard(a)
+        with read_locked(c.store):
+            self.assertEqual(set(), c.store.smembers('idle/foo/a'))
+            self.assertThat(lambda:c.store['affinity/0'], raises(KeyError))
+
+    def test_affinity_fallback_looks_at_needed_instances(self):
+        c = self.make_timed_cache(reserve=10)
+        c.fill_reserve()
+        looked_at = []
+        usage = c._usage
+        def recording_usage(instance):
+            looked_at.append(instance)
+            return usage(instance)
+        c._usage = recording_usage
+        handed_out = c.provision(1, affinity='a')
+        # The instance handed out, not all ten.
+        self.assertEqual(set(c._external_name(looked_at)), handed_out)
+
+    def test_affinity_index_follows_cache(self):
+        c = self.make_timed_cache(reserve=1, max_idle=5)
+        c.discard(c.provision(1, affinity='a'))
+        self.now += 10
+        self.assertEqual(1, c.evict())
+        with read_locked(c.store):
+            self.assertEqual(set(), c.store.smembers('idle/foo/a'))
+        c.collect()
+        with read_locked(c.store):
+            self.assertThat(lambda:c.store['affinity/0'], raises(KeyError))
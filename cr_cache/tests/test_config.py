@@ -16,31 +16,44 @@
 
 import os.path
 
-from fixtures import Fixture
+from fixtures import Fixture, MonkeyPatch
 from testtools.matchers import Is, IsInstance
 import yaml
 
 from cr_cache import config
+from cr_cache.policy import priority
 from cr_cache.source import model
+from cr_cache.store import (
+    journal,
+    local,
+    read_locked,
+    sqlite,
+    write_locked,
+    )
 from cr_cache.tests import TestCase
 
 
 class SourceConfigFixture(Fixture):
     """Sets up a source configuration."""
 
-    def __init__(self, name, type, reserve=None, sources=None):
+    def __init__(self, name, type, reserve=None, sources=None, floor=None,
+        ceiling=None):
         """Create a SourceConfigFixture.
 
         :param name: The name for the source to configure.
         :param type: The type to give the source.
         :param reserve: Configure a reserve.
         :param sources: Configure sources.
+        :param floor: Configure a floor.
+        :param ceiling: Configure a ceiling.
         """
         super(SourceConfigFixture, self).__init__()
         self._type = type
         self._name = name
         self._reserve = reserve
         self._sources = sources
+        self._floor = floor
+        self._ceiling = ceiling
 
     def setUp(self):
         super(SourceConfigFixture, self).setUp()
@@ -52,6 +65,10 @@ class SourceConfigFixture(Fixture):
             conf['reserve'] = str(self._reserve)
         if self._sources is not None:
             conf['sources'] = self._sources.split(',')
+        if self._floor is not None:
+            conf['floor'] = str(self._floor)
+        if self._ceiling is not None:
+            conf['ceiling'] = str(self._ceiling)
         with open(os.path.join(source_dir, 'source.conf'), 'wt') as f:
             yaml.safe_dump(conf, f)
 
@@ -108,3 +125,106 @@ class TestConfig(TestCase):
         c = config.Config()
         s = c.get_source('model')
         self.assertEqual(1, s.reserve)
+
+    def test_get_source_policy_defaults_to_priority(self):
+        c = config.Config()
+        self.assertThat(c.get_source('local').policy,
+            IsInstance(priority.Policy))
+
+    def test_get_source_health_check(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        source_dir = os.path.join(os.environ['HOME'], '.config', 'crcache',
+            'sources', 'model')
+        os.mkdir(os.path.join(source_dir, 'check.d'))
+        script = os.path.join(source_dir, 'check.d', 'ping')
+        with open(script, 'wt') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(script, 0o755)
+        s = config.Config().get_source('model')
+        self.assertEqual([script], s.health_check.scripts)
+        self.assertEqual(None, s.health_check.command)
+
+    def test_get_source_no_health_check(self):
+        self.assertEqual(None, config.Config().get_source('local').health_check)
+
+    def test_get_source_eviction_limits(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        path = os.path.join(os.environ['HOME'], '.config', 'crcache',
+            'sources', 'model', 'source.conf')
+        with open(path, 'wt') as f:
+            yaml.safe_dump({'type': 'model', 'max_idle': 60, 'max_age': '3600',
+                'max_uses': 5, 'eviction': 'lfu'}, f)
+        s = config.Config().get_source('model')
+        self.assertEqual((60, 3600, 5, 'lfu'),
+            (s.max_idle, s.max_age, s.max_uses, s.eviction))
+
+    def test_get_source_floor_and_ceiling_passed_to_cache(self):
+        self.useFixture(SourceConfigFixture('model', 'model', floor=1,
+            ceiling=4))
+        c = config.Config()
+        s = c.get_source('model')
+        self.assertEqual((1, 4), (s.floor, s.ceiling))
+
+    def test_store_defaults_to_sqlite(self):
+        c = config.Config()
+        store = c.get_source('local').store
+        self.assertThat(store, IsInstance(sqlite.Store))
+        self.assertEqual('local', store.shard)
+
+    def test_store_conf_selects_store(self):
+        root = config.default_path()[0]
+        os.makedirs(root)
+        with open(os.path.join(root, 'store.conf'), 'wt') as f:
+            yaml.safe_dump({'type': 'journal'}, f)
+        c = config.Config()
+        self.assertThat(c.get_source('local').store, IsInstance(journal.Store))
+
+    def test_store_conf_daemon_falls_back_to_local(self):
+        root = config.default_path()[0]
+        os.makedirs(root)
+        with open(os.path.join(root, 'store.conf'), 'wt') as f:
+            yaml.safe_dump({'type': 'daemon'}, f)
+        c = config.Config()
+        self.assertThat(c.get_source('local').store, IsInstance(local.Store))
+
+    def test_store_conf_lock_timeout(self):
+        root = config.default_path()[0]
+        os.makedirs(root)
+        with open(os.path.join(root, 'store.conf'), 'wt') as f:
+            yaml.safe_dump({'type': 'local', 'lock_timeout': 5}, f)
+        c = config.Config()
+        self.assertEqual(5, c.get_source('local').store._lockfile.timeout)
+
+    def test_get_source_imports_legacy_state(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        # The unsharded dbm older versions kept, with comma separated sets.
+        legacy = local.Store()
+        with write_locked(legacy):
+            legacy['pool/model'] = '0,1'
+            legacy['allocated/model'] = '1'
+            legacy['resource/0'] = 'model'
+            legacy['resource/1'] = 'model'
+            legacy['pool/other'] = '2'
+            legacy['resource/2'] = 'other'
+        s = config.Config().get_source('model')
+        self.assertEqual((set(['model-1']), 1), (s.instances(), s.cached()))
+        with read_locked(legacy):
+            self.assertEqual(['pool/other', 'resource/2'],
+                sorted(legacy.keys()))
+        # Once moved, the instances are not adopted a second time.
+        s.discard(['model-1'], force=True)
+        s.collect()
+        s = config.Config().get_source('model')
+        self.assertEqual((set(), 1), (s.instances(), s.cached()))
+
+    def test_get_source_imports_legacy_state_once(self):
+        self.useFixture(SourceConfigFixture('model', 'model'))
+        legacy = local.Store()
+        config.Config().get_source('model')
+        # Instances recorded after the import are left alone, and the legacy
+        # state is not even opened.
+        with write_locked(legacy):
+            legacy['pool/model'] = '0'
+        self.useFixture(MonkeyPatch('cr_cache.store.local.Store', None))
+        s = config.Config().get_source('model')
+        self.assertEqual(0, s.cached())
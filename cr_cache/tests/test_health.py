@@ -0,0 +1,59 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for health checking instances."""
+
+import os.path
+import sys
+
+from fixtures import TempDir
+
+from cr_cache import health
+from cr_cache.source import model
+from cr_cache.tests import TestCase
+
+
+class TestHealthCheck(TestCase):
+
+    def make_script(self, directory, name, code):
+        path = os.path.join(directory, name)
+        with open(path, 'wt') as f:
+            f.write('#!%s\nimport sys\n%s\n' % (sys.executable, code))
+        os.chmod(path, 0o755)
+        return path
+
+    def test_command_run_on_instance(self):
+        source = model.Source(None, None)
+        check = health.HealthCheck('foo', source, ['true'])
+        self.assertEqual(True, check('0'))
+        self.assertEqual(('popen', (['true'],)), source._calls[0][:2])
+
+    def test_scripts_get_instance_name(self):
+        directory = self.useFixture(TempDir()).path
+        script = self.make_script(directory, 'check',
+            'sys.exit(sys.argv[1] != "foo-0")')
+        check = health.HealthCheck('foo', model.Source(None, None),
+            scripts=[script])
+        self.assertEqual(True, check('0'))
+        self.assertEqual(False, check('1'))
+
+    def test_scripts_in(self):
+        directory = self.useFixture(TempDir()).path
+        second = self.make_script(directory, 'b', '')
+        first = self.make_script(directory, 'a', '')
+        with open(os.path.join(directory, 'README'), 'wt') as f:
+            f.write('not executable')
+        self.assertEqual([first, second], health.scripts_in(directory))
+        self.assertEqual([],
+            health.scripts_in(os.path.join(directory, 'missing')))
@@ -0,0 +1,82 @@
+#
+# Copyright (c) 2013 crcache contributors
+# 
+# Licensed under either the Apache License, Version 2.0 or the BSD 3-clause
+# license at the users choice. A copy of both licenses are available in the
+# project source as Apache-2.0 and BSD. You may not use this file except in
+# compliance with one of these two licences.
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under these licenses is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# license you chose for the specific language governing permissions and
+# limitations under that license.
+
+"""Tests for running work concurrently."""
+
+import threading
+
+from testtools.matchers import raises
+
+from cr_cache import parallel
+from cr_cache.tests import TestCase
+
+
+class TestRun(TestCase):
+
+    def test_results_in_order(self):
+        results = parallel.run(lambda item:item * 2, [3, 1, 2], 2)
+        self.assertEqual([(3, 6, None), (1, 2, None), (2, 4, None)], results)
+
+    def test_errors_collected(self):
+        def fail_odd(item):
+            if item % 2:
+                raise ValueError(item)
+            return item
+        results = parallel.run(fail_odd, [1, 2, 3], 3)
+        self.assertEqual([2], [result[1] for result in results
+            if result[2] is None])
+        self.assertEqual([ValueError, ValueError],
+            [result[2][0] for result in results if result[2] is not None])
+
+    def test_runs_concurrently_up_to_limit(self):
+        lock = threading.Lock()
+        running = [0, 0]
+        barrier = threading.Event()
+        def work(item):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+                if running[0] == 2:
+                    barrier.set()
+            barrier.wait(5)
+            with lock:
+                running[0] -= 1
+        parallel.run(work, range(6), 2)
+        self.assertEqual(2, running[1])
+
+
+class TestRaiseErrors(TestCase):
+
+    def raiser(self, items):
+        def fail_odd(item):
+            if item % 2:
+                raise ValueError('odd %d' % item)
+            return item
+        return lambda:parallel.raise_errors(
+            parallel.run(fail_odd, items, 3))
+
+    def test_no_errors(self):
+        self.raiser([2, 4])()
+
+    def test_one_error_raised_as_is(self):
+        self.assertThat(self.raiser([1, 2]), raises(ValueError('odd 1')))
+
+    def test_several_errors_raised_together(self):
+        try:
+            self.raiser([1, 2, 3])()
+        except parallel.Errors as e:
+            self.assertEqual([1, 3], [item for item, _ in e.errors])
+            self.assertEqual('1: odd 1; 3: odd 3', str(e))
+        else:
+            self.fail('Errors not raised')
@@ -87,12 +87,16 @@ setup(name='crcache',
         'cr_cache',
         'cr_cache.arguments',
         'cr_cache.commands',
+        'cr_cache.policy',
         'cr_cache.store',
+        'cr_cache.strategy',
         'cr_cache.ui',
         'cr_cache.tests',
         'cr_cache.tests.arguments',
         'cr_cache.tests.commands',
+        'cr_cache.tests.policy',
         'cr_cache.tests.store',
+        'cr_cache.tests.strategy',
         'cr_cache.tests.ui',
         ],
       install_requires=[